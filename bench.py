@@ -0,0 +1,295 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+from block import *
+from chain import *
+from client import *
+from server import *
+from protocol import *
+
+# microbenchmarks for the hot paths of a node, run against synthetic chains.
+# results are written as json, so runs can be compared across versions:
+#
+#   python bench.py --sizes 1000,10000,100000 --output bench.json
+
+DEFAULT_SIZES = '1000,10000,100000'
+NUM_ACCOUNTS = 1000
+NUM_LOOKUPS = 10000
+
+def quiet(*args):
+    pass
+
+HANDLERS = {
+    'onstatus': quiet,
+    'onerror': quiet,
+    'onconnect': quiet,
+    'ondisconnect': quiet,
+    'onfailure': quiet
+}
+
+# a tx chain of `n` blocks (starting with the genesis block) moving funds
+# between random accounts
+def gentxchain(n, accounts, rng):
+    started = datetime.datetime(2018, 1, 1)
+    blocks = [GENESISTX]
+
+    for i in xrange(1, n):
+        sender = '0x0' if i < len(accounts) else rng.choice(accounts)
+        blocks.append(Transaction(i, started + datetime.timedelta(seconds=i), sender, accounts[i % len(accounts)], rng.randint(1, 100), i - 1))
+
+    return blocks
+
+# a tx_cnf chain of `n` blocks, fully confirming the first n / REQUIRED_CONFIRMATIONS tx blocks
+def gencnfchain(n, txblocks):
+    started = datetime.datetime(2018, 1, 1)
+    blocks = []
+
+    for i in xrange(n):
+        linked = txblocks[min(i // REQUIRED_CONFIRMATIONS, len(txblocks) - 1)]
+        blocks.append(Confirmation(i, started + datetime.timedelta(seconds=i), linked.blockid, 'validator{}'.format(i % REQUIRED_CONFIRMATIONS), 'SUCCESS', i - 1 if i != 0 else None))
+
+    return blocks
+
+# build a chain from blocks, optionally writing them to its block log as well
+def mkchain(key, blocks, path, compact=False, persist=False):
+    bc = Chain(key, compact=compact and key in COMPACT_BLOCKS, path=os.path.join(path, key))
+
+    for blk in blocks:
+        if persist:
+            blk.savelocal(bc)
+        bc.append(blk)
+
+    if persist:
+        bc.log.close()
+
+    return bc
+
+# best wall time of `repeat` runs of fn(setup()), with setup left out of the timing
+def timed(fn, ops, repeat, setup=None):
+    best = None
+
+    for i in xrange(repeat):
+        state = setup() if setup is not None else None
+
+        started = default_timer()
+        fn(state)
+        seconds = default_timer() - started
+
+        best = seconds if best is None else min(best, seconds)
+
+    return {
+        'seconds': best,
+        'ops': ops,
+        'ops_per_sec': ops / best if best > 0 else None
+    }
+
+class Bench:
+    def __init__(self, n, repeat, compact, server_mode, compression, seed):
+        self.n = n
+        self.repeat = repeat
+        self.compact = compact
+        self.server_mode = server_mode
+        self.compression = compression
+        self.rng = random.Random(seed)
+        self.path = tempfile.mkdtemp(prefix='p2p-bench-')
+
+        self.accounts = ['acct{}'.format(i) for i in xrange(NUM_ACCOUNTS)]
+        self.txblocks = gentxchain(n, self.accounts, self.rng)
+        self.cnfblocks = gencnfchain(n, self.txblocks)
+        self.results = {}
+
+    def run(self):
+        try:
+            self.serialization()
+            self.loadlocal()
+            self.balances()
+            self.mining()
+
+            for codec in CODECS:
+                self.fetchblocks(codec)
+        finally:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+        return self.results
+
+    # a fresh set of chains holding the synthetic blocks, with their block logs in `path`
+    def chains(self, path=None, persist=False):
+        path = path or tempfile.mkdtemp(dir=self.path)
+
+        return dict((key, mkchain(key, blocks, path, self.compact, persist)) for key, blocks in [
+            ('tx', self.txblocks),
+            ('tx_cnf', self.cnfblocks),
+            ('blk', []),
+            ('blk_cnf', [])
+        ])
+
+    def serialization(self):
+        encoded = [blk.serialize_json() for blk in self.txblocks]
+
+        self.results['serialize_json'] = timed(lambda state: [blk.serialize_json() for blk in self.txblocks], self.n, self.repeat)
+        self.results['deserialize_json'] = timed(lambda state: [Transaction.deserialize_json(data) for data in encoded], self.n, self.repeat)
+
+    # replay of the block logs written for the tx and tx_cnf chains
+    def loadlocal(self):
+        path = tempfile.mkdtemp(dir=self.path)
+        self.chains(path, persist=True)
+
+        for key in ['tx', 'tx_cnf']:
+            def setup():
+                return Chain(key, compact=self.compact and key in COMPACT_BLOCKS, path=os.path.join(path, key))
+
+            def load(bc):
+                bc._loadlocalloop(HANDLERS)
+                bc.log.close()
+
+            self.results['loadlocal_{}'.format(key)] = timed(load, self.n, self.repeat, setup)
+
+    def balances(self):
+        chains = self.chains()
+        lookups = [self.rng.choice(self.accounts) for i in xrange(NUM_LOOKUPS)]
+
+        # building the confirmation and balance indexes over existing chains
+        self.results['index_build'] = timed(lambda state: Client(chains['tx'], chains['tx_cnf'], chains['blk'], chains['blk_cnf'], HANDLERS), self.n, self.repeat)
+
+        client = Client(chains['tx'], chains['tx_cnf'], chains['blk'], chains['blk_cnf'], HANDLERS)
+        self.results['calcbalance'] = timed(lambda state: [client._calcbalance(acct) for acct in lookups], len(lookups), self.repeat)
+
+    # confirming every tx block that still needs confirmations
+    def mining(self):
+        def setup():
+            chains = self.chains()
+            client = Client(chains['tx'], chains['tx_cnf'], chains['blk'], chains['blk_cnf'], HANDLERS)
+            client.is_connected = True
+
+            # the chains are complete and there's no node to catch up with
+            client.checked = set(['tx', 'tx_cnf'])
+            chains['tx'].local_blocks_loaded = chains['tx_cnf'].local_blocks_loaded = True
+
+            # one confirmation gets added for every block short of confirmations
+            unconfirmed = sum(1 for blk in self.txblocks if not blk.isgenesis() and client.confirmations.tally(blk.blockid).count() < REQUIRED_CONFIRMATIONS)
+
+            return client, len(self.cnfblocks) + unconfirmed
+
+        def mine((client, expected)):
+            thread.start_new_thread(client.check_for_blocks_to_mine, (client.tx_chain, client.tx_cnf_chain))
+
+            while len(client.tx_cnf_chain.blocks) < expected:
+                time.sleep(0.001)
+
+            client.is_connected = False
+
+        self.results['check_for_blocks_to_mine'] = timed(mine, self.n, self.repeat, setup)
+
+    # paging through the whole tx chain from a server over loopback, with a
+    # fresh server (and so a cold encoded block cache) every run
+    def fetchblocks(self, codec):
+        chains = self.chains()
+
+        def setup():
+            srv = Server(chains['tx'], chains['tx_cnf'], chains['blk'], chains['blk_cnf'], quiet, mode=self.server_mode)
+            srv.start('127.0.0.1', 0)
+
+            sock = socket.create_connection(srv.socket.getsockname())
+            reader = FrameReader()
+
+            sendmessage(sock, {
+                'type': 'hello',
+                'codecs': [codec],
+                'compressions': [self.compression] if self.compression is not None else []
+            })
+
+            awaitmessage(sock, reader, 'hello')
+
+            return srv, sock, reader
+
+        def fetch((srv, sock, reader)):
+            cursor = -1
+            more = True
+
+            while more:
+                sendmessage(sock, {
+                    'type': 'fetchblocks',
+                    'blockidgt': cursor,
+                    'bc': 'tx'
+                })
+
+                page = awaitmessage(sock, reader, 'retrieveblocks')
+                cursor = page['cursor']
+                more = page['more']
+
+            sock.close()
+            srv.stop()
+
+        self.results['fetchblocks_{}'.format(codec)] = timed(fetch, self.n, self.repeat, setup)
+
+def awaitmessage(sock, reader, msg_type):
+    while 1:
+        frames = reader.recv(sock)
+
+        if frames is None:
+            raise socket.error('connection closed')
+
+        for frame in frames:
+            obj = decodemessage(frame)
+
+            if obj.get('type') == msg_type:
+                return obj
+
+def gitrevision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='P2P benchmarks')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated numbers of blocks in the synthetic chains')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark; the fastest one is reported')
+    parser.add_argument('--compact-chains', action='store_true', help='keep the tx and tx_cnf chains in memory as columns')
+    parser.add_argument('--server-mode', choices=SERVER_MODES, default='threaded', help='server mode for the fetchblocks benchmark')
+    parser.add_argument('--compression', choices=COMPRESSIONS, help='compression for the fetchblocks benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    report = {
+        'revision': gitrevision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT),
+        'repeat': args.repeat,
+        'compact_chains': args.compact_chains,
+        'server_mode': args.server_mode,
+        'compression': args.compression,
+        'runs': []
+    }
+
+    for n in [int(size) for size in args.sizes.split(',')]:
+        sys.stderr.write('benchmarking {} blocks...\n'.format(n))
+
+        report['runs'].append({
+            'blocks': n,
+            'results': Bench(n, args.repeat, args.compact_chains, args.server_mode, args.compression, args.seed).run()
+        })
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
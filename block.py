@@ -3,6 +3,16 @@ import datetime
 import time
 import json
 
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# equivalent to datetime.datetime.strptime(s, TIMESTAMP_FORMAT), but without
+# going through the generic format parser.
+def parsetimestamp(s):
+    if len(s) != 19 or s[4] != '-' or s[7] != '-' or s[10] != 'T' or s[13] != ':' or s[16] != ':':
+        raise ValueError("time data {!r} does not match format {!r}".format(s, TIMESTAMP_FORMAT))
+
+    return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
 class Block:
     def __init__(self, blockid, timestamp, data, parent):
         self.blockid = blockid
@@ -25,7 +35,7 @@ class Block:
     def serialize_obj(self):
         return {
             'blockid': self.blockid,
-            'timestamp': self.timestamp.strftime("%Y-%m-%dT%H:%M:%S"),
+            'timestamp': self.timestamp.strftime(TIMESTAMP_FORMAT),
             'data': self.data,
             'parent': self.parent
         }
@@ -40,28 +50,41 @@ class Block:
         assert obj['timestamp'] is not None
         assert obj['data'] is not None
 
-        obj['timestamp'] = datetime.datetime.strptime(obj['timestamp'], "%Y-%m-%dT%H:%M:%S")
+        obj['timestamp'] = parsetimestamp(obj['timestamp'])
 
         return Block(blockid=int(obj['blockid']), timestamp=obj['timestamp'], data=obj['data'], parent=obj['parent'])
 
     def savelocal(self, bc):
-        f = open('./data/{}/{}-{}.dat'.format(bc.key, bc.key, self.blockid), 'w+')
-        f.write(self.serialize_json())
+        bc.log.append(self)
+
+    def calcnumcnfs(self, cnf_index):
+        return cnf_index.tally(self.blockid).count()
+
 
-    def calcnumcnfs(self, cnf_bc):
-        cnfs = filter(lambda x: x.blockid == self.blockid, cnf_bc.blocks)
-        return len(cnfs)
+# the (sender, receiver, amt) transfers in a tx block's data: a single one for
+# a plain transaction, or several for a block assembled from the mempool
+def transfers(data):
+    if 'txs' in data:
+        return [(tx['sender'], tx['receiver'], tx['amt']) for tx in data['txs']]
 
+    return [(data['sender'], data['receiver'], data['amt'])]
 
 class Transaction(Block):
     def __init__(self, blockid, timestamp, senderid, receiverid, amt, parent):
         Block.__init__(self, blockid, timestamp, { 'sender': senderid, 'receiver': receiverid, 'amt': amt }, parent)
 
+    def transfers(self):
+        return transfers(self.data)
+
     @classmethod
     def deserialize_obj(cls, obj):
         assert obj['blockid'] is not None
         assert obj['timestamp'] is not None
         assert obj['data'] is not None
+
+        if 'txs' in obj['data']:
+            return TransactionBatch.deserialize_obj(obj)
+
         assert obj['data']['sender'] is not None
         assert isinstance(obj['data']['sender'], basestring)
         assert obj['data']['receiver'] is not None
@@ -70,10 +93,33 @@ class Transaction(Block):
         assert isinstance(obj['data']['amt'], int)
         assert obj['data']['amt'] > 0
 
-        obj['timestamp'] = datetime.datetime.strptime(obj['timestamp'], "%Y-%m-%dT%H:%M:%S")
+        obj['timestamp'] = parsetimestamp(obj['timestamp'])
 
         return Transaction(blockid=int(obj['blockid']), timestamp=obj['timestamp'], senderid=obj['data']['sender'], receiverid=obj['data']['receiver'], amt=obj['data']['amt'], parent=obj['parent'])
 
+# a tx block holding several transactions, given as (sender, receiver, amt)
+class TransactionBatch(Transaction):
+    def __init__(self, blockid, timestamp, txs, parent):
+        Block.__init__(self, blockid, timestamp, { 'txs': [{ 'sender': sender, 'receiver': receiver, 'amt': amt } for sender, receiver, amt in txs] }, parent)
+
+    @classmethod
+    def deserialize_obj(cls, obj):
+        assert obj['blockid'] is not None
+        assert obj['timestamp'] is not None
+        assert obj['data'] is not None
+        assert isinstance(obj['data']['txs'], list)
+        assert len(obj['data']['txs']) > 0
+
+        for tx in obj['data']['txs']:
+            assert isinstance(tx['sender'], basestring)
+            assert isinstance(tx['receiver'], basestring)
+            assert isinstance(tx['amt'], int)
+            assert tx['amt'] > 0
+
+        obj['timestamp'] = parsetimestamp(obj['timestamp'])
+
+        return TransactionBatch(blockid=int(obj['blockid']), timestamp=obj['timestamp'], txs=transfers(obj['data']), parent=obj['parent'])
+
 
 class Confirmation(Block):
     def __init__(self, blockid, timestamp, linkedblockid, validatorid, result, parent):
@@ -92,7 +138,7 @@ class Confirmation(Block):
         assert isinstance(obj['data']['result'], basestring)
         assert obj['data']['result'] == 'FAILURE' or obj['data']['result'] == 'SUCCESS'
 
-        obj['timestamp'] = datetime.datetime.strptime(obj['timestamp'], "%Y-%m-%dT%H:%M:%S")
+        obj['timestamp'] = parsetimestamp(obj['timestamp'])
 
         return Confirmation(blockid=int(obj['blockid']), timestamp=obj['timestamp'], linkedblockid=obj['data']['linkedblock'], validatorid=obj['data']['validator'], result=obj['data']['result'], parent=obj['parent'])
 
@@ -0,0 +1,87 @@
+import json
+import thread
+from collections import OrderedDict
+
+from codec import *
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+ENTRY_OVERHEAD = 100 # rough per-entry cost of the key and dict slot, in bytes
+
+# blocks never change once they are in a chain, so the server keeps their
+# encoded form around instead of re-encoding the same blocks for every client.
+# entries are keyed by chain, codec and blockid, and the least recently used
+# ones are evicted once the cache grows past `maxbytes`.
+#
+# the reply to 'latestblock' is cached per chain as well, and dropped whenever
+# a block is appended to that chain.
+class EncodedBlockCache:
+    def __init__(self, chains, maxbytes=DEFAULT_CACHE_BYTES):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.entries = OrderedDict() # (chain key, codec, blockid) -> encoded block
+        self.tips = {} # chain key -> encoded 'retrievelatestblock' reply
+        self.versions = {} # chain key -> number of appends seen
+        self.hits = 0
+        self.misses = 0
+        self.lock = thread.allocate_lock()
+
+        for bc in chains:
+            self.versions[bc.key] = 0
+            # nothing to replay for a compact chain, so skip materializing it
+            bc.addlistener(self._onappend, bulk=lambda blocks: None)
+
+    def get(self, bc, blk, codec):
+        key = (bc.key, codec, blk.blockid)
+
+        with self.lock:
+            data = self.entries.pop(key, None)
+
+            if data is not None:
+                # re-insert to mark it as most recently used
+                self.entries[key] = data
+                self.hits += 1
+                return data
+
+            self.misses += 1
+
+        data = encodeblock(blk) if codec == 'binary' else blk.serialize_json()
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = data
+                self.size += len(data) + ENTRY_OVERHEAD
+
+                while self.size > self.maxbytes and len(self.entries) != 0:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= len(evicted) + ENTRY_OVERHEAD
+
+        return data
+
+    def tip(self, bc):
+        with self.lock:
+            reply = self.tips.get(bc.key)
+
+            if reply is not None:
+                return reply
+
+            version = self.versions[bc.key]
+
+        # the block and its hash have to be read together
+        with bc.lock:
+            blk = bc.latestblock() if len(bc.blocks) != 0 else None
+            blkhash = bc.hashat(-1).encode('hex') if blk is not None else None
+
+        reply = '{{"type": "retrievelatestblock", "bc": {}, "block": {}, "hash": {}}}'.format(
+            json.dumps(bc.key), self.get(bc, blk, 'json') if blk is not None else 'null', json.dumps(blkhash))
+
+        with self.lock:
+            # don't cache a tip that was already replaced while encoding it
+            if self.versions[bc.key] == version:
+                self.tips[bc.key] = reply
+
+        return reply
+
+    def _onappend(self, bc, blk):
+        with self.lock:
+            self.versions[bc.key] += 1
+            self.tips.pop(bc.key, None)
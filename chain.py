@@ -1,10 +1,16 @@
 import time
 import os
 import thread
-import re
 import sqlite3
+from array import array
+from bisect import bisect_right
 
 from block import *
+from codec import *
+from storage import *
+from columnar import *
+from lazy import *
+from metrics import *
 
 if not os.path.isdir('./data'):
     os.mkdir('./data')
@@ -12,76 +18,215 @@ if not os.path.isdir('./data'):
 # blocks_conn = sqlite3.connect('./data/blocks.db')
 # blocks_cur = blocks_conn.cursor()
 
+# chains that can keep their blocks in columns (see columnar.py)
+COMPACT_BLOCKS = {
+    'tx': TxBlocks,
+    'tx_cnf': CnfBlocks
+}
+
 class Chain:
-    def __init__(self, key):
-        self.blocks = []
+    # a lazy chain keeps only its blockids in memory, and reads blocks back
+    # from the block log when they're used (see lazy.py)
+    def __init__(self, key, compact=False, lazy=False, cache_blocks=DEFAULT_CACHE_BLOCKS, **logopts):
+        assert not compact or key in COMPACT_BLOCKS, "only the {} chains can be compact".format(', '.join(COMPACT_BLOCKS))
+        assert not (compact and lazy), "a chain can't be both compact and lazy"
+
         self.key = key
+        self.compact = compact
+        self.lazy = lazy
+        self.cache_blocks = cache_blocks
+        self.metrics = Metrics()
+        self.log = BlockLog(key, metrics=self.metrics, **logopts)
+        self.setblocks([])
         self.remote_diff = 0
         self.local_blocks_loaded = False
+        self.listeners = []
+        self.lock = thread.allocate_lock()
+
+        self.metrics.gauge('blocks', lambda: len(self.blocks))
+        self.metrics.gauge('remote_diff', lambda: self.remote_diff)
+
+        if lazy:
+            self.metrics.gauge('cache_hits', lambda: self.blocks.hits)
+            self.metrics.gauge('cache_misses', lambda: self.blocks.misses)
+
+    # register fn(bc, blk) to be called for every block appended to this chain.
+    # existing blocks are replayed so the listener starts with a complete view.
+    # for a compact chain, `bulk` can instead build the listener's view of the
+    # existing blocks from the columns in one go.
+    def addlistener(self, fn, bulk=None):
+        with self.lock:
+            self.listeners.append(fn)
+
+            if self.compact and bulk is not None:
+                bulk(self.blocks)
+                return
+
+            for blk in self.blocks:
+                fn(self, blk)
+
+    # `encoded` is the block's binary encoding, if the caller already has it
+    def append(self, blk, encoded=None):
+        if encoded is None:
+            encoded = encodeblock(blk)
+
+        with self.lock:
+            self.hashes += blockhash(encoded, self.hashat(-1) if len(self.blocks) != 0 else NO_HASH)
+            self.blocks.append(blk)
+
+            if not (self.compact or self.lazy):
+                self.blockids.append(blk.blockid)
+
+            for fn in self.listeners:
+                fn(self, blk)
+
+        self.metrics.meter('appended').mark()
 
     def loadlocal(self, handlers):
         thread.start_new_thread(self._loadlocalloop, (handlers,))
 
     def _loadlocalloop(self, handlers):
-        time.sleep(5)
         assert self.local_blocks_loaded == False
 
         k = self.key
-        pth = './data/{}'.format(k)
+        pth = self.log.path
 
         handlers['onstatus']('Loading local blocks in path "{}"...'.format(pth))
 
-        if os.path.isdir(pth):
-            for dirpath, dnames, fnames in os.walk(pth):
-                for f in fnames:
-                    m = re.search('^{}-(\d+).dat$'.format(k), f)
-                    
-                    if m is not None:
-                        blockindex = int(m.group(1))
-
-                        try:
-                            self._loadblock(blockindex, dirpath, f, handlers)
-                        except (IOError, ValueError) as e:
-                            handlers['onerror']('Failed to load block #{} in path \'{}\'. It is recommended to delete the \'{}\' directory to do a complete resync. The error was: {}'.format(blockindex, pth, k, e))
-
-            if len(self.blocks) == 0:
-                handlers['onstatus']('No local blocks to load in path \'{}\'.'.format(pth))
-
-                if k == 'tx':
-                    handlers['onstatus']('Creating genesis block before starting peer sync...')
-                    self._creategenesisblock(handlers)
-                else:
-                    self.local_blocks_loaded = True
-            else:
-                handlers['onstatus']('Done loading local blocks in path \'{}\'.'.format(pth))
-                self.local_blocks_loaded = True
-        else:
-            handlers['onstatus']('No local blocks to load.')
+        try:
+            num_migrated = self.log.migrate()
+
+            if num_migrated != 0:
+                handlers['onstatus']('Migrated {} blocks in path \'{}\' to the block log.'.format(num_migrated, pth))
 
-            handlers['onstatus']('Creating \'{}\' directory...'.format(pth))
-            os.mkdir(pth)
+            # blocks restored from a snapshot are already in place, so only
+            # the blocks written after it need to be replayed.
+            after = self.latestblock().blockid if len(self.blocks) != 0 else None
+
+            for blockid, payload in self.log.iterrecords(after):
+                try:
+                    self._loadblock(payload)
+                except (ValueError, KeyError, AssertionError) as e:
+                    handlers['onerror']('Failed to load block #{} in path \'{}\'. It is recommended to delete the \'{}\' directory to do a complete resync. The error was: {}'.format(blockid, pth, k, e))
+                    break
+        except (IOError, OSError) as e:
+            handlers['onerror']('Failed to read the block log in path \'{}\'. The error was: {}'.format(pth, e))
+            return
+
+        if len(self.blocks) == 0:
+            handlers['onstatus']('No local blocks to load in path \'{}\'.'.format(pth))
 
             if k == 'tx':
                 handlers['onstatus']('Creating genesis block before starting peer sync...')
                 self._creategenesisblock(handlers)
+        else:
+            handlers['onstatus']('Done loading local blocks in path \'{}\'.'.format(pth))
+
+        self.local_blocks_loaded = True
 
     def _creategenesisblock(self, handlers):
         assert self.key == 'tx'
-        GENESISTX.savelocal(self.key)
-
-        # re-run
-        self.loadlocal(handlers)
 
-    def _loadblock(self, blockindex, dirpath, fname, handlers):
-        # handlers['onstatus']('Loading block #{} ...'.format(blockindex))
+        GENESISTX.savelocal(self)
+        self.log.flush()
+        self.append(GENESISTX)
 
-        blkfile = open(os.path.join(dirpath, fname))
-        blk = Block.deserialize_json(blkfile.read())
+    def _loadblock(self, payload):
+        blk = decodestored(payload)
 
         if not blk.isgenesis():
             assert blk.parent == self.latestblock().blockid
 
-        self.blocks.append(blk)
+        # binary tx and confirmation records are already encoded the way the
+        # block is hashed (older block records may not have sorted their data)
+        self.append(blk, payload if payload[:1] in (chr(KIND_TX), chr(KIND_TXS), chr(KIND_CNF)) else None)
+
+    # replace the chain's blocks without notifying listeners, for restoring
+    # blocks whose derived state is restored separately. their hashes are
+    # recomputed unless given. the caller holds the lock.
+    def setblocks(self, blocks, hashes=None):
+        if hashes is not None and len(hashes) == len(blocks) * HASH_SIZE:
+            self.hashes = bytearray(hashes)
+        else:
+            self.hashes = bytearray()
+
+            for blk in blocks:
+                self.hashes += blockhash(encodeblock(blk), str(self.hashes[-HASH_SIZE:]) if len(self.hashes) != 0 else NO_HASH)
+
+        if self.compact:
+            self.blocks = COMPACT_BLOCKS[self.key]()
+
+            for blk in blocks:
+                self.blocks.append(blk)
+
+            # the blockid column doubles as the index
+            self.blockids = self.blocks.blockid
+        elif self.lazy:
+            # the blocks have to be in the log already
+            self.blocks = LazyBlocks(self.log, self.cache_blocks)
+
+            for blk in blocks:
+                self.blocks.append(blk)
+
+            self.blockids = self.blocks.blockid
+        else:
+            self.blocks = blocks
+            self.blockids = array('l', [blk.blockid for blk in blocks])
+
+    # like setblocks(), for a chain whose blocks are in its log up to
+    # `blockids`. a lazy chain only needs their ids, other chains read them
+    # back from the log. raises KeyError if the log doesn't go that far (e.g.
+    # it lost its tail in a crash). the caller holds the lock.
+    def setblockids(self, blockids, hashes=None):
+        self.log.open()
+
+        if len(blockids) != 0 and blockids[-1] not in self.log:
+            raise KeyError(blockids[-1])
+
+        if not self.lazy:
+            self.setblocks([decodestored(self.log.read(blockid)) for blockid in blockids], hashes)
+            return
+
+        self.blocks = LazyBlocks(self.log, self.cache_blocks)
+        self.blocks.blockid.extend(blockids)
+        self.blockids = self.blocks.blockid
+
+        if hashes is not None and len(hashes) == len(blockids) * HASH_SIZE:
+            self.hashes = bytearray(hashes)
+        else:
+            self.hashes = bytearray()
+
+            for blk in self.blocks:
+                self.hashes += blockhash(encodeblock(blk), str(self.hashes[-HASH_SIZE:]) if len(self.hashes) != 0 else NO_HASH)
+
+    # position in self.blocks of the first block with a blockid greater than `blockid`
+    def positionafter(self, blockid):
+        return bisect_right(self.blockids, blockid)
+
+    # hash of the block at position i in self.blocks
+    def hashat(self, i):
+        if i < 0:
+            i += len(self.hashes) // HASH_SIZE
+
+        return str(self.hashes[i * HASH_SIZE:(i + 1) * HASH_SIZE])
+
+    # hash of the block with this blockid, or None if the chain doesn't have it
+    def hashof(self, blockid):
+        i = bisect_right(self.blockids, blockid) - 1
+
+        if i < 0 or self.blockids[i] != blockid:
+            return None
+
+        return self.hashat(i)
+
+    # the block with this blockid, or None if the chain doesn't have it
+    def find(self, blockid):
+        i = bisect_right(self.blockids, blockid) - 1
+
+        if i < 0 or self.blockids[i] != blockid:
+            return None
+
+        return self.blocks[i]
 
     def latestblock(self):
         assert len(self.blocks) != 0
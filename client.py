@@ -1,4 +1,5 @@
 import thread
+import Queue
 import socket
 import json
 import time
@@ -6,42 +7,150 @@ from functools import reduce
 
 from block import *
 from chain import *
-
-class InvalidMessage(Exception):
-    def __init__(self, msg):
-        self.msg = "Invalid message: {}".format(msg)
+from index import *
+from protocol import *
+from rangesync import *
+from ingest import *
+from metrics import *
+from forks import *
+from pending import *
+from gossip import *
+from peers import *
+
+PARALLEL_SYNC_THRESHOLD = 2 * SYNC_CHUNK_SIZE # blocks behind before syncing from several peers
+
+RESYNC_INTERVAL = 5 # seconds between checking each chain's sync state
+SUBSCRIBED_RESYNC_INTERVAL = 60 # the same, once the node pushes new blocks to us
+PING_TIMEOUT = 5 # seconds before an unanswered ping counts against the node
+FAILOVER_DELAY = 2 # seconds between dropping a degraded node and connecting to another, for the old connection's threads to wind down
+MINE_RECHECK_INTERVAL = 30 # seconds before a block still short of confirmations is looked at again
+
+# message types the client handles; metrics for anything else are kept under 'unknown'
+MESSAGE_TYPES = ('pong', 'hello', 'updatepeers', 'subscribed', 'announce', 'retrievelatestblock', 'headers', 'retrieveblocks', 'balance', 'accounthistory', 'submittedtx', 'broadcast', 'error')
+
+# the type of the reply to each request, where it differs from the request's
+REPLY_TYPES = {
+    'ping': 'pong',
+    'subscribe': 'subscribed',
+    'latestblock': 'retrievelatestblock',
+    'fetchblocks': 'retrieveblocks',
+    'submittx': 'submittedtx'
+}
 
 class Client:
-    def __init__(self, tx_chain, tx_cnf_chain, blk_chain, blk_cnf_chain, handlers):
+    def __init__(self, tx_chain, tx_cnf_chain, blk_chain, blk_cnf_chain, handlers, max_frame_size=MAX_FRAME_SIZE, ingest_processes=0, peers=None):
         self.handlers = handlers
+        self.max_frame_size = max_frame_size
 
         self.socket = None
-        self.peers = []
+        self.codec = 'json'
+        self.compression = None
+        self.server_address = None
+        self.sendlock = thread.allocate_lock()
+        self.peers = peers if peers is not None else PeerTable() # nodes to connect and sync to, by score
+        self.failover_to = None # peer to connect to once the connection being dropped is gone
+        self.subscribed = False
+        self.forksearches = {} # chain key -> ForkSearch in progress
+        self.forks = {} # chain key -> (last common blockid, remote tip) of a detected fork
+        self.requests = PendingRequests() # requests waiting for a reply, by id
+        self.announced = {} # chain key -> latest blockid the node announced
+        self.checked = set() # keys of the chains compared with the node's since connecting
+        self.broadcastlisteners = []
         self.is_connected = False
+        self.connecting = False # a connection is being made, see connect()
+        self.connectlock = thread.allocate_lock()
 
         self.tx_chain = tx_chain
         self.tx_cnf_chain = tx_cnf_chain
         self.blk_chain = blk_chain
         self.blk_cnf_chain = blk_cnf_chain
 
+        self.confirmations = ConfirmationIndex(tx_chain, tx_cnf_chain)
+        self.balances = BalanceIndex(tx_chain, self.confirmations)
+        self.accounts = AccountIndex(tx_chain)
+
+        # pages of blocks are validated and written off the socket reader's thread
+        self.ingest = IngestPipeline(self._onnewremoteblock, handlers['onerror'], processes=ingest_processes)
+
+        self.metrics = Metrics()
+        self.metrics.gauge('connected', lambda: self.is_connected)
+        self.metrics.gauge('subscribed', lambda: self.subscribed)
+        self.metrics.gauge('requests', lambda: len(self.requests))
+        self.metrics.gauge('sync_lag', lambda: dict((bc.key, bc.remote_diff) for bc in [self.tx_chain, self.tx_cnf_chain, self.blk_chain, self.blk_cnf_chain]))
+        self.metrics.gauge('ingest', self.ingest.stats)
+        self.metrics.gauge('server', lambda: '{}:{}'.format(*self.server_address) if self.server_address is not None else None)
+
+    # start connecting to a node, unless connected or connecting already (e.g.
+    # while failing over). returns whether a connection was started.
     def connect(self, server_address, server_port):
-        assert not self.is_connected
+        if not self._reserveconnect():
+            return False
+
         thread.start_new_thread(self._connect, (server_address, server_port))
+        return True
+
+    # connect to the healthy peer with the best score, or to `default` (a
+    # (host, port)) if there's none. returns the address connected to, or
+    # None if there's none or another connection is being made.
+    def connectbest(self, default=None):
+        address = next(iter(self.peers.best(1)), default)
+
+        if address is None or not self.connect(*address):
+            return None
+
+        return address
+
+    # only one connection is made at a time, so two of them can't both set
+    # up self.socket. the caller goes on to _connect() if this returns True.
+    def _reserveconnect(self):
+        with self.connectlock:
+            if self.is_connected or self.connecting:
+                return False
+
+            self.connecting = True
+            return True
 
     def _connect(self, server_address, server_port):
+        self.peers.add((server_address, server_port))
+
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.settimeout(3)
             self.socket.connect((server_address, server_port))
+            self.server_address = (server_address, server_port)
+            self.codec = 'json'
+            self.compression = None
+            self.subscribed = False
+            self.announced = {}
+            self.checked = set()
             self.is_connected = True
 
+            # offer our codecs and compressions; the server answers with the ones it picked
+            self._request({
+                'type': 'hello',
+                'codecs': list(CODECS),
+                'compressions': list(COMPRESSIONS)
+            })
+
+            # ask to have new blocks pushed to us, so polling is only a fallback.
+            # nodes that don't know 'subscribe' just never answer it.
+            self._request({
+                'type': 'subscribe',
+                'bcs': [bc.key for bc in [self.tx_chain, self.tx_cnf_chain, self.blk_chain, self.blk_cnf_chain]],
+                'mode': 'blocks'
+            })
+
             thread.start_new_thread(self.listen_for_server_messages, ())
             thread.start_new_thread(self.periodically_resync_with_peers, ())
             thread.start_new_thread(self.check_for_blocks_to_mine, (self.tx_chain, self.tx_cnf_chain))
 
             self.handlers['onconnect']()
         except Exception as e:
+            self.peers.recordfailure((server_address, server_port))
             self.handlers['onfailure'](e)
+        finally:
+            with self.connectlock:
+                self.connecting = False
 
 
     def disconnect(self):
@@ -54,6 +163,8 @@ class Client:
         for bc in [self.tx_chain, self.tx_cnf_chain, self.blk_chain, self.blk_cnf_chain]:
             bc.remote_diff = 0
 
+        self.requests.failall('disconnected')
+
         #if self.is_connected:
         #    thread.start_new_thread(self.periodically_resync_with_peers, ())
 
@@ -76,31 +187,61 @@ class Client:
 
     def check_for_blocks_to_mine(self, bc, cnf_bc):
         my_id = 'TEST'
+        self.handlers['onstatus']("checking for blocks in '{}' chain to validate...".format(bc.key))
+
+        # a block's confirmations are only known once the tx_cnf chain is
+        # loaded and caught up with the node, so don't mine before then
+        while self.is_connected and not self._caughtup(bc, cnf_bc):
+            time.sleep(1)
+
+        recheck = {} # blockid -> block short of confirmations after being mined
+        rechecked = time.time()
+
         while self.is_connected:
-            self.handlers['onstatus']("checking for blocks in '{}' chain to validate...".format(bc.key))
+            if time.time() - rechecked > MINE_RECHECK_INTERVAL:
+                for blockid, block in recheck.items():
+                    tally = self.confirmations.tally(blockid)
+
+                    if tally.count() >= REQUIRED_CONFIRMATIONS:
+                        del recheck[blockid]
+                    elif my_id not in tally.validators:
+                        # our confirmation was lost, e.g. to a fork of the tx_cnf chain
+                        self.handlers['onstatus']("mining block {} again...".format(blockid))
+                        self._confirmblock(bc, block)
+
+                rechecked = time.time()
+
+            try:
+                block = self.confirmations.queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+
+            if not self.is_connected:
+                # leave it for the next time we connect
+                self.confirmations.queue.put(block)
+                break
 
-            for block in bc.blocks:
-                if not block.isgenesis():
-                    cnf_blocks = filter(lambda x: x.data['linkedblock'] == block.blockid, cnf_bc.blocks)
+            tally = self.confirmations.tally(block.blockid)
 
-                    if len(cnf_blocks) < 6:
-                        self.handlers['onstatus']("block {} requires {} more confirmations".format(block.blockid, 6 - len(cnf_blocks)))
+            if tally.count() < REQUIRED_CONFIRMATIONS:
+                self.handlers['onstatus']("block {} requires {} more confirmations".format(block.blockid, REQUIRED_CONFIRMATIONS - tally.count()))
 
-                        can_mine_block = True
+                if my_id not in tally.validators:
+                    self.handlers['onstatus']("mining block {}...".format(block.blockid))
 
-                        for cnf in cnf_blocks:
-                            if cnf.data['validator'] == my_id:
-                                can_mine_block = False
-                                break
+                    self._confirmblock(bc, block)
+                else:
+                    self.handlers['onstatus']("block {} already mined".format(block.blockid))
 
-                        if can_mine_block:
-                            self.handlers['onstatus']("mining block {}...".format(block.blockid))
+                recheck[block.blockid] = block
 
-                            self._confirmblock(bc, block)
-                        else:
-                            self.handlers['onstatus']("block {} already mined".format(block.blockid))
+        for block in recheck.itervalues():
+            self.confirmations.queue.put(block)
 
-            time.sleep(30)
+    # whether both chains hold their local blocks and have been brought up to
+    # date with the node since connecting
+    def _caughtup(self, *bcs):
+        return all(bc.local_blocks_loaded and bc.key in self.checked and bc.remote_diff == 0 and bc.key not in self.forksearches for bc in bcs)
 
     def respond_to_message(self, obj):
         msg_type = obj["type"]
@@ -110,8 +251,56 @@ class Client:
 
         if msg_type == "pong":
             pass
+        elif msg_type == "hello":
+            self.codec = obj['codec'] if obj.get('codec') in CODECS else 'json'
+            self.compression = obj['compression'] if obj.get('compression') in COMPRESSIONS else None
         elif msg_type == "updatepeers":
             self._updatepeers(obj["peers"])
+        elif msg_type == 'balance':
+            if 'onbalance' in self.handlers:
+                self.handlers['onbalance'](obj['acct'], obj['confirmed'], obj['unconfirmed'])
+        elif msg_type == 'accounthistory':
+            # blocks are newest first, and `cursor` continues with older ones
+            if 'onaccounthistory' in self.handlers:
+                blocks = [blk if isinstance(blk, Block) else Transaction.deserialize_obj(blk) for blk in obj['blocks']]
+                self.handlers['onaccounthistory'](obj['acct'], blocks, obj['cursor'] if obj.get('more') else None)
+        elif msg_type == 'submittedtx':
+            if 'onsubmittedtx' in self.handlers:
+                self.handlers['onsubmittedtx'](obj.get('accepted'), obj.get('txid'), obj.get('reason'))
+        elif msg_type == 'broadcast':
+            # a message relayed by the node (see gossip.py)
+            msg = obj.get('msg')
+
+            if not isinstance(msg, dict) or not isinstance(msg.get('type'), basestring) or not isinstance(obj.get('msgid'), basestring):
+                raise InvalidMessage(obj)
+
+            self.metrics.counter('broadcasts').inc()
+
+            for fn in self.broadcastlisteners:
+                fn(obj['msgid'], msg)
+        elif msg_type == 'subscribed':
+            self.subscribed = len(obj.get('bcs') or []) != 0
+        elif msg_type == 'announce':
+            bc = self._getblockchain(obj)
+            self.announced[bc.key] = max(obj['blockid'], self.announced.get(bc.key, -1))
+
+            # wait for local blocks, and leave the blocks to a sync already underway.
+            # announced blocks only link by blockid, so ignore them while forked.
+            if not bc.local_blocks_loaded or bc.remote_diff > 0 or bc.key in self.forksearches or bc.key in self.forks:
+                return
+
+            local_blockid = bc.latestblock().blockid if len(bc.blocks) != 0 else -1
+
+            if obj['blockid'] <= local_blockid:
+                return
+
+            # the blocks usually follow on from ours, but if they don't (or only
+            # the tip was announced), fetch what we're missing as usual
+            if len(obj.get('blocks') or []) != 0 and len(self._applyblocks(bc, obj['blocks'])) == 0 and bc.latestblock().blockid == obj['blockid']:
+                return
+
+            bc.remote_diff = obj['blockid'] - (bc.latestblock().blockid if len(bc.blocks) != 0 else -1)
+            self._fetchremoteblocks(bc)
         elif msg_type == 'retrievelatestblock':
             # retrieve latest block after running latestblock to node
             if obj['block'] is not None:
@@ -123,153 +312,351 @@ class Client:
                     remote_blk = Confirmation.deserialize_obj(obj['block'])
 
                 bc = self._getblockchain(obj)
-                bc.remote_diff = remote_blk.blockid - (bc.latestblock().blockid if len(bc.blocks) != 0 else 0)
+                search = self.forksearches.get(bc.key)
 
-                if bc.remote_diff != 0:
-                    if bc.remote_diff > 0:
-                        self.handlers['onstatus']('Local out of date with remote by {} blocks.'.format(bc.remote_diff))
-                        self._fetchremoteblocks(bc)
-                    else:
-                        self.handlers['onstatus']('Local ahead of remote by {} blocks.'.format(-1 * bc.remote_diff))
-                        #todo
+                if search is not None and not search.timedout():
+                    return
+
+                self.forksearches.pop(bc.key, None)
+
+                if obj.get('hash') is None or len(bc.blocks) == 0:
+                    # the node doesn't hash its blocks, so go by blockids alone
+                    self._syncto(bc, remote_blk.blockid)
+                else:
+                    self._checkfork(bc, remote_blk.blockid, obj['hash'])
+
+            self.checked.add(obj['bc'])
+
+        elif msg_type == 'headers':
+            bc = self._getblockchain(obj)
+            search = self.forksearches.get(bc.key)
+
+            # answers to a search that was since given up on are dropped
+            if search is None or obj.get('blockids') != search.pending or not isinstance(obj.get('headers'), list):
+                return
+
+            search.update(obj['blockids'], obj['headers'])
+
+            if search.done():
+                del self.forksearches[bc.key]
+                self._onforksearched(search)
+            else:
+                self._requestheaders(search)
 
         elif msg_type == 'retrieveblocks':
             assert obj['blocks'] is not None, "obj['blocks'] should not be None"
             assert isinstance(obj['blocks'], list), "obj['blocks'] should be of type `list`"
-            assert len(obj['blocks']) > 0, "len(obj['blocks']) should be > 0"
 
-            # validate each block
             bc = self._getblockchain(obj)
-            prevblockid = bc.latestblock().blockid if len(bc.blocks) != 0 else 0
+            more = obj.get('more')
+
+            def onvalidated(blocks, errors):
+                # the page is good, so fetch the next one while this one is written
+                if len(errors) == 0 and more and self.is_connected:
+                    self._fetchremoteblocks(bc, after=obj['cursor'])
+
+            def ondone(blocks, errors):
+                if len(errors) != 0:
+                    for error in errors:
+                        self.handlers['onerror']('Rejected {} from \'{}\' chain.'.format(error, bc.key))
+
+                    # stop here; the next resync will pick up from the last good block
+                    bc.remote_diff = 0
+                elif not more and self.announced.get(bc.key, -1) > obj['cursor'] and self.is_connected:
+                    # more blocks were announced while this page was on its way
+                    self._fetchremoteblocks(bc, after=obj['cursor'])
+                elif not more:
+                    bc.remote_diff = 0
+                    self.handlers['onstatus']('Local and remote are now in sync ({}).'.format(self.ingest.summary()))
+
+            # blocks while the pipeline is full, so we stop reading until it catches up
+            self.ingest.submit(bc, obj['blocks'], onvalidated, ondone)
+            #self.handlers['onstatus']('Syncing clients...')
 
-            for block in obj['blocks']:
-                assert isinstance(block, dict), "block should be of type `dict`"
+    # sync up to the node's latest block `remote_blockid`, once we know our
+    # chain is a prefix of the node's
+    def _syncto(self, bc, remote_blockid):
+        bc.remote_diff = remote_blockid - (bc.latestblock().blockid if len(bc.blocks) != 0 else 0)
 
-                if prevblockid is not None:
-                    assert block['parent'] == prevblockid, "block['parent'] should be equal to previous block id ({})".format(prevblockid)
-    
-                prevblockid = block['blockid']
+        if bc.remote_diff != 0:
+            if bc.remote_diff > 0:
+                self.handlers['onstatus']('Local out of date with remote by {} blocks.'.format(bc.remote_diff))
 
-            for block in obj['blocks']:
-                blk = None
+                if bc.remote_diff > PARALLEL_SYNC_THRESHOLD and len(self._syncpeers()) > 1:
+                    self._syncranges(bc, remote_blockid)
+                else:
+                    self._fetchremoteblocks(bc)
+            else:
+                self.handlers['onstatus']('Local ahead of remote by {} blocks.'.format(-1 * bc.remote_diff))
+                #todo
+
+    # before syncing, make sure both chains agree on the last block they both
+    # have, and if they don't, search for where they forked
+    def _checkfork(self, bc, remote_blockid, remote_hash):
+        local_blockid = bc.latestblock().blockid
+
+        if remote_blockid > local_blockid:
+            search = ForkSearch(bc, len(bc.blocks) - 1, remote_blockid)
+        else:
+            upto = bc.positionafter(remote_blockid) - 1
 
-                if obj['bc'] == 'tx':
-                    blk = Transaction.deserialize_obj(block)
-                elif obj['bc'] == 'blk':
-                    blk = Block.deserialize_obj(block)
-                elif obj['bc'].endswith('_cnf'):
-                    blk = Confirmation.deserialize_obj(block)
+            if upto < 0 or bc.blockids[upto] != remote_blockid:
+                # no block to compare with
+                self._syncto(bc, remote_blockid)
+                return
 
-                self._onnewremoteblock(bc, blk)
+            # we have the node's latest block (usually as our own tip), so
+            # compare without asking, and only search on a mismatch
+            if bc.hashat(upto).encode('hex') == remote_hash:
+                self.forks.pop(bc.key, None)
+                self._syncto(bc, remote_blockid)
+                return
 
-            bc.remote_diff = 0
-            self.handlers['onstatus']('Local and remote are now in sync.')
-            #self.handlers['onstatus']('Syncing clients...')
+            search = ForkSearch(bc, upto, remote_blockid)
+            search.update([remote_blockid], [[remote_blockid, remote_hash]])
+
+        if search.done():
+            self._onforksearched(search)
+        else:
+            self.forksearches[bc.key] = search
+            self._requestheaders(search)
+
+    def _requestheaders(self, search):
+        def onfailure(error):
+            # give up on the search; the next resync starts a new one
+            if self.forksearches.get(search.bc.key) is search:
+                del self.forksearches[search.bc.key]
+
+        self._request({
+            'type': 'headers',
+            'bc': search.bc.key,
+            'blockids': search.probes()
+        }, onfailure=onfailure)
+
+    def _onforksearched(self, search):
+        bc = search.bc
+
+        if search.agrees():
+            self.forks.pop(bc.key, None)
+            self._syncto(bc, search.remote_tip)
+            return
+
+        fork = (search.forkpoint(), search.remote_tip)
+
+        if self.forks.get(bc.key) == fork:
+            # already reported
+            return
+
+        self.forks[bc.key] = fork
+
+        self.handlers['onerror']("'{}' chain has forked from the node's after block #{} (found in {} round trips). Local tip is #{}, remote tip is #{}.".format(
+            bc.key, fork[0], search.rounds, bc.latestblock().blockid, search.remote_tip))
+
+        if 'onfork' in self.handlers:
+            self._fetchfork(bc, fork[0], search.remote_tip)
+
+    # fetch only the node's blocks after the fork point, and hand them to
+    # handlers['onfork'] to resolve the fork
+    def _fetchfork(self, bc, forkpoint, remote_tip):
+        after = forkpoint if forkpoint is not None else -1
+        items = []
+
+        def onchunk(blocks):
+            items.extend(blocks)
+            return True
+
+        def ondone(synced, complete):
+            blocks, errors = decodebatch(bc.key, items, forkpoint)
+
+            for error in errors:
+                self.handlers['onerror']('Rejected {} from the node\'s fork of \'{}\' chain.'.format(error, bc.key))
+
+            self.handlers['onfork'](bc.key, forkpoint, blocks)
+
+        if remote_tip > after:
+            RangeSync(bc, [self.server_address], after, remote_tip, onchunk, ondone, max_frame_size=self.max_frame_size).start()
+
+    # decode and validate a run of blocks (json objects, or blocks already
+    # decoded from a binary message) that should directly follow our latest
+    # block, and append the ones before the first bad block. binary blocks
+    # never go through the deserialize_obj() asserts, so this is the only
+    # check they get. returns a BlockError for every block that was rejected.
+    def _applyblocks(self, bc, blocks):
+        blks, errors = decodebatch(bc.key, blocks, bc.latestblock().blockid if len(bc.blocks) != 0 else None)
+
+        for blk in blks:
+            self._onnewremoteblock(bc, blk)
+
+        return errors
 
     def _onnewremoteblock(self, bc, blk):
         assert blk is not None
 
         # write block
         blk.savelocal(bc)
-        bc.blocks.append(blk)
+        bc.append(blk)
 
     def _confirmblock(self, bc, blk):
         self.handlers['onstatus']('Confirming block #{} for {} chain...'.format(blk.blockid, bc.key))
 
-        # TODO move this to a more efficient way of calculating balance.
-        total_balance, unconfirmed_balance = self._calcbalance(blk.data['sender'])
+        txs = transfers(blk.data)
+
+        # every transfer has to move a positive amount, or a negative one could
+        # offset (and so mint) what its sender sends elsewhere in the block
+        valid = all(isinstance(amt, (int, long)) and amt > 0 for sender, receiver, amt in txs)
 
-        value = blk.data['amt']
-        assert isinstance(value, int), "block amt should be int"
+        # every sender has to be able to cover all it sends in the block
+        sent = {}
+
+        if valid:
+            for sender, receiver, amt in txs:
+                sent[sender] = sent.get(sender, 0) + amt
+
+        covered = valid and all(self._calcbalance(sender)[0] >= amt for sender, amt in sent.iteritems())
 
         last_cnf = self.tx_cnf_chain.latestblock() if len(self.tx_cnf_chain.blocks) > 0 else None
         last_cnf_id = last_cnf.blockid if last_cnf is not None else -1
 
-        if total_balance >= blk.data['amt']:
+        if covered:
             cnf_blk = Confirmation(last_cnf_id + 1, datetime.datetime.now(), blk.blockid, 'TEST', 'SUCCESS', last_cnf_id)
             self.handlers['onstatus']('Confirming block #{} confirmed for {} chain'.format(blk.blockid, bc.key))
         else:
             cnf_blk = Confirmation(last_cnf_id + 1, datetime.datetime.now(), blk.blockid, 'TEST', 'FAILURE', last_cnf_id)
             self.handlers['onstatus']('Confirming block #{} confirmation marked FAILED for {} chain'.format(blk.blockid, bc.key))
 
-        self.tx_cnf_chain.blocks.append(cnf_blk)
         cnf_blk.savelocal(self.tx_cnf_chain)
+        self.tx_cnf_chain.append(cnf_blk)
 
 
     def _calcbalance(self, acct):
-        # TODO verify ONLY confirmed txs
-        total_balance = 0
-        unconfirmed_balance = 0
+        return self.balances.lookup(acct)
+
+    # the reader and heartbeat of a connection stop once it's replaced by another
+    def _current(self, sock):
+        return self.is_connected and self.socket is sock
+
+    def listen_for_server_messages(self):
+        sock = self.socket
+        thread.start_new_thread(self.heartbeat, (self.server_address, sock))
 
-        txs = filter(lambda x: (x.data['sender'] == acct or x.data['receiver'] == acct), self.tx_chain.blocks)
-        for blk in txs:
-            blk_confirmations = filter(lambda x: x.data['linkedblock'] == blk.blockid and x.data['result'] == 'SUCCESS', self.tx_cnf_chain.blocks)
+        reader = FrameReader(self.max_frame_size)
 
-            block_bal = 0
+        while 1:
+            if not self._current(sock):
+                break
 
-            if blk.data['receiver'] == acct:
-                block_bal += blk.data['amt']
+            try:
+                frames = reader.recv(sock)
 
-            elif blk.data['sender'] == acct:
-                block_bal -= blk.data['amt']
+                if frames is None:
+                    break
 
-            if len(blk_confirmations) >= 6 or blk.isgenesis():
-                total_balance += block_bal
+                for frame in frames:
+                    self._handlemessage(frame)
 
-            unconfirmed_balance += block_bal
+            except Exception as e:
+                print("Error while listening for server messages: {}".format(e))
+                break
 
-        return (total_balance, unconfirmed_balance)
+        if self._current(sock):
+            self.peers.recordfailure(self.server_address)
+            self.disconnect()
+        elif self.socket is not sock:
+            # a new connection was made meanwhile, and its reader takes over
+            return
 
-    def listen_for_server_messages(self):
-        thread.start_new_thread(self.heartbeat, ())
+        address, self.failover_to = self.failover_to, None
 
-        while 1:
-            if not self.is_connected:
-                return
+        # hold off other reconnects (e.g. the node's) until the failover's done
+        failover = address is not None and self._reserveconnect()
 
-            try:
-                data = self.socket.recv(1024)
+        self.handlers['ondisconnect']()
 
-                if not data:
-                    break
+        if failover:
+            time.sleep(FAILOVER_DELAY)
+            self._connect(*address)
 
-                obj = None
+    def _handlemessage(self, frame):
+        started = time.time()
+        msg_type = None
 
-                try:
-                    obj = json.loads(data)
-                except:
-                    raise InvalidMessage(data)
+        self.metrics.counter('bytes_in').inc(FRAME_HEADER.size + len(frame))
 
+        try:
+            obj = decodemessage(frame, self.max_frame_size)
+            msg_type = obj.get('type') if isinstance(obj, dict) else None
+
+            if not isinstance(obj, dict):
+                raise InvalidMessage(obj)
+
+            request = self.requests.match(obj)
+
+            if request is not None:
+                self.metrics.histogram('request.{}'.format(request.type)).observe(started - request.sent)
+
+                if msg_type == 'error':
+                    request.fail(obj.get('error'))
+                else:
+                    request.succeed(obj)
+            elif obj.get('id') is not None:
+                # the request already timed out, and whatever was waiting on it moved on
+                self.metrics.counter('late_replies').inc()
+            else:
                 self.respond_to_message(obj)
+        except InvalidMessage as e:
+            self.metrics.counter('invalid_messages').inc()
+            self.handlers['onstatus'](str(e))
 
-            except InvalidMessage as e:
-                self.handlers['onstatus'](str(e))
-                continue
+        self.metrics.histogram('handle.{}'.format(msg_type if msg_type in MESSAGE_TYPES else 'unknown')).observe(time.time() - started)
 
-            except Exception as e:
-                print("Error while listening for server messages: {}".format(e))
-                break
+    # ping the node every second, which also measures its round trip time.
+    # if it stops answering, or another peer turns out to be much faster, the
+    # connection is dropped for the best peer in the table.
+    def heartbeat(self, address, sock):
+        while self._current(sock):
+            self._ping(address)
 
-        if self.is_connected:
-            self.disconnect()
+            self.metrics.counter('request_timeouts').inc(len(self.requests.expire()))
 
-        self.handlers['ondisconnect']()
+            other = self.peers.better(address)
 
-    def heartbeat(self):
-        while self.is_connected:
-            self.socket.send(json.dumps({
-                'type': 'ping'
-            }))
+            if other is not None and self._current(sock):
+                self.handlers['onstatus']('Node {}:{} is degraded, failing over to {}:{}...'.format(address[0], address[1], other[0], other[1]))
+                self.metrics.counter('failovers').inc()
+                self.failover_to = other
+                self.disconnect()
+                return
 
             time.sleep(1)
 
+    def _ping(self, address):
+        sent = time.time()
+
+        def onreply(reply):
+            self.peers.recordrtt(address, time.time() - sent)
+
+        def onfailure(error):
+            # pings failed by disconnecting aren't the node's fault
+            if self.is_connected:
+                self.peers.recordfailure(address)
+
+        try:
+            self._request({
+                'type': 'ping'
+            }, onreply, onfailure, PING_TIMEOUT)
+        except socket.error:
+            # the socket reader notices the broken connection
+            pass
+
+    # every chain's sync state is checked at once; their requests are tagged,
+    # so the chains sync concurrently over the one connection.
     def periodically_resync_with_peers(self):
         while self.is_connected:
             for bc, bcname in [(self.blk_chain, 'model'), (self.blk_cnf_chain, 'model_confirmations'), (self.tx_chain, 'transaction'), (self.tx_cnf_chain, 'transaction_confirmations')]:                
                 if not self.is_connected:
                     return
 
-                if bc.remote_diff == 0:
+                if bc.remote_diff == 0 and self.requests.outstanding(key=bc.key) == 0:
                     self.handlers['onstatus']("Checking sync state for '{}' blockchain...".format(bcname))
 
                     if bc.local_blocks_loaded:
@@ -279,29 +666,148 @@ class Client:
                 else:
                    self.handlers['onstatus']("Awaiting local blocks for '{}' blockchain...".format(bcname))
 
-                if not self.is_connected:
-                    return
+            if not self.is_connected:
+                return
 
-                time.sleep(5)
+            self._waitforresync()
+
+    def _waitforresync(self):
+        started = time.time()
+
+        # check every second, as the subscription may be answered meanwhile
+        while self.is_connected and time.time() - started < (SUBSCRIBED_RESYNC_INTERVAL if self.subscribed else RESYNC_INTERVAL):
+            time.sleep(1)
 
     # request the latest transaction from the connected node
     # this is done periodically to make sure we are in sync
     def request_latest_block(self, blockchain):
         assert self.is_connected
 
-        self.socket.send(json.dumps({
+        return self._request({
             'type': 'latestblock',
             'bc': blockchain.key
-        }))
+        })
+
+    # send a request, tagged with an id the node echoes in its reply. the
+    # reply goes to onreply (respond_to_message by default), and onfailure is
+    # called instead if the request times out, the node rejects it or the
+    # connection is lost. returns the Request, to wait on from other threads.
+    def _request(self, obj, onreply=None, onfailure=None, timeout=None):
+        request = self.requests.add(obj, REPLY_TYPES.get(obj['type'], obj['type']), onreply or self.respond_to_message, onfailure, timeout)
+        obj['id'] = request.id
+
+        self._send(obj)
+
+        return request
+
+    # messages are sent from several threads, so whole frames are sent under a
+    # lock to keep them from interleaving on the socket.
+    def _send(self, obj):
+        payload = json.dumps(obj)
+
+        with self.sendlock:
+            sendframe(self.socket, payload)
+
+        self.metrics.counter('bytes_out').inc(FRAME_HEADER.size + len(payload))
+
+    # ask the node for an account's balance, answered through handlers['onbalance']
+    # (or `onreply`, with the reply message)
+    def request_balance(self, acct, onreply=None):
+        return self._request({
+            'type': 'balance',
+            'acct': acct
+        }, onreply)
+
+    # ask the node for a page of an account's txs older than blockid `before`
+    # (the latest ones if None), answered through handlers['onaccounthistory']
+    # (or `onreply`, with the reply message)
+    def request_account_history(self, acct, before=None, limit=None, onreply=None):
+        return self._request({
+            'type': 'accounthistory',
+            'acct': acct,
+            'before': before,
+            'limit': limit
+        }, onreply)
+
+    # hand a tx to the node's mempool, answered through handlers['onsubmittedtx']
+    # (or `onreply`, with the reply message). resubmitting it with the same
+    # nonce won't add it twice. a tx the node accepts may still be turned away
+    # later, which handlers['onsubmittedtx'] hears about with its txid.
+    def submit_transaction(self, sender, receiver, amt, nonce=None, onreply=None, onfailure=None):
+        return self._request({
+            'type': 'submittx',
+            'sender': sender,
+            'receiver': receiver,
+            'amt': amt,
+            'nonce': nonce
+        }, onreply, onfailure)
+
+    # register fn(msgid, msg) to be called for every message the node relays
+    def addbroadcastlistener(self, fn):
+        self.broadcastlisteners.append(fn)
+
+    # have the node relay a message to all its other clients
+    def broadcast(self, msg, msgid=None):
+        self._send({
+            'type': 'broadcast',
+            'msgid': msgid or messageid(msg),
+            'msg': msg
+        })
 
     def _updatepeers(self, peerlist):
-        self.peers = peerlist
+        for peer in peerlist:
+            try:
+                self.peers.add(parseaddress(peer))
+            except (TypeError, ValueError):
+                continue
 
-    # fetch $(blockchain.remote_diff) blocks from the node
-    def _fetchremoteblocks(self, blockchain):
-        self.socket.send(json.dumps({
+    # addresses of the connected node and the healthy peers, best first, to sync from
+    def _syncpeers(self):
+        return [self.server_address] + self.peers.best(exclude=(self.server_address,))
+
+    # fetch the blocks up to `tip` from several peers at once
+    def _syncranges(self, bc, tip):
+        after = bc.latestblock().blockid if len(bc.blocks) != 0 else -1
+        peers = self._syncpeers()
+
+        self.handlers['onstatus']("Syncing {} blocks of '{}' chain from {} peers...".format(tip - after, bc.key, min(len(peers), SYNC_MAX_PEERS)))
+
+        def ondone(synced, complete):
+            if complete:
+                bc.remote_diff = 0
+                self.handlers['onstatus']('Local and remote are now in sync.')
+            elif self.is_connected:
+                self.handlers['onstatus']("Parallel sync of '{}' chain stopped after block {}, continuing from the connected node.".format(bc.key, synced))
+                self._fetchremoteblocks(bc)
+            else:
+                bc.remote_diff = 0
+
+        RangeSync(bc, peers, after, tip, lambda blocks: len(self._applyblocks(bc, blocks)) == 0, ondone, max_frame_size=self.max_frame_size, peertable=self.peers).start()
+
+    # fetch the next page of at most `limit` blocks (or `maxbytes` bytes) after
+    # `after` (by default our latest block) from the node, repeated until we
+    # have caught up with $(blockchain.remote_diff)
+    def _fetchremoteblocks(self, blockchain, limit=None, maxbytes=None, after=None):
+        if after is None:
+            after = blockchain.latestblock().blockid if len(blockchain.blocks) != 0 else -1
+
+        address = self.server_address
+        sent = time.time()
+
+        def onreply(reply):
+            self.peers.recordsync(address, len(reply.get('blocks') or []), time.time() - sent)
+            self.respond_to_message(reply)
+
+        def onfailure(error):
+            # stop here; the next resync will pick up from the last good block
+            blockchain.remote_diff = 0
+            self.handlers['onstatus']("Stopped syncing '{}' chain after block {}: {}".format(blockchain.key, after, error))
+
+        self._request({
             'type': 'fetchblocks',
-            'blockidgt': blockchain.latestblock().blockid if len(blockchain.blocks) != 0 else -1,
+            'blockidgt': after,
+            'limit': limit,
+            'maxbytes': maxbytes,
             'bc': blockchain.key
-        }))
+        }, onreply, onfailure)
 
@@ -0,0 +1,275 @@
+import struct
+import json
+import hashlib
+import calendar
+import datetime
+
+from block import *
+
+# codecs a node can speak for blocks, in order of preference. 'json' is the
+# original encoding and always works as a fallback.
+CODECS = ('binary', 'json')
+
+# the compact binary encoding of a block is a fixed header followed by a body
+# depending on its kind. kinds never collide with '{', so stored json blocks
+# and binary ones can be told apart by their first byte.
+KIND_BLOCK = 1
+KIND_TX = 2
+KIND_CNF = 3
+KIND_TXS = 4 # several transactions in one block
+
+BLOCK_HEADER = struct.Struct('>Bqqq') # kind, blockid, parent, timestamp (epoch seconds)
+STR_LEN = struct.Struct('>H')
+DATA_LEN = struct.Struct('>I')
+TX_AMT = struct.Struct('>q')
+CNF_BODY = struct.Struct('>qB') # linkedblock, result
+COUNT = struct.Struct('>I')
+
+NO_PARENT = -(2 ** 63)
+CNF_RESULTS = ['FAILURE', 'SUCCESS']
+
+# blocks are hash linked: a block's hash covers its binary encoding and its
+# parent's hash, so equal hashes mean equal chains up to and including it.
+HASH_SIZE = 32
+NO_HASH = '\x00' * HASH_SIZE # parent hash of the genesis block
+
+class CodecError(ValueError):
+    pass
+
+def _istx(data):
+    return len(data) == 3 and isinstance(data.get('sender'), basestring) and isinstance(data.get('receiver'), basestring) and isinstance(data.get('amt'), (int, long))
+
+def _istxs(data):
+    return len(data) == 1 and isinstance(data.get('txs'), list) and len(data['txs']) != 0 and all(isinstance(tx, dict) and _istx(tx) for tx in data['txs'])
+
+def _iscnf(data):
+    return len(data) == 3 and isinstance(data.get('linkedblock'), (int, long)) and isinstance(data.get('validator'), basestring) and data.get('result') in CNF_RESULTS
+
+def _packstr(s):
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+
+    return STR_LEN.pack(len(s)) + s
+
+def _unpackstr(buf, offset):
+    n = STR_LEN.unpack_from(buf, offset)[0]
+    offset += STR_LEN.size
+
+    if offset + n > len(buf):
+        raise CodecError('string runs past the end of the buffer')
+
+    return buf[offset:offset + n].decode('utf-8'), offset + n
+
+def encodeblock(blk):
+    data = blk.data
+    parent = NO_PARENT if blk.parent is None else blk.parent
+    timestamp = calendar.timegm(blk.timestamp.timetuple())
+
+    if isinstance(data, dict) and _istx(data):
+        return BLOCK_HEADER.pack(KIND_TX, blk.blockid, parent, timestamp) + _packstr(data['sender']) + _packstr(data['receiver']) + TX_AMT.pack(data['amt'])
+    elif isinstance(data, dict) and _istxs(data):
+        return BLOCK_HEADER.pack(KIND_TXS, blk.blockid, parent, timestamp) + COUNT.pack(len(data['txs'])) + ''.join(_packstr(tx['sender']) + _packstr(tx['receiver']) + TX_AMT.pack(tx['amt']) for tx in data['txs'])
+    elif isinstance(data, dict) and _iscnf(data):
+        return BLOCK_HEADER.pack(KIND_CNF, blk.blockid, parent, timestamp) + CNF_BODY.pack(data['linkedblock'], CNF_RESULTS.index(data['result'])) + _packstr(data['validator'])
+    else:
+        # sorted, so the encoding (and so the hash) doesn't depend on dict order
+        body = json.dumps(data, sort_keys=True)
+        return BLOCK_HEADER.pack(KIND_BLOCK, blk.blockid, parent, timestamp) + DATA_LEN.pack(len(body)) + body
+
+def blockhash(encoded, parenthash):
+    return hashlib.sha256(parenthash + encoded).digest()
+
+# decode the block at `offset` in `buf`, returning it with the offset just past it.
+def decodeblock(buf, offset=0):
+    try:
+        kind, blockid, parent, timestamp = BLOCK_HEADER.unpack_from(buf, offset)
+        offset += BLOCK_HEADER.size
+
+        parent = None if parent == NO_PARENT else parent
+        timestamp = datetime.datetime.utcfromtimestamp(timestamp)
+
+        if kind == KIND_TX:
+            sender, offset = _unpackstr(buf, offset)
+            receiver, offset = _unpackstr(buf, offset)
+            amt = TX_AMT.unpack_from(buf, offset)[0]
+            offset += TX_AMT.size
+
+            return Transaction(blockid=blockid, timestamp=timestamp, senderid=sender, receiverid=receiver, amt=amt, parent=parent), offset
+        elif kind == KIND_TXS:
+            count = COUNT.unpack_from(buf, offset)[0]
+            offset += COUNT.size
+            txs = []
+
+            for i in xrange(count):
+                sender, offset = _unpackstr(buf, offset)
+                receiver, offset = _unpackstr(buf, offset)
+                txs.append((sender, receiver, TX_AMT.unpack_from(buf, offset)[0]))
+                offset += TX_AMT.size
+
+            return TransactionBatch(blockid=blockid, timestamp=timestamp, txs=txs, parent=parent), offset
+        elif kind == KIND_CNF:
+            linkedblock, result = CNF_BODY.unpack_from(buf, offset)
+            offset += CNF_BODY.size
+            validator, offset = _unpackstr(buf, offset)
+
+            return Confirmation(blockid=blockid, timestamp=timestamp, linkedblockid=linkedblock, validatorid=validator, result=CNF_RESULTS[result], parent=parent), offset
+        elif kind == KIND_BLOCK:
+            n = DATA_LEN.unpack_from(buf, offset)[0]
+            offset += DATA_LEN.size
+
+            if offset + n > len(buf):
+                raise CodecError('block data runs past the end of the buffer')
+
+            return Block(blockid=blockid, timestamp=timestamp, data=json.loads(buf[offset:offset + n]), parent=parent), offset + n
+        else:
+            raise CodecError('unknown block kind {}'.format(kind))
+
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise CodecError(str(e))
+
+def encodeblocks(encoded):
+    return COUNT.pack(len(encoded)) + ''.join(encoded)
+
+def decodeblocks(buf, offset=0):
+    try:
+        count = COUNT.unpack_from(buf, offset)[0]
+    except struct.error as e:
+        raise CodecError(str(e))
+
+    offset += COUNT.size
+    blocks = []
+
+    for i in xrange(count):
+        blk, offset = decodeblock(buf, offset)
+        blocks.append(blk)
+
+    return blocks
+
+# encoding of blocks written to a BlockLog
+def encodestored(blk, codec):
+    return encodeblock(blk) if codec == 'binary' else blk.serialize_json()
+
+def decodestored(payload):
+    if payload[:1] == '{':
+        return Block.deserialize_json(payload)
+
+    blk, offset = decodeblock(payload)
+
+    if offset != len(payload):
+        raise CodecError('trailing data after block')
+
+    return blk
+
+# a block in a batch that failed to decode or validate
+class BlockError:
+    def __init__(self, index, blockid, reason):
+        self.index = index
+        self.blockid = blockid
+        self.reason = reason
+
+    def __str__(self):
+        return 'block #{} (item {} in batch): {}'.format(self.blockid, self.index, self.reason)
+
+def _check(cond, reason):
+    if not cond:
+        raise CodecError(reason)
+
+def _decodeheader(obj):
+    _check(isinstance(obj, dict), 'block should be of type `dict`')
+    _check(isinstance(obj.get('blockid'), (int, long)), 'blockid should be int')
+    _check(isinstance(obj.get('timestamp'), basestring), 'timestamp should be str')
+    _check(isinstance(obj.get('data'), dict), 'data should be of type `dict`')
+
+    return obj['blockid'], parsetimestamp(obj['timestamp']), obj['data'], obj.get('parent')
+
+def _checktx(data):
+    _check(isinstance(data.get('sender'), basestring), 'sender should be str')
+    _check(isinstance(data.get('receiver'), basestring), 'receiver should be str')
+    _check(isinstance(data.get('amt'), (int, long)), 'amt should be int')
+    _check(data['amt'] > 0, 'amt should be greater than zero')
+
+def _checktxdata(data):
+    if 'txs' in data:
+        _check(isinstance(data['txs'], list) and len(data['txs']) != 0, 'txs should be a non-empty list')
+
+        for tx in data['txs']:
+            _check(isinstance(tx, dict), 'txs should hold objects')
+            _checktx(tx)
+    else:
+        _checktx(data)
+
+def _checkcnfdata(data):
+    _check(isinstance(data.get('validator'), basestring), 'validator should be str')
+    _check(isinstance(data.get('linkedblock'), (int, long)), 'linkedblock should be int')
+    _check(data.get('result') in CNF_RESULTS, "result should be 'SUCCESS' or 'FAILURE'")
+
+def _decodetx(obj):
+    blockid, timestamp, data, parent = _decodeheader(obj)
+
+    _checktxdata(data)
+
+    if 'txs' in data:
+        return TransactionBatch(blockid=blockid, timestamp=timestamp, txs=transfers(data), parent=parent)
+
+    return Transaction(blockid=blockid, timestamp=timestamp, senderid=data['sender'], receiverid=data['receiver'], amt=data['amt'], parent=parent)
+
+def _decodecnf(obj):
+    blockid, timestamp, data, parent = _decodeheader(obj)
+
+    _checkcnfdata(data)
+
+    return Confirmation(blockid=blockid, timestamp=timestamp, linkedblockid=data['linkedblock'], validatorid=data['validator'], result=data['result'], parent=parent)
+
+def _decodeblock(obj):
+    blockid, timestamp, data, parent = _decodeheader(obj)
+
+    return Block(blockid=blockid, timestamp=timestamp, data=data, parent=parent)
+
+# a block already decoded from a binary message skips the json checks, so its
+# kind and data are checked against the chain here instead
+def _checkdecoded(key, blk):
+    if key == 'tx':
+        _check(isinstance(blk, Transaction), 'block should be a transaction')
+        _checktxdata(blk.data)
+    elif key.endswith('_cnf'):
+        _check(isinstance(blk, Confirmation), 'block should be a confirmation')
+        _checkcnfdata(blk.data)
+    else:
+        _check(isinstance(blk.data, dict), 'data should be of type `dict`')
+
+    return blk
+
+# decode and validate a batch of blocks for chain `key` in a single pass. items
+# are json objects, or blocks already decoded from a binary message. each block
+# must link to the one before it, the first to `prevblockid` (unless None).
+#
+# returns (blocks, errors): the blocks before the first bad one, and a
+# BlockError for every block that failed.
+def decodebatch(key, items, prevblockid):
+    if key == 'tx':
+        decode = _decodetx
+    elif key.endswith('_cnf'):
+        decode = _decodecnf
+    else:
+        decode = _decodeblock
+
+    blocks = []
+    errors = []
+
+    for i, item in enumerate(items):
+        blockid = item.blockid if isinstance(item, Block) else item.get('blockid') if isinstance(item, dict) else None
+
+        try:
+            blk = _checkdecoded(key, item) if isinstance(item, Block) else decode(item)
+        except (CodecError, ValueError) as e:
+            errors.append(BlockError(i, blockid, str(e)))
+            continue
+
+        if prevblockid is not None and blk.parent != prevblockid:
+            errors.append(BlockError(i, blockid, 'parent should be equal to previous block id ({})'.format(prevblockid)))
+        elif len(errors) == 0:
+            blocks.append(blk)
+
+        prevblockid = blk.blockid
+
+    return blocks, errors
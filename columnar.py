@@ -0,0 +1,206 @@
+import datetime
+import calendar
+from array import array
+
+from block import *
+from codec import NO_PARENT, CNF_RESULTS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# list-like storage for a chain's blocks that keeps each field in a typed
+# array instead of one python object per block. strings are interned into
+# small integer ids. blocks are materialized when indexed or iterated, and
+# aggregations run over the columns directly (with numpy, if it's installed).
+#
+# blocks whose data doesn't fit the columns are kept as objects in
+# self.overflow, with zeroed columns that don't count towards aggregations.
+class ColumnarBlocks(object):
+    def __init__(self):
+        self.blockid = array('l')
+        self.parent = array('l')
+        self.timestamp = array('l')
+        self.overflow = {} # position -> block
+        self.strings = [None] # id -> string, id 0 is reserved for overflow blocks
+        self.stringids = {}
+
+    def __len__(self):
+        return len(self.blockid)
+
+    def __iter__(self):
+        for i in xrange(len(self.blockid)):
+            yield self._materialize(i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._materialize(j) for j in xrange(*i.indices(len(self.blockid)))]
+
+        if i < 0:
+            i += len(self.blockid)
+
+        if i < 0 or i >= len(self.blockid):
+            raise IndexError('block index out of range')
+
+        return self._materialize(i)
+
+    def append(self, blk):
+        self.blockid.append(blk.blockid)
+        self.parent.append(NO_PARENT if blk.parent is None else blk.parent)
+        self.timestamp.append(calendar.timegm(blk.timestamp.timetuple()))
+
+        if isinstance(blk.data, dict) and self._fits(blk.data):
+            self._appenddata(blk.data)
+        else:
+            self.overflow[len(self.blockid) - 1] = blk
+            self._appenddata(None)
+
+    def intern(self, s):
+        sid = self.stringids.get(s)
+
+        if sid is None:
+            sid = self.stringids[s] = len(self.strings)
+            self.strings.append(s)
+
+        return sid
+
+    def _materialize(self, i):
+        if i in self.overflow:
+            return self.overflow[i]
+
+        parent = self.parent[i]
+
+        return self._makeblock(i, self.blockid[i], datetime.datetime.utcfromtimestamp(self.timestamp[i]), None if parent == NO_PARENT else parent)
+
+    def _column(self, arr):
+        return numpy.frombuffer(arr, dtype=arr.typecode)
+
+class TxBlocks(ColumnarBlocks):
+    def __init__(self):
+        ColumnarBlocks.__init__(self)
+        self.sender = array('l')
+        self.receiver = array('l')
+        self.amt = array('l')
+
+    def _fits(self, data):
+        return len(data) == 3 and isinstance(data.get('sender'), basestring) and isinstance(data.get('receiver'), basestring) and isinstance(data.get('amt'), (int, long))
+
+    def _appenddata(self, data):
+        if data is None:
+            self.sender.append(0)
+            self.receiver.append(0)
+            self.amt.append(0)
+        else:
+            self.sender.append(self.intern(data['sender']))
+            self.receiver.append(self.intern(data['receiver']))
+            self.amt.append(data['amt'])
+
+    def _makeblock(self, i, blockid, timestamp, parent):
+        return Transaction(blockid=blockid, timestamp=timestamp, senderid=self.strings[self.sender[i]], receiverid=self.strings[self.receiver[i]], amt=self.amt[i], parent=parent)
+
+    # net balance of every account over the blocks where mask is true (all
+    # blocks if mask is None), following the same rules as BalanceIndex.
+    def netbalances(self, mask=None):
+        n = len(self.blockid)
+
+        if numpy is not None:
+            sender = self._column(self.sender)
+            receiver = self._column(self.receiver)
+            amt = self._column(self.amt)
+
+            if mask is not None:
+                mask = numpy.asarray(mask, dtype=bool)
+                sender, receiver, amt = sender[mask], receiver[mask], amt[mask]
+
+            # summed as int64; bincount() sums its weights as float64, which
+            # can't hold balances past 2 ** 53 exactly
+            amt = amt.astype(numpy.int64)
+            received = numpy.zeros(len(self.strings), dtype=numpy.int64)
+            sent = numpy.zeros(len(self.strings), dtype=numpy.int64)
+            numpy.add.at(received, receiver, amt)
+            numpy.add.at(sent, sender, amt * (sender != receiver))
+            seen = numpy.union1d(sender, receiver)
+
+            balances = dict((self.strings[sid], int(received[sid] - sent[sid])) for sid in seen if sid != 0)
+        else:
+            balances = {}
+
+            for i in xrange(n):
+                if (mask is not None and not mask[i]) or i in self.overflow:
+                    continue
+
+                self._transfer(balances, self.strings[self.sender[i]], self.strings[self.receiver[i]], self.amt[i])
+
+        # blocks of several transactions don't fit the columns
+        for i, blk in self.overflow.iteritems():
+            if (mask is None or mask[i]) and isinstance(blk.data, dict) and 'txs' in blk.data:
+                for sender, receiver, amt in transfers(blk.data):
+                    self._transfer(balances, sender, receiver, amt)
+
+        return balances
+
+    def _transfer(self, balances, sender, receiver, amt):
+        balances.setdefault(sender, 0)
+        balances[receiver] = balances.get(receiver, 0) + amt
+
+        if sender != receiver:
+            balances[sender] -= amt
+
+class CnfBlocks(ColumnarBlocks):
+    def __init__(self):
+        ColumnarBlocks.__init__(self)
+        self.linkedblock = array('l')
+        self.validator = array('l')
+        self.result = array('b') # index into CNF_RESULTS, -1 for overflow blocks
+
+    def _fits(self, data):
+        return len(data) == 3 and isinstance(data.get('linkedblock'), (int, long)) and isinstance(data.get('validator'), basestring) and data.get('result') in CNF_RESULTS
+
+    def _appenddata(self, data):
+        if data is None:
+            self.linkedblock.append(0)
+            self.validator.append(0)
+            self.result.append(-1)
+        else:
+            self.linkedblock.append(data['linkedblock'])
+            self.validator.append(self.intern(data['validator']))
+            self.result.append(CNF_RESULTS.index(data['result']))
+
+    def _makeblock(self, i, blockid, timestamp, parent):
+        return Confirmation(blockid=blockid, timestamp=timestamp, linkedblockid=self.linkedblock[i], validatorid=self.strings[self.validator[i]], result=CNF_RESULTS[self.result[i]], parent=parent)
+
+    # linked blockid -> (successes, failures, set of validators)
+    def tallies(self):
+        tallies = {}
+
+        if numpy is not None and len(self.blockid) != 0:
+            linkedblock = self._column(self.linkedblock)
+            result = self._column(self.result)
+
+            linked, inverse = numpy.unique(linkedblock[result >= 0], return_inverse=True)
+            valid = result[result >= 0]
+            successes = numpy.bincount(inverse, weights=(valid == 1), minlength=len(linked))
+            failures = numpy.bincount(inverse, weights=(valid == 0), minlength=len(linked))
+
+            for j in xrange(len(linked)):
+                tallies[int(linked[j])] = (int(successes[j]), int(failures[j]), set())
+        else:
+            for i in xrange(len(self.blockid)):
+                if self.result[i] < 0:
+                    continue
+
+                successes, failures, validators = tallies.get(self.linkedblock[i], (0, 0, None))
+
+                if self.result[i] == 1:
+                    successes += 1
+                else:
+                    failures += 1
+
+                tallies[self.linkedblock[i]] = (successes, failures, validators or set())
+
+        for i in xrange(len(self.blockid)):
+            if self.result[i] >= 0:
+                tallies[self.linkedblock[i]][2].add(self.strings[self.validator[i]])
+
+        return tallies
@@ -0,0 +1,90 @@
+import zlib
+
+# compression a node can apply to large messages, in order of preference.
+# it's negotiated per connection in 'hello', and nodes that don't offer any
+# get every message uncompressed.
+COMPRESSIONS = ('zlib-dict', 'zlib')
+
+COMPRESS_THRESHOLD = 1024 # messages shorter than this are sent as is (pings, tips, ...)
+COMPRESS_LEVEL = 6
+
+# compressed messages start with a marker byte naming the method. markers
+# never collide with '{' or the binary message marker.
+COMPRESSION_MARKERS = {
+    'zlib': '\x01',
+    'zlib-dict': '\x02'
+}
+
+# text that shows up in most messages carrying blocks, so even the first
+# block of a message compresses as well as the ones after it. the most common
+# text goes last, as deflate encodes nearby matches in fewer bits.
+#
+# changing this breaks 'zlib-dict' between nodes, so a different dictionary
+# needs a new method name.
+PRESET_DICT = ''.join([
+    '{"type": "accounthistory", "acct": "", "cursor": null, "more": false, "blocks": []}',
+    '{"type": "announce", "bc": "blk", "blockid": , "blocks": []}',
+    '{"type": "retrieveblocks", "bc": "blk_cnf", "cursor": , "more": true, "blocks": []}',
+    '{"type": "retrieveblocks", "bc": "tx_cnf", "cursor": , "more": true, "blocks": []}',
+    '{"type": "retrieveblocks", "bc": "tx", "cursor": , "more": true, "blocks": []}',
+    '"result": "FAILURE"}, "parent": ',
+    '{"timestamp": "2018-01-01T00:00:00", "blockid": , "data": {"linkedblock": , "validator": "validator", "result": "SUCCESS"}, "parent": }, ',
+    '{"timestamp": "2018-01-01T00:00:00", "blockid": , "data": {"sender": "0x0", "amt": , "receiver": "acct"}, "parent": }, ',
+    '{"timestamp": "2019-01-01T00:00:00", "blockid": , "data": {"sender": "acct", "amt": , "receiver": "acct"}, "parent": }, '
+])
+
+class CompressionError(ValueError):
+    pass
+
+# python 2's zlib can't take a preset dictionary, so one is emulated: a
+# compressor that has already been fed the dictionary (and a decompressor that
+# has read it back) is kept around and copied for every message. messages
+# are raw deflate streams, without zlib's header and checksum.
+_primed_compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+_primed_decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+_primed_decompressor.decompress(_primed_compressor.compress(PRESET_DICT) + _primed_compressor.flush(zlib.Z_SYNC_FLUSH))
+
+def _compressor(method):
+    if method == 'zlib-dict':
+        return _primed_compressor.copy()
+
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+def _decompressor(method):
+    if method == 'zlib-dict':
+        return _primed_decompressor.copy()
+
+    return zlib.decompressobj(-zlib.MAX_WBITS)
+
+def iscompressed(payload):
+    return payload[:1] in COMPRESSION_MARKERS.values()
+
+# compress an encoded message with `method` (None for none), unless it's too
+# short to be worth it, already compressed, or wouldn't get any shorter.
+def compress(payload, method):
+    if method is None or len(payload) < COMPRESS_THRESHOLD or iscompressed(payload):
+        return payload
+
+    c = _compressor(method)
+    compressed = COMPRESSION_MARKERS[method] + c.compress(payload) + c.flush()
+
+    return compressed if len(compressed) < len(payload) else payload
+
+# the message a compressed payload holds, refusing to inflate it past `maxsize`
+def decompress(payload, maxsize):
+    method = next((m for m, marker in COMPRESSION_MARKERS.items() if marker == payload[:1]), None)
+
+    if method is None:
+        raise CompressionError('unknown compression marker {!r}'.format(payload[:1]))
+
+    d = _decompressor(method)
+
+    try:
+        data = d.decompress(buffer(payload, 1), maxsize)
+    except zlib.error as e:
+        raise CompressionError(str(e))
+
+    if len(d.unconsumed_tail) != 0:
+        raise CompressionError('message inflates past {} bytes'.format(maxsize))
+
+    return data
@@ -0,0 +1,65 @@
+import time
+
+HEADER_PROBES = 16 # blockids asked about per round trip
+MAX_HEADER_PROBES = 64 # most blockids a node answers about at once
+FORK_SEARCH_TIMEOUT = 30 # seconds to wait for a round before giving up
+
+# finds the last block our chain has in common with a remote node's, by
+# comparing block hashes. since a block's hash covers its parent's hash, two
+# chains that agree on a block agree on everything before it, so the fork
+# point can be searched for like in a sorted list. every round asks the remote
+# node for the hashes of HEADER_PROBES blocks evenly spaced between the last
+# block known to match (lo) and the first known to differ (hi), so a fork is
+# found in O(log n) round trips without transferring any blocks.
+#
+# positions are indexes into the local chain's blocks.
+class ForkSearch:
+    def __init__(self, bc, upto, remote_tip):
+        self.bc = bc
+        self.remote_tip = remote_tip
+        self.lo = -1 # last position known to match, -1 if none
+        self.hi = None # first position known to differ, None if none yet
+        self.upto = upto # position to check first
+        self.pending = None # blockids of the round in flight
+        self.rounds = 0
+        self.started = time.time()
+
+    # blockids to ask the remote node about next
+    def probes(self):
+        self.started = time.time()
+        self.rounds += 1
+
+        if self.hi is None:
+            positions = [self.upto]
+        else:
+            span = self.hi - self.lo - 1
+            step = max(1, -(-span // HEADER_PROBES))
+            positions = range(self.lo + step, self.hi, step)
+
+        self.pending = [self.bc.blockids[i] for i in positions]
+        return self.pending
+
+    # narrow down the search with the remote hashes for `headers`, a list of
+    # [blockid, hex hash] (or None for blocks the remote node doesn't have)
+    def update(self, probes, headers):
+        for blockid, header in zip(probes, headers):
+            i = self.bc.positionafter(blockid) - 1
+
+            if header is not None and header[0] == blockid and header[1] == self.bc.hashat(i).encode('hex'):
+                self.lo = max(self.lo, i)
+            elif self.hi is None or i < self.hi:
+                self.hi = i
+
+    # the first checked block matched: the chains agree up to there
+    def agrees(self):
+        return self.hi is None and self.lo == self.upto
+
+    def done(self):
+        return self.agrees() or (self.hi is not None and self.hi == self.lo + 1)
+
+    def timedout(self):
+        return time.time() - self.started > FORK_SEARCH_TIMEOUT
+
+    # blockid of the last block in common, or None if not even the first block is
+    def forkpoint(self):
+        return self.bc.blockids[self.lo] if self.lo >= 0 else None
@@ -0,0 +1,42 @@
+import hashlib
+import json
+import thread
+from collections import OrderedDict
+
+SEEN_MESSAGES = 10000 # ids of relayed messages remembered to drop copies arriving over other paths
+MAX_MSGID_LENGTH = 128
+
+# messages broadcast between nodes are relayed to every connection but the
+# one they came in on. a message reaching a node more than once (e.g. over
+# both its client and its server) is only relayed the first time, which also
+# keeps messages from going around in circles.
+#
+# a message's id is picked by its sender, or else derived from its content
+def messageid(msg):
+    return hashlib.sha256(json.dumps(msg, sort_keys=True)).hexdigest()
+
+# the ids of the most recently seen messages, oldest first
+class SeenMessages:
+    def __init__(self, size=SEEN_MESSAGES):
+        self.size = size
+        self.ids = OrderedDict()
+        self.lock = thread.allocate_lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, msgid):
+        return msgid in self.ids
+
+    # remember `msgid`, and return False if it was already seen
+    def add(self, msgid):
+        with self.lock:
+            if msgid in self.ids:
+                return False
+
+            self.ids[msgid] = True
+
+            while len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+
+            return True
@@ -0,0 +1,275 @@
+import thread
+import Queue
+from array import array
+from bisect import bisect_left
+
+from block import *
+
+REQUIRED_CONFIRMATIONS = 6
+
+class ConfirmationTally:
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.validators = set()
+
+    def count(self):
+        return self.successes + self.failures
+
+# tallies the confirmations in the tx_cnf chain per linked tx block, and queues
+# up tx blocks that still need confirmations for the miner to work through.
+# an index nobody mines from (`mining` False) keeps no queue.
+class ConfirmationIndex:
+    def __init__(self, tx_chain, tx_cnf_chain, mining=True):
+        self.tallies = {} # tx blockid -> ConfirmationTally
+        self.queue = Queue.Queue() if mining else None # tx blocks awaiting confirmations
+        self.listeners = []
+        self.lock = thread.allocate_lock()
+        self.tx_chain = tx_chain
+
+        # tallies first, so a compact tx chain only queues unconfirmed blocks
+        tx_cnf_chain.addlistener(self._oncnf, bulk=self._loadtallies)
+
+        if mining:
+            tx_chain.addlistener(self._ontx, bulk=self._loadqueue)
+
+    # register fn(blockid, tally) to be called once a block reaches the
+    # required number of successful confirmations.
+    def addlistener(self, fn):
+        self.listeners.append(fn)
+
+    # a copy of the block's tally, as it's updated while the cnf chain grows
+    def tally(self, blockid):
+        copy = ConfirmationTally()
+
+        with self.lock:
+            tally = self.tallies.get(blockid)
+
+            if tally is not None:
+                copy.successes = tally.successes
+                copy.failures = tally.failures
+                copy.validators = set(tally.validators)
+
+        return copy
+
+    def successes(self, blockid):
+        with self.lock:
+            return self.tallies[blockid].successes if blockid in self.tallies else 0
+
+    def getstate(self):
+        with self.lock:
+            return dict((blockid, (tally.successes, tally.failures, list(tally.validators))) for blockid, tally in self.tallies.iteritems())
+
+    # restore tallies saved by getstate(). the tx chain should already hold the
+    # blocks the state was taken from, so the mining queue can be rebuilt.
+    def setstate(self, state):
+        with self.lock:
+            self.tallies = {}
+
+            for blockid, (successes, failures, validators) in state.iteritems():
+                tally = self.tallies[blockid] = ConfirmationTally()
+                tally.successes = successes
+                tally.failures = failures
+                tally.validators = set(validators)
+
+            if self.queue is None:
+                return
+
+            self.queue = Queue.Queue()
+
+            for blk in self.tx_chain.blocks:
+                if not blk.isgenesis() and (blk.blockid not in self.tallies or self.tallies[blk.blockid].count() < REQUIRED_CONFIRMATIONS):
+                    self.queue.put(blk)
+
+    def _loadtallies(self, blocks):
+        with self.lock:
+            for blockid, (successes, failures, validators) in blocks.tallies().iteritems():
+                tally = self.tallies[blockid] = ConfirmationTally()
+                tally.successes = successes
+                tally.failures = failures
+                tally.validators = validators
+
+    def _loadqueue(self, blocks):
+        with self.lock:
+            for i, blockid in enumerate(blocks.blockid):
+                if blockid != 0 and (blockid not in self.tallies or self.tallies[blockid].count() < REQUIRED_CONFIRMATIONS):
+                    self.queue.put(blocks[i])
+
+    def _ontx(self, bc, blk):
+        if not blk.isgenesis():
+            self.queue.put(blk)
+
+    def _oncnf(self, bc, cnf):
+        linkedblock = cnf.data['linkedblock']
+
+        with self.lock:
+            tally = self.tallies.get(linkedblock)
+
+            if tally is None:
+                tally = self.tallies[linkedblock] = ConfirmationTally()
+
+            tally.validators.add(cnf.data['validator'])
+
+            if cnf.data['result'] == 'SUCCESS':
+                tally.successes += 1
+                reached = tally.successes == REQUIRED_CONFIRMATIONS
+            else:
+                tally.failures += 1
+                reached = False
+
+        # listeners are called outside of the lock so they may query the index.
+        if reached:
+            for fn in self.listeners:
+                fn(linkedblock, tally)
+
+# keeps confirmed and unconfirmed balances per account up to date as blocks
+# are appended to the tx chain and confirmed, so lookups don't rescan the chains.
+class BalanceIndex:
+    def __init__(self, tx_chain, confirmations):
+        self.confirmed = {}
+        self.unconfirmed = {}
+        self.pending = {} # tx blockid -> tx data, for txs not yet confirmed
+        self.confirmations = confirmations
+        self.lock = thread.allocate_lock()
+
+        confirmations.addlistener(self._onconfirmed)
+        tx_chain.addlistener(self._ontx, bulk=self._loadcolumns)
+
+    def lookup(self, acct):
+        with self.lock:
+            return (self.confirmed.get(acct, 0), self.unconfirmed.get(acct, 0))
+
+    def accounts(self):
+        with self.lock:
+            return [(acct, (self.confirmed.get(acct, 0), bal)) for acct, bal in self.unconfirmed.iteritems()]
+
+    def getstate(self):
+        with self.lock:
+            return {
+                'confirmed': dict(self.confirmed),
+                'unconfirmed': dict(self.unconfirmed),
+                'pending': dict(self.pending)
+            }
+
+    def setstate(self, state):
+        with self.lock:
+            self.confirmed = dict(state['confirmed'])
+            self.unconfirmed = dict(state['unconfirmed'])
+            self.pending = dict(state['pending'])
+
+    def _ontx(self, bc, blk):
+        with self.lock:
+            self._apply(self.unconfirmed, blk.data)
+
+            if blk.isgenesis() or self.confirmations.successes(blk.blockid) >= REQUIRED_CONFIRMATIONS:
+                self._apply(self.confirmed, blk.data)
+            else:
+                self.pending[blk.blockid] = blk.data
+
+    def _loadcolumns(self, blocks):
+        with self.confirmations.lock:
+            tallies = self.confirmations.tallies
+            confirmed = [blockid == 0 or (blockid in tallies and tallies[blockid].successes >= REQUIRED_CONFIRMATIONS) for blockid in blocks.blockid]
+
+        with self.lock:
+            self.unconfirmed = blocks.netbalances()
+            self.confirmed = blocks.netbalances(confirmed)
+            self.pending = dict((blocks.blockid[i], blocks[i].data) for i in xrange(len(confirmed)) if not confirmed[i])
+
+    def _onconfirmed(self, blockid, tally):
+        with self.lock:
+            if blockid in self.pending:
+                self._apply(self.confirmed, self.pending.pop(blockid))
+
+    def _apply(self, balances, data):
+        for sender, receiver, amt in transfers(data):
+            # make sure both parties show up in the ledger, even with a zero balance.
+            balances.setdefault(sender, 0)
+            balances.setdefault(receiver, 0)
+
+            balances[receiver] += amt
+
+            if sender != receiver:
+                balances[sender] -= amt
+
+# the tx blocks each account took part in (as sender or receiver), in chain
+# order, so an account's history can be paged through without rescanning the chain.
+class AccountIndex:
+    def __init__(self, tx_chain):
+        self.blockids = {} # account -> array of tx blockids
+        self.lock = thread.allocate_lock()
+
+        tx_chain.addlistener(self._ontx, bulk=self._loadcolumns)
+
+    def count(self, acct):
+        with self.lock:
+            return len(self.blockids.get(acct, ()))
+
+    # blockids of the account's latest `limit` txs before blockid `before` (or
+    # the latest ones if None), newest first
+    def lookup(self, acct, before=None, limit=None):
+        with self.lock:
+            blockids = self.blockids.get(acct)
+
+            if blockids is None:
+                return []
+
+            end = bisect_left(blockids, before) if before is not None else len(blockids)
+            start = max(0, end - limit) if limit is not None else 0
+
+            return blockids[start:end].tolist()[::-1]
+
+    def getstate(self):
+        with self.lock:
+            return dict((acct, blockids.tolist()) for acct, blockids in self.blockids.iteritems())
+
+    def setstate(self, state):
+        with self.lock:
+            self.blockids = dict((acct, array('l', blockids)) for acct, blockids in state.iteritems())
+
+    def _ontx(self, bc, blk):
+        with self.lock:
+            for acct in self._accounts(blk.data):
+                self._add(acct, blk.blockid)
+
+    def _loadcolumns(self, blocks):
+        with self.lock:
+            self.blockids = {}
+
+            for i in xrange(len(blocks)):
+                if i in blocks.overflow:
+                    for acct in self._accounts(blocks.overflow[i].data):
+                        self._add(acct, blocks.blockid[i])
+                    continue
+
+                sender, receiver = blocks.strings[blocks.sender[i]], blocks.strings[blocks.receiver[i]]
+
+                self._add(sender, blocks.blockid[i])
+
+                if receiver != sender:
+                    self._add(receiver, blocks.blockid[i])
+
+    # every account taking part in a block's transfers, once each, in order
+    def _accounts(self, data):
+        accts = []
+
+        try:
+            for sender, receiver, amt in transfers(data):
+                for acct in (sender, receiver):
+                    if acct not in accts:
+                        accts.append(acct)
+        except (KeyError, TypeError):
+            pass
+
+        return accts
+
+    def _add(self, acct, blockid):
+        if not isinstance(acct, basestring):
+            return
+
+        blockids = self.blockids.get(acct)
+
+        if blockids is None:
+            blockids = self.blockids[acct] = array('l')
+
+        blockids.append(blockid)
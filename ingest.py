@@ -0,0 +1,185 @@
+import thread
+import Queue
+import time
+import multiprocessing
+
+from codec import *
+
+INGEST_QUEUE_SIZE = 8 # batches waiting for each stage before submit() blocks
+POOL_MIN_BATCH = 500 # blocks in a batch before it's worth validating on the process pool
+POOL_MIN_CHUNK = 100
+
+def _validatechunk(args):
+    return decodebatch(*args)
+
+def _itemblockid(item):
+    return item.blockid if isinstance(item, Block) else item.get('blockid') if isinstance(item, dict) else None
+
+# busy time and volume of one stage of the pipeline
+class StageStats:
+    def __init__(self):
+        self.batches = 0
+        self.blocks = 0
+        self.seconds = 0.0
+
+    def record(self, blocks, seconds):
+        self.batches += 1
+        self.blocks += blocks
+        self.seconds += seconds
+
+    def throughput(self):
+        return self.blocks / self.seconds if self.seconds > 0 else 0.0
+
+# applies batches of blocks received from the network in stages, each on its
+# own thread, so the thread reading the socket only has to decode messages:
+#
+#   validate: decodebatch() against the last block validated for the chain
+#             (large batches optionally split across a process pool)
+#   persist:  apply(bc, blk) for every valid block, i.e. savelocal + append
+#
+# stages are connected by bounded queues, so submit() blocks while the
+# pipeline is full, which keeps the reader from pulling in more than can be
+# applied. batches of a chain are applied in the order they were submitted.
+class IngestPipeline:
+    def __init__(self, apply, onerror, processes=0, queue_size=INGEST_QUEUE_SIZE):
+        self.apply = apply
+        self.onerror = onerror
+        self.processes = processes
+
+        # forked here rather than when first needed, as by then the node's
+        # other threads are running and may hold locks the children inherit
+        self.pool = multiprocessing.Pool(processes) if processes > 0 else None
+
+        self.validate_queue = Queue.Queue(queue_size)
+        self.persist_queue = Queue.Queue(queue_size)
+
+        self.tails = {} # chain key -> blockid of the last block validated but maybe not yet persisted
+        self.pending = {} # chain key -> batches validated but not yet persisted
+        self.lock = thread.allocate_lock()
+
+        self.stages = {
+            'validate': StageStats(),
+            'persist': StageStats()
+        }
+        self.waited = 0.0 # seconds submit() spent blocked on a full pipeline
+
+        thread.start_new_thread(self._validateloop, ())
+        thread.start_new_thread(self._persistloop, ())
+
+    # queue a run of blocks (json objects, or blocks decoded from a binary
+    # message) that should follow on from the chain's latest block.
+    #
+    # onvalidated(blocks, errors) is called once the batch has been validated,
+    # and ondone(blocks, errors) once the valid blocks have been applied, both
+    # from the pipeline's threads. blocks are the ones before the first bad
+    # block, and errors hold a BlockError for every rejected block.
+    def submit(self, bc, items, onvalidated=None, ondone=None):
+        started = time.time()
+        self.validate_queue.put((bc, items, onvalidated, ondone))
+        self.waited += time.time() - started
+
+    def stats(self):
+        stats = dict((name, {
+            'batches': stage.batches,
+            'blocks': stage.blocks,
+            'seconds': stage.seconds,
+            'blocks_per_sec': stage.throughput()
+        }) for name, stage in self.stages.iteritems())
+
+        stats['validate']['queued'] = self.validate_queue.qsize()
+        stats['persist']['queued'] = self.persist_queue.qsize()
+        stats['waited'] = self.waited
+
+        return stats
+
+    def summary(self):
+        return 'validated {:.0f} blocks/s, persisted {:.0f} blocks/s, reader blocked for {:.2f}s'.format(
+            self.stages['validate'].throughput(), self.stages['persist'].throughput(), self.waited)
+
+    def _validateloop(self):
+        while 1:
+            bc, items, onvalidated, ondone = self.validate_queue.get()
+            started = time.time()
+
+            with self.lock:
+                prevblockid = self.tails.get(bc.key)
+
+                if prevblockid is None and len(bc.blocks) != 0:
+                    prevblockid = bc.latestblock().blockid
+
+            try:
+                blocks, errors = self._validate(bc.key, items, prevblockid)
+            except Exception as e:
+                blocks, errors = [], [BlockError(0, _itemblockid(items[0]) if len(items) != 0 else None, str(e))]
+
+            with self.lock:
+                self.pending[bc.key] = self.pending.get(bc.key, 0) + 1
+
+                if len(blocks) != 0:
+                    self.tails[bc.key] = blocks[-1].blockid
+
+            self.stages['validate'].record(len(items), time.time() - started)
+
+            self._call(onvalidated, blocks, errors)
+            self.persist_queue.put((bc, blocks, errors, ondone))
+
+    def _validate(self, key, items, prevblockid):
+        if self.pool is None or len(items) < POOL_MIN_BATCH or not isinstance(items[0], dict):
+            return decodebatch(key, items, prevblockid)
+
+        # each chunk links to the last item of the one before it
+        size = max(POOL_MIN_CHUNK, -(-len(items) // self.processes))
+        chunks = [(key, items[lo:lo + size], prevblockid if lo == 0 else _itemblockid(items[lo - 1])) for lo in xrange(0, len(items), size)]
+
+        blocks = []
+        errors = []
+
+        for n, (chunk_blocks, chunk_errors) in enumerate(self.pool.map(_validatechunk, chunks)):
+            if len(errors) == 0:
+                blocks.extend(chunk_blocks)
+
+            for error in chunk_errors:
+                error.index += n * size
+                errors.append(error)
+
+        return blocks, errors
+
+    def _persistloop(self):
+        while 1:
+            bc, blocks, errors, ondone = self.persist_queue.get()
+            started = time.time()
+            applied = []
+
+            # an earlier batch of this chain may have failed to persist
+            if len(blocks) != 0 and len(bc.blocks) != 0 and blocks[0].parent != bc.latestblock().blockid:
+                errors = [BlockError(0, blocks[0].blockid, 'parent should be equal to previous block id ({})'.format(bc.latestblock().blockid))] + errors
+                blocks = []
+
+            for i, blk in enumerate(blocks):
+                try:
+                    self.apply(bc, blk)
+                except Exception as e:
+                    errors = [BlockError(i, blk.blockid, 'failed to apply block: {}'.format(e))] + errors
+                    break
+
+                applied.append(blk)
+
+            with self.lock:
+                self.pending[bc.key] -= 1
+
+                if self.pending[bc.key] == 0 or len(applied) != len(blocks):
+                    # later batches are validated against the chain itself again
+                    self.tails.pop(bc.key, None)
+
+            self.stages['persist'].record(len(applied), time.time() - started)
+
+            self._call(ondone, applied, errors)
+
+    def _call(self, fn, blocks, errors):
+        if fn is None:
+            return
+
+        try:
+            fn(blocks, errors)
+        except Exception as e:
+            self.onerror('Error while ingesting blocks: {}'.format(e))
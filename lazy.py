@@ -0,0 +1,75 @@
+import thread
+from array import array
+from collections import OrderedDict
+
+from codec import *
+
+DEFAULT_CACHE_BLOCKS = 10000 # decoded blocks a lazy chain keeps in memory
+
+# list-like storage for a chain's blocks that keeps only their blockids in
+# memory. blocks are read from the chain's block log (through memory maps of
+# its segments) and decoded when indexed, and the most recently used ones are
+# kept in an LRU cache of `cache_size` blocks. a block appended to the chain
+# has to be in the log already, which it is when appended as usual, after
+# blk.savelocal(bc).
+#
+# iterating reads through the log without filling the cache, so a full scan
+# doesn't push out the blocks near the tip that are used the most.
+class LazyBlocks(object):
+    def __init__(self, log, cache_size=DEFAULT_CACHE_BLOCKS):
+        self.log = log
+        self.cache_size = cache_size
+        self.blockid = array('l')
+        self.cache = OrderedDict() # position -> block, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.lock = thread.allocate_lock()
+
+    def __len__(self):
+        return len(self.blockid)
+
+    def __iter__(self):
+        for i in xrange(len(self.blockid)):
+            yield self._get(i, False)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._get(j) for j in xrange(*i.indices(len(self.blockid)))]
+
+        if i < 0:
+            i += len(self.blockid)
+
+        if i < 0 or i >= len(self.blockid):
+            raise IndexError('block index out of range')
+
+        return self._get(i)
+
+    def append(self, blk):
+        self.blockid.append(blk.blockid)
+        self._remember(len(self.blockid) - 1, blk)
+
+    def _get(self, i, cache=True):
+        with self.lock:
+            blk = self.cache.pop(i, None)
+
+            if blk is not None:
+                # re-insert to mark it as most recently used
+                self.cache[i] = blk
+                self.hits += 1
+                return blk
+
+            self.misses += 1
+
+        blk = decodestored(self.log.readmapped(self.blockid[i]))
+
+        if cache:
+            self._remember(i, blk)
+
+        return blk
+
+    def _remember(self, i, blk):
+        with self.lock:
+            self.cache[i] = blk
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
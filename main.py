@@ -6,47 +6,38 @@ import thread
 import json
 import time
 import datetime
+import argparse
 
 from client import *
 from server import *
 from chain import *
+from snapshot import *
+from node import *
 
 class P2PServer(Frame):
-    def __init__(self, root):
+    def __init__(self, root, server_opts={}, compact_chains=False, lazy_chains=False, cache_blocks=DEFAULT_CACHE_BLOCKS, ingest_processes=0, stats_file=None, stats_interval=60, block_max_txs=BLOCK_MAX_TXS, block_max_wait=BLOCK_MAX_WAIT):
         Frame.__init__(self, root)
         self.root = root
 
-        self.blockchains = {}
-
-        for k in ['tx', 'tx_cnf', 'blk', 'blk_cnf']:
-            chain = Chain(k)
-            self.blockchains[k] = chain
-            chain.loadlocal(handlers={
-                'onstatus': self.client_status,
-                'onerror': self.client_error
-            })
-
-        self.client = Client(
-            self.blockchains['tx'],
-            self.blockchains['tx_cnf'],
-            self.blockchains['blk'],
-            self.blockchains['blk_cnf'],
-            {
-                'onconnect': self._onselfconnect,
-                'ondisconnect': self._onselfdisconnect,
-                'onfailure': self._onselffailure,
-                'onstatus': self.client_status,
-                'onerror': self.client_error
-            }
-        ) # so it can connect to other servers as a client
-    
-        self.server = Server(
-            self.blockchains['tx'],
-            self.blockchains['tx_cnf'],
-            self.blockchains['blk'],
-            self.blockchains['blk_cnf'],
-            onstatus=self.server_status
-        )
+        self.node = Node({
+            'onconnect': self._onselfconnect,
+            'ondisconnect': self._onselfdisconnect,
+            'onfailure': self._onselffailure,
+            'onstatus': self.client_status,
+            'onerror': self.client_error
+        }, self.server_status, server_opts=server_opts, compact_chains=compact_chains, lazy_chains=lazy_chains, cache_blocks=cache_blocks, ingest_processes=ingest_processes, stats_file=stats_file, stats_interval=stats_interval, block_max_txs=block_max_txs, block_max_wait=block_max_wait)
+
+        self.blockchains = self.node.blockchains
+        self.mempool = self.node.mempool
+        self.client = self.node.client
+        self.server = self.node.server
+        self.snapshots = self.node.snapshots
+
+    def loadlocal(self):
+        self.node.loadlocal({
+            'onstatus': self.client_status,
+            'onerror': self.client_error
+        })
 
     def _onselfconnect(self):
         self.client_status("Connected to server successfully")
@@ -173,67 +164,46 @@ class P2PServer(Frame):
         nb.add(public_ledger_frame, text='Public Ledger')
 
     def refresh_public_ledger(self):
-        #get all accounts
-        records = {}
-
-        for tx in self.blockchains['tx'].blocks:
-            for acct in [tx.data['sender'], tx.data['receiver']]:
-                assert isinstance(acct, basestring)
-                if records.get(acct) is None:
-                    records[acct] = self.client._calcbalance(acct)
+        records = self.client.balances.accounts()
 
         self.public_ledger_list.delete(0, END)
         
-        for k, v in records.iteritems():
+        for k, v in records:
             self.public_ledger_list.insert(END, "{}:\tConfirmed: {}\tUnconfirmed: {}".format(k, *v))
 
 
     def _reset_new_transaction_text(self):
-        latest = self.blockchains['tx'].latestblock()
         self.create_new_transaction_field.delete(1.0, END)
-        self.create_new_transaction_field.insert(END, '{{\n  "blockid": {},\n  "timestamp": "{}",\n  "parent": {},\n  "data": {{\n    "sender": "",\n    "receiver": "",\n    "amt": 0\n  }}\n}}'.format(latest.blockid + 1, datetime.datetime.now(), latest.blockid))
+        self.create_new_transaction_field.insert(END, '{{\n  "sender": "",\n  "receiver": "",\n  "amt": 0,\n  "nonce": "{}"\n}}'.format(datetime.datetime.now()))
 
     def create_new_transaction(self):
         text_value = self.create_new_transaction_field.get("1.0", END)
 
         try:
             json_tx = json.loads(text_value)
-            # adjust timestamp.
-            json_tx['timestamp'] = datetime.datetime.now()
-            latest = self.blockchains['tx'].latestblock()
-
-            assert isinstance(json_tx['blockid'], int), "blockid should be int"
-            assert json_tx['blockid'] == latest.blockid + 1, "blockid should be equal to latest block id + 1"
-            assert isinstance(json_tx['parent'], int), "parent should be int"
-            assert json_tx['parent'] == latest.blockid, "blockid should be equal to latest block id"
-            assert (json_tx['data'] is not None) and (isinstance(json_tx['data'], dict)), "no data provided, or data is invalid type (should be dict)"
-            assert isinstance(json_tx['data']['sender'], basestring), "sender should be str"
-            assert len(json_tx['data']['sender']) > 0, "no sender provided"
-            assert isinstance(json_tx['data']['receiver'], basestring), "receiver should be str"
-            assert len(json_tx['data']['receiver']) > 0, "no receiver provided"
-            assert isinstance(json_tx['data']['amt'], int), "amt should be int"
-            assert json_tx['data']['amt'] > 0, "amt should be greater than zero"
-
-            tx = Transaction(
-                blockid=json_tx['blockid'],
-                timestamp=json_tx['timestamp'],
-                senderid=json_tx['data']['sender'],
-                receiverid=json_tx['data']['receiver'],
-                amt=json_tx['data']['amt'],
-                parent=json_tx['parent']
-            )
-
-            self.client_status("Broadcasting transaction...")
-
-            self.blockchains['tx'].blocks.append(tx)
-            tx.savelocal(self.blockchains['tx'])
-
-            tkMessageBox.showinfo("Transaction created", "The transaction has been successfully created, and will begin propagating throughout the network.")
+
+            assert isinstance(json_tx, dict), "transaction should be an object"
+            assert isinstance(json_tx.get('sender'), basestring), "sender should be str"
+            assert len(json_tx['sender']) > 0, "no sender provided"
+            assert isinstance(json_tx.get('receiver'), basestring), "receiver should be str"
+            assert len(json_tx['receiver']) > 0, "no receiver provided"
+            assert isinstance(json_tx.get('amt'), int), "amt should be int"
+            assert json_tx['amt'] > 0, "amt should be greater than zero"
+
+            # the nonce keeps the same transaction from being added twice
+            self.mempool.add(json_tx['sender'], json_tx['receiver'], json_tx['amt'], json_tx.get('nonce'))
+
+            self.client_status("Transaction added to the pool...")
+
+            tkMessageBox.showinfo("Transaction created", "The transaction has been added to the pool and announced to the network. It will be confirmed once it's packed into a block.")
             self._reset_new_transaction_text()
 
         except AssertionError as e:
             tkMessageBox.showerror("Validation failed", str(e))
 
+        except TransactionRejected as e:
+            tkMessageBox.showerror("Transaction rejected", str(e))
+
         except ValueError as e:
             tkMessageBox.showerror("Invalid JSON data", str(e))
             self._reset_new_transaction_text()
@@ -278,10 +248,31 @@ class P2PServer(Frame):
 
 
 def main():
+    parser = argparse.ArgumentParser(description='P2P Server')
+    parser.add_argument('--server-mode', choices=SERVER_MODES, default='threaded', help='serve clients with a thread each, or all from one event loop')
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG, help='listen backlog of the server socket')
+    parser.add_argument('--max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS, help='connections beyond this are closed right away')
+    parser.add_argument('--no-compression', action='store_true', help='never compress messages sent to other nodes, e.g. on a fast local network')
+    parser.add_argument('--compact-chains', action='store_true', help='keep the tx and tx_cnf chains in memory as columns instead of block objects')
+    parser.add_argument('--lazy-chains', action='store_true', help='keep only blockids in memory and read blocks from disk when needed (the tx and tx_cnf chains stay compact with --compact-chains)')
+    parser.add_argument('--cache-blocks', type=int, default=DEFAULT_CACHE_BLOCKS, help='blocks a lazy chain keeps decoded in memory')
+    parser.add_argument('--ingest-processes', type=int, default=0, help='validate large batches of synced blocks on this many processes')
+    parser.add_argument('--block-max-txs', type=int, default=BLOCK_MAX_TXS, help='most transactions packed into one block')
+    parser.add_argument('--block-max-wait-ms', type=int, default=int(BLOCK_MAX_WAIT * 1000), help='milliseconds a transaction waits for others to share its block')
+    parser.add_argument('--stats-file', help='append a json snapshot of the node\'s metrics to this file periodically')
+    parser.add_argument('--stats-interval', type=int, default=60, help='seconds between snapshots written to --stats-file')
+    args = parser.parse_args()
+
     root = Tk()
 
-    p2p_server = P2PServer(root)
+    p2p_server = P2PServer(root, server_opts={
+        'mode': args.server_mode,
+        'backlog': args.backlog,
+        'max_connections': args.max_connections,
+        'compressions': () if args.no_compression else COMPRESSIONS
+    }, compact_chains=args.compact_chains, lazy_chains=args.lazy_chains, cache_blocks=args.cache_blocks, ingest_processes=args.ingest_processes, stats_file=args.stats_file, stats_interval=args.stats_interval, block_max_txs=args.block_max_txs, block_max_wait=args.block_max_wait_ms / 1000.0)
     p2p_server.show()
+    p2p_server.loadlocal()
 
     root.mainloop()
 
@@ -0,0 +1,281 @@
+import hashlib
+import json
+import thread
+import threading
+import time
+import datetime
+from collections import OrderedDict
+
+from block import *
+from metrics import *
+
+MEMPOOL_MAX_TXS = 10000 # pending txs before new ones are turned away
+BLOCK_MAX_TXS = 100 # txs packed into one block
+BLOCK_MAX_WAIT = 0.5 # seconds the oldest pending tx waits for others to share its block
+SEEN_TXIDS = 100000 # ids of txs already taken into blocks, remembered to turn away resubmissions
+TAKEN_TIMEOUT = 600 # seconds a taken tx counts against its sender if it never shows up in a block
+
+class TransactionRejected(ValueError):
+    pass
+
+# txs are identified by their fields and a nonce picked by whoever submits
+# them, so a tx submitted twice (e.g. retried after a timeout) is only taken once
+def txid(sender, receiver, amt, nonce):
+    return hashlib.sha256(json.dumps([sender, receiver, amt, nonce])).hexdigest()
+
+# transactions waiting to be packed into a block, oldest first. txs are
+# checked against the sender's balance when they're added, counting what the
+# sender already has pending in the pool, so blocks are mostly made of txs
+# that will get confirmed.
+#
+# a tx taken out of the pool keeps counting against its sender until a block
+# holding it is appended to the tx chain (see ontxblock()), as that's when the
+# sender's balance reflects it. that's right away for blocks packed here, but
+# a tx forwarded to another node only gets here with the next sync, or is
+# rejected by that node (see reject()).
+class Mempool:
+    def __init__(self, balances, max_txs=MEMPOOL_MAX_TXS):
+        self.balances = balances
+        self.max_txs = max_txs
+
+        self.txs = OrderedDict() # txid -> (sender, receiver, amt, time added, nonce, onrejected)
+        self.taken = OrderedDict() # txid -> (sender, receiver, amt, time taken, nonce, onrejected), until it's in a block
+        self.takenby = {} # (sender, receiver, amt) -> txids in self.taken, oldest first
+        self.outgoing = {} # sender -> amt of its txs in the pool or taken
+        self.seen = OrderedDict() # txids taken into blocks, oldest first
+        self.cond = threading.Condition()
+        self.listeners = []
+
+        self.metrics = Metrics()
+        self.metrics.gauge('pending', lambda: len(self.txs))
+        self.metrics.gauge('taken', lambda: len(self.taken))
+
+    def __len__(self):
+        return len(self.txs)
+
+    # register fn(txid, sender, receiver, amt, nonce) to be called for every tx
+    # taken into the pool
+    def addlistener(self, fn):
+        self.listeners.append(fn)
+
+    # add a tx to the pool and return its id, or raise TransactionRejected.
+    # without a nonce every tx is taken to be a new one, and is given a nonce
+    # of its own so other nodes derive the same id for it. if the tx is
+    # rejected later on (see reject()), onrejected(txid, reason) is called.
+    def add(self, sender, receiver, amt, nonce=None, onrejected=None):
+        if not isinstance(sender, basestring) or len(sender) == 0:
+            raise TransactionRejected('sender should be a non-empty str')
+
+        if not isinstance(receiver, basestring) or len(receiver) == 0:
+            raise TransactionRejected('receiver should be a non-empty str')
+
+        if not isinstance(amt, int) or amt <= 0:
+            raise TransactionRejected('amt should be an int greater than zero')
+
+        if nonce is None:
+            nonce = repr(time.time())
+
+        tid = txid(sender, receiver, amt, nonce)
+
+        with self.cond:
+            if tid in self.txs or tid in self.seen:
+                self.metrics.counter('duplicates').inc()
+                raise TransactionRejected('duplicate transaction {}'.format(tid))
+
+            if len(self.txs) >= self.max_txs:
+                self.metrics.counter('rejected').inc()
+                raise TransactionRejected('the pool is full')
+
+            # spendable is what's confirmed, less what's on its way out in
+            # unconfirmed blocks (which the unconfirmed balance reflects) and
+            # in the pool. funds still being received don't count yet.
+            confirmed, unconfirmed = self.balances.lookup(sender)
+            available = min(confirmed, unconfirmed) - self.outgoing.get(sender, 0)
+
+            if available < amt:
+                self.metrics.counter('rejected').inc()
+                raise TransactionRejected('{} has {} available, but sends {}'.format(sender, available, amt))
+
+            self.txs[tid] = (sender, receiver, amt, time.time(), nonce, onrejected)
+            self.outgoing[sender] = self.outgoing.get(sender, 0) + amt
+            self.metrics.counter('accepted').inc()
+            self.cond.notify_all()
+
+        for fn in self.listeners:
+            fn(tid, sender, receiver, amt, nonce)
+
+        return tid
+
+    # take the oldest `n` txs as (sender, receiver, amt), or (txid, sender,
+    # receiver, amt, nonce) with `ids`, once there are that many, or once the
+    # oldest has waited `wait` seconds. returns [] if the pool stays empty for
+    # `timeout` seconds.
+    def take(self, n, wait, timeout=1, ids=False):
+        with self.cond:
+            self._expiretaken()
+
+            deadline = time.time() + timeout
+
+            while len(self.txs) == 0:
+                remaining = deadline - time.time()
+
+                if remaining <= 0:
+                    return []
+
+                self.cond.wait(remaining)
+
+            while len(self.txs) < n:
+                remaining = next(self.txs.itervalues())[3] + wait - time.time()
+
+                if remaining <= 0:
+                    break
+
+                self.cond.wait(remaining)
+
+            taken = []
+            now = time.time()
+
+            while len(self.txs) != 0 and len(taken) < n:
+                tid, (sender, receiver, amt, added, nonce, onrejected) = self.txs.popitem(last=False)
+                taken.append((tid, sender, receiver, amt, nonce) if ids else (sender, receiver, amt))
+
+                self.taken[tid] = (sender, receiver, amt, now, nonce, onrejected)
+                self.takenby.setdefault((sender, receiver, amt), []).append(tid)
+
+                self.seen[tid] = True
+                self.metrics.histogram('wait').observe(now - added)
+
+            while len(self.seen) > SEEN_TXIDS:
+                self.seen.popitem(last=False)
+
+            return taken
+
+    # a chain listener for the tx chain: the txs in `blk` stop counting
+    # against their senders, as their balances now reflect them
+    def ontxblock(self, bc, blk):
+        if len(self.taken) == 0:
+            return
+
+        with self.cond:
+            for sender, receiver, amt in transfers(blk.data):
+                tids = self.takenby.get((sender, receiver, amt))
+
+                if tids:
+                    self._release(tids[0])
+
+    # a taken tx was turned away by the node it was forwarded to
+    def reject(self, tid, reason):
+        with self.cond:
+            if tid not in self.taken:
+                return
+
+            onrejected = self.taken[tid][5]
+            self._release(tid)
+            self.metrics.counter('rejected_upstream').inc()
+
+        if onrejected is not None:
+            onrejected(tid, reason)
+
+    # put a taken tx back in the pool, e.g. when it couldn't be forwarded
+    def requeue(self, tid):
+        with self.cond:
+            if tid not in self.taken:
+                return
+
+            sender, receiver, amt, taken, nonce, onrejected = self.taken[tid]
+            self._release(tid)
+
+            self.txs[tid] = (sender, receiver, amt, time.time(), nonce, onrejected)
+            self.outgoing[sender] = self.outgoing.get(sender, 0) + amt
+            self.cond.notify_all()
+
+    # the caller holds the lock
+    def _release(self, tid):
+        sender, receiver, amt = self.taken.pop(tid)[:3]
+
+        tids = self.takenby[(sender, receiver, amt)]
+        tids.remove(tid)
+
+        if len(tids) == 0:
+            del self.takenby[(sender, receiver, amt)]
+
+        self.outgoing[sender] -= amt
+
+        if self.outgoing[sender] == 0:
+            del self.outgoing[sender]
+
+    # txs that never made it into a block (e.g. lost along with the node they
+    # were forwarded to) stop counting eventually. the caller holds the lock.
+    def _expiretaken(self):
+        cutoff = time.time() - TAKEN_TIMEOUT
+
+        while len(self.taken) != 0 and next(self.taken.itervalues())[3] < cutoff:
+            self._release(next(self.taken.iterkeys()))
+            self.metrics.counter('expired').inc()
+
+# packs txs from the mempool into blocks on the tx chain: up to `max_txs` per
+# block, waiting at most `max_wait` seconds for a block to fill up. a block
+# of several txs needs only one round of confirmations for all of them.
+#
+# a node syncing its tx chain from another one can't add blocks to it without
+# forking from that node, so while it's connected its txs are handed on to be
+# packed there instead (see forwardto()).
+class BlockAssembler:
+    def __init__(self, mempool, tx_chain, onstatus, max_txs=BLOCK_MAX_TXS, max_wait=BLOCK_MAX_WAIT):
+        self.mempool = mempool
+        self.tx_chain = tx_chain
+        self.onstatus = onstatus
+        self.max_txs = max_txs
+        self.max_wait = max_wait
+        self.is_running = False
+        self.forward = None
+
+        self.metrics = Metrics()
+
+    # the tx chain should hold its local blocks (at least the genesis block) by now
+    def start(self):
+        assert not self.is_running
+
+        self.is_running = True
+        thread.start_new_thread(self.assemble_blocks, ())
+
+    def stop(self):
+        self.is_running = False
+
+    # hand the txs taken from the pool to fn(txid, sender, receiver, amt,
+    # nonce) instead of packing them, or pack them again if `fn` is None
+    def forwardto(self, fn):
+        self.forward = fn
+
+    def assemble_blocks(self):
+        while self.is_running:
+            txs = self.mempool.take(self.max_txs, self.max_wait if self.forward is None else 0, ids=True)
+            forward = self.forward
+
+            if len(txs) == 0:
+                continue
+
+            # checked again after the wait, so no block is packed once txs are forwarded
+            if forward is not None:
+                for tid, sender, receiver, amt, nonce in txs:
+                    forward(tid, sender, receiver, amt, nonce)
+
+                self.metrics.counter('forwarded').inc(len(txs))
+                continue
+
+            txs = [(sender, receiver, amt) for tid, sender, receiver, amt, nonce in txs]
+
+            latest = self.tx_chain.latestblock()
+
+            if len(txs) == 1:
+                # a lone tx stays a plain transaction, which every node understands
+                blk = Transaction(latest.blockid + 1, datetime.datetime.now(), txs[0][0], txs[0][1], txs[0][2], latest.blockid)
+            else:
+                blk = TransactionBatch(latest.blockid + 1, datetime.datetime.now(), txs, latest.blockid)
+
+            blk.savelocal(self.tx_chain)
+            self.tx_chain.append(blk)
+
+            self.metrics.counter('blocks').inc()
+            self.metrics.counter('txs').inc(len(txs))
+            self.onstatus('Assembled block #{} of {} transactions.'.format(blk.blockid, len(txs)))
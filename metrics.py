@@ -0,0 +1,140 @@
+import json
+import os
+import thread
+import time
+
+HISTOGRAM_BUCKETS = 32 # bucket i holds values below 2^i microseconds
+METER_WINDOW = 60 # seconds a meter's rate is averaged over
+
+# metrics are updated from many threads without taking a lock, to keep them
+# cheap on the hot paths. under heavy contention an update can occasionally
+# be lost, which is fine for monitoring.
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+# latencies (in seconds) in power of two buckets, for cheap approximate percentiles
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[min(int(seconds * 1000000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.sum += seconds
+
+        if seconds > self.max:
+            self.max = seconds
+
+    # upper bound (in seconds) of the bucket holding the q-th quantile
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+
+        for i, n in enumerate(self.buckets):
+            seen += n
+
+            if seen >= rank and n != 0:
+                return min((2 ** i) / 1000000.0, self.max)
+
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count != 0 else 0.0,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99)
+        }
+
+# events per second over the last METER_WINDOW seconds, kept in one slot per second
+class Meter:
+    def __init__(self):
+        self.total = 0
+        self.slots = [0] * METER_WINDOW
+        self.stamps = [0] * METER_WINDOW
+
+    def mark(self, n=1):
+        now = int(time.time())
+        i = now % METER_WINDOW
+
+        if self.stamps[i] != now:
+            self.stamps[i] = now
+            self.slots[i] = 0
+
+        self.slots[i] += n
+        self.total += n
+
+    def rate(self):
+        since = int(time.time()) - METER_WINDOW
+
+        return sum(n for n, stamp in zip(self.slots, self.stamps) if stamp > since) / float(METER_WINDOW)
+
+    def snapshot(self):
+        return {
+            'total': self.total,
+            'per_sec': self.rate()
+        }
+
+# a named set of metrics. gauges are functions, read when taking a snapshot.
+class Metrics:
+    def __init__(self):
+        self.metrics = {}
+        self.gauges = {}
+
+    def counter(self, name):
+        return self.metrics.get(name) or self.metrics.setdefault(name, Counter())
+
+    def histogram(self, name):
+        return self.metrics.get(name) or self.metrics.setdefault(name, Histogram())
+
+    def meter(self, name):
+        return self.metrics.get(name) or self.metrics.setdefault(name, Meter())
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        snapshot = dict((name, metric.snapshot()) for name, metric in self.metrics.items())
+
+        for name, fn in self.gauges.items():
+            try:
+                snapshot[name] = fn()
+            except Exception:
+                snapshot[name] = None
+
+        return snapshot
+
+# snapshot of several named sets of metrics
+def collect(sources):
+    stats = dict((name, metrics.snapshot()) for name, metrics in sources.items())
+    stats['time'] = time.time()
+
+    return stats
+
+# append a snapshot of `sources` to the file at `path` every `interval`
+# seconds, as one json object per line.
+def dumpperiodically(sources, path, interval, onerror):
+    def dump():
+        while 1:
+            time.sleep(interval)
+
+            try:
+                with open(path, 'a') as f:
+                    f.write(json.dumps(collect(sources)) + '\n')
+            except (IOError, OSError) as e:
+                onerror('Failed to write stats to \'{}\'. The error was: {}'.format(path, e))
+
+    thread.start_new_thread(dump, ())
@@ -0,0 +1,312 @@
+import argparse
+import signal
+import socket
+import sys
+import thread
+import time
+
+from client import *
+from server import *
+from chain import *
+from snapshot import *
+from metrics import *
+from ringlog import *
+from mempool import *
+from peers import *
+
+# the chains, client, server and snapshots that make up a node, wired up
+# without any UI. `client_handlers` are the Client's handlers, and
+# `onserverstatus` receives the Server's status messages.
+class Node:
+    def __init__(self, client_handlers, onserverstatus, server_opts={}, compact_chains=False, lazy_chains=False, cache_blocks=DEFAULT_CACHE_BLOCKS, ingest_processes=0, stats_file=None, stats_interval=60, block_max_txs=BLOCK_MAX_TXS, block_max_wait=BLOCK_MAX_WAIT):
+        self.client_handlers = client_handlers
+        self.blockchains = {}
+
+        for k in ['tx', 'tx_cnf', 'blk', 'blk_cnf']:
+            compact = compact_chains and k in COMPACT_BLOCKS
+            self.blockchains[k] = Chain(k, compact=compact, lazy=lazy_chains and not compact, cache_blocks=cache_blocks)
+
+        # the nodes we know about and how well they served us, kept across restarts
+        self.peers = PeerTable('./data/peers.json')
+
+        try:
+            self.peers.load()
+        except (IOError, ValueError) as e:
+            client_handlers['onerror']('Failed to read the peer table in \'{}\'. The error was: {}'.format(self.peers.path, e))
+
+        self.client = Client(
+            self.blockchains['tx'],
+            self.blockchains['tx_cnf'],
+            self.blockchains['blk'],
+            self.blockchains['blk_cnf'],
+            dict(client_handlers, onconnect=self._onconnect, ondisconnect=self._ondisconnect, onsubmittedtx=self._onsubmittedtx),
+            ingest_processes=ingest_processes,
+            peers=self.peers
+        ) # so it can connect to other servers as a client
+
+        # new txs wait in the mempool to be packed into blocks
+        self.mempool = Mempool(self.client.balances)
+        self.blockchains['tx'].addlistener(self.mempool.ontxblock, bulk=lambda blocks: None)
+        self.assembler = BlockAssembler(self.mempool, self.blockchains['tx'], client_handlers['onstatus'], max_txs=block_max_txs, max_wait=block_max_wait)
+
+        self.server = Server(
+            self.blockchains['tx'],
+            self.blockchains['tx_cnf'],
+            self.blockchains['blk'],
+            self.blockchains['blk_cnf'],
+            onstatus=onserverstatus,
+            balances=self.client.balances,
+            accounts=self.client.accounts,
+            mempool=self.mempool,
+            **server_opts
+        )
+
+        # txs taken into the mempool are gossiped to the rest of the network,
+        # and gossip heard over the client or the server is passed on over the other
+        self.mempool.addlistener(self._gossiptx)
+        self.server.addbroadcastlistener(self._onbroadcastfromclient)
+        self.client.addbroadcastlistener(self._onbroadcastfromnode)
+
+        self.server.addstats('client', self.client.metrics)
+        self.server.addstats('peers', self.peers.metrics)
+        self.server.addstats('mempool', self.mempool.metrics)
+        self.server.addstats('assembler', self.assembler.metrics)
+
+        if stats_file is not None:
+            dumpperiodically(self.server.stats_sources, stats_file, stats_interval, onserverstatus)
+
+        self.snapshots = Snapshotter(self.blockchains, {
+            'confirmations': self.client.confirmations,
+            'balances': self.client.balances,
+            'accounts': self.client.accounts
+        })
+
+    def _gossiptx(self, tid, sender, receiver, amt, nonce):
+        msg = {
+            'type': 'tx',
+            'txid': tid,
+            'sender': sender,
+            'receiver': receiver,
+            'amt': amt,
+            'nonce': nonce
+        }
+
+        if self.server.broadcast(msg, tid):
+            self._broadcastupstream(tid, msg)
+
+    # a message broadcast by one of the server's clients, already relayed to the others
+    def _onbroadcastfromclient(self, msgid, msg):
+        self._broadcastupstream(msgid, msg)
+        self._onbroadcast(msgid, msg)
+
+    # a message relayed by the node the client is connected to
+    def _onbroadcastfromnode(self, msgid, msg):
+        if self.server.broadcast(msg, msgid):
+            self._onbroadcast(msgid, msg)
+
+    def _broadcastupstream(self, msgid, msg):
+        if not self.client.is_connected:
+            return
+
+        try:
+            self.client.broadcast(msg, msgid)
+        except socket.error:
+            # the client's reader notices the broken connection
+            pass
+
+    # a node syncing from another one can't add blocks of its own to the tx
+    # chain without forking from it, so while the client is connected the txs
+    # in the pool are packed by the node it's connected to
+    def _onconnect(self):
+        self.assembler.forwardto(self._forwardtx)
+        self.client_handlers['onconnect']()
+
+    def _ondisconnect(self):
+        self.assembler.forwardto(None)
+        self.client_handlers['ondisconnect']()
+
+    # a forwarded tx keeps counting against its sender until it's synced back
+    # from the node. if the node turns it away, so does the mempool, which
+    # tells whoever submitted it; if it never got there, it goes back in the pool.
+    def _forwardtx(self, tid, sender, receiver, amt, nonce):
+        def onreply(obj):
+            # the node usually has the tx already, from its gossip
+            if not obj.get('accepted') and not str(obj.get('reason')).startswith('duplicate'):
+                self.client_handlers['onerror']('The node rejected a forwarded transaction: {}'.format(obj.get('reason')))
+                self.mempool.reject(tid, obj.get('reason'))
+
+        def onfailure(error):
+            self.mempool.requeue(tid)
+
+        try:
+            self.client.submit_transaction(sender, receiver, amt, nonce, onreply, onfailure)
+        except socket.error as e:
+            self.client_handlers['onerror']('Failed to forward a transaction to the node. The error was: {}'.format(e))
+            self.mempool.requeue(tid)
+
+    # the node turns away a tx it accepted earlier when the node it forwarded
+    # the tx to does
+    def _onsubmittedtx(self, accepted, tid, reason):
+        if not accepted and tid is not None:
+            self.mempool.reject(tid, reason)
+
+        if 'onsubmittedtx' in self.client_handlers:
+            self.client_handlers['onsubmittedtx'](accepted, tid, reason)
+
+    def _onbroadcast(self, msgid, msg):
+        # a node that isn't connected to another one packs the txs of
+        # everything connected to it, so the txs gossiped to it go into its pool
+        if msg.get('type') == 'tx' and not self.client.is_connected:
+            try:
+                self.mempool.add(msg.get('sender'), msg.get('receiver'), msg.get('amt'), msg.get('nonce'))
+            except TransactionRejected:
+                pass
+
+    def loadlocal(self, handlers):
+        thread.start_new_thread(self._loadlocal, (handlers,))
+
+    def _loadlocal(self, handlers):
+        # restore the latest snapshot first, so the chains only need to
+        # replay the blocks that were written after it.
+        self.snapshots.restore(handlers)
+
+        for chain in self.blockchains.values():
+            chain.loadlocal(handlers)
+
+        self.snapshots.start(handlers)
+        self.peers.start(handlers)
+
+        # blocks are assembled on top of the local tx chain, so wait for it
+        while not self.blockchains['tx'].local_blocks_loaded:
+            time.sleep(0.1)
+
+        self.assembler.start()
+
+    # stop serving and syncing, and write out what's still pending
+    def shutdown(self, handlers):
+        self.assembler.stop()
+
+        if self.client.is_connected:
+            self.client.disconnect()
+
+        if self.server.is_running:
+            self.server.stop()
+
+        if all(bc.local_blocks_loaded for bc in self.blockchains.values()):
+            try:
+                self.snapshots.save()
+            except (IOError, OSError) as e:
+                handlers['onerror']('Failed to write snapshot. The error was: {}'.format(e))
+
+        for chain in self.blockchains.values():
+            chain.log.close()
+
+        try:
+            self.peers.save()
+        except (IOError, OSError) as e:
+            handlers['onerror']('Failed to write the peer table to \'{}\'. The error was: {}'.format(self.peers.path, e))
+
+def _address(s):
+    host, _, port = s.rpartition(':')
+
+    try:
+        return host or '127.0.0.1', int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected host:port, got {!r}'.format(s))
+
+# runs a node from the command line, for servers without X. status messages go
+# to a bounded, rate limited log (see ringlog.py) that's echoed to stdout.
+def main():
+    parser = argparse.ArgumentParser(description='Headless P2P node')
+    parser.add_argument('--listen', type=_address, default=('127.0.0.1', 8090), help='host:port to serve other nodes on')
+    parser.add_argument('--no-server', action='store_true', help='only sync from --connect, without serving other nodes')
+    parser.add_argument('--connect', type=_address, help='host:port of a node to sync from, unless a known peer has proven faster')
+    parser.add_argument('--peer', type=_address, action='append', default=[], help='host:port of another node to sync from or fail over to (repeatable)')
+    parser.add_argument('--reconnect-interval', type=int, default=10, help='seconds to wait before reconnecting to the best peer')
+    parser.add_argument('--server-mode', choices=SERVER_MODES, default='threaded', help='serve clients with a thread each, or all from one event loop')
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG, help='listen backlog of the server socket')
+    parser.add_argument('--max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS, help='connections beyond this are closed right away')
+    parser.add_argument('--no-compression', action='store_true', help='never compress messages sent to other nodes, e.g. on a fast local network')
+    parser.add_argument('--compact-chains', action='store_true', help='keep the tx and tx_cnf chains in memory as columns instead of block objects')
+    parser.add_argument('--lazy-chains', action='store_true', help='keep only blockids in memory and read blocks from disk when needed (the tx and tx_cnf chains stay compact with --compact-chains)')
+    parser.add_argument('--cache-blocks', type=int, default=DEFAULT_CACHE_BLOCKS, help='blocks a lazy chain keeps decoded in memory')
+    parser.add_argument('--ingest-processes', type=int, default=0, help='validate large batches of synced blocks on this many processes')
+    parser.add_argument('--block-max-txs', type=int, default=BLOCK_MAX_TXS, help='most transactions packed into one block')
+    parser.add_argument('--block-max-wait-ms', type=int, default=int(BLOCK_MAX_WAIT * 1000), help='milliseconds a transaction waits for others to share its block')
+    parser.add_argument('--stats-file', help='append a json snapshot of the node\'s metrics to this file periodically')
+    parser.add_argument('--stats-interval', type=int, default=60, help='seconds between snapshots written to --stats-file')
+    parser.add_argument('--log-capacity', type=int, default=DEFAULT_CAPACITY, help='log lines kept in memory')
+    parser.add_argument('--log-rate', type=float, default=DEFAULT_RATE, help='log lines per second allowed per category')
+    parser.add_argument('--log-burst', type=int, default=DEFAULT_BURST, help='log lines a category may write at once before being limited')
+    parser.add_argument('--quiet', action='store_true', help='keep the log in memory only, instead of echoing it to stdout')
+    args = parser.parse_args()
+
+    log = RingLog(capacity=args.log_capacity, rate=args.log_rate, burst=args.log_burst, out=None if args.quiet else sys.stdout)
+
+    handlers = {
+        'onstatus': log.handler('client'),
+        'onerror': log.handler('error', 'error')
+    }
+
+    connection_lost = [False]
+
+    def ondisconnect():
+        log.log('client', 'Client not connected')
+        connection_lost[0] = True
+
+    def onfailure(e):
+        log.log('client', 'Failed to connect to server: {}'.format(e), 'error')
+        connection_lost[0] = True
+
+    node = Node({
+        'onconnect': lambda: log.log('client', 'Connected to server successfully'),
+        'ondisconnect': ondisconnect,
+        'onfailure': onfailure,
+        'onstatus': handlers['onstatus'],
+        'onerror': handlers['onerror']
+    }, log.handler('server'), server_opts={
+        'mode': args.server_mode,
+        'backlog': args.backlog,
+        'max_connections': args.max_connections,
+        'compressions': () if args.no_compression else COMPRESSIONS
+    }, compact_chains=args.compact_chains, lazy_chains=args.lazy_chains, cache_blocks=args.cache_blocks, ingest_processes=args.ingest_processes, stats_file=args.stats_file, stats_interval=args.stats_interval, block_max_txs=args.block_max_txs, block_max_wait=args.block_max_wait_ms / 1000.0)
+
+    def onterm(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, onterm)
+
+    node.loadlocal(handlers)
+
+    if not args.no_server:
+        node.server.start(*args.listen)
+
+    for address in ([args.connect] if args.connect is not None else []) + args.peer:
+        node.peers.add(address)
+
+    address = node.client.connectbest(args.connect)
+
+    if address is not None:
+        log.log('client', 'Connecting to {}:{}...'.format(*address))
+
+    try:
+        while 1:
+            time.sleep(args.reconnect_interval)
+
+            if connection_lost[0] and not node.client.is_connected:
+                address = node.client.connectbest(args.connect)
+
+                if address is not None:
+                    connection_lost[0] = False
+                    log.log('client', 'Reconnecting to {}:{}...'.format(*address))
+
+    except KeyboardInterrupt:
+        log.log('node', 'Shutting down...')
+
+    # don't let a second signal interrupt the shutdown
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    node.shutdown(handlers)
+
+if __name__ == '__main__':
+    main()
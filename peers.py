@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import thread
+
+from metrics import *
+
+PEER_ALPHA = 0.3 # weight of a new sample in a peer's moving averages
+PEER_DEFAULT_RTT = 1.0 # seconds, assumed for peers whose round trip time hasn't been measured yet
+PEER_DEFAULT_THROUGHPUT = 1000.0 # blocks per second, assumed for peers that haven't been synced from yet
+PEER_SCORE_BLOCKS = 500 # blocks per request a peer's score is figured for
+PEER_MAX_FAILURES = 3 # failures in a row before a peer is passed over
+PEER_RETRY_INTERVAL = 60 # seconds before a peer that was passed over is tried again
+PEER_SWITCH_FACTOR = 4 # how many times better another peer has to score to fail over to it
+MAX_PEERS = 1000 # peers kept in the table; the ones seen least recently go first
+PEERS_SAVE_INTERVAL = 60 # seconds between writing out the table
+
+# (host, port) of a peer given as 'host:port' or [host, port]. raises ValueError
+def parseaddress(peer):
+    if isinstance(peer, basestring):
+        host, _, port = peer.rpartition(':')
+    else:
+        host, port = peer
+
+    if not isinstance(host, basestring) or len(host) == 0:
+        raise ValueError('invalid peer address {!r}'.format(peer))
+
+    return str(host), int(port)
+
+# what's known about a node we can connect to. round trip times come from the
+# client's pings, and throughput (blocks per second) from syncing blocks.
+class Peer:
+    def __init__(self, address):
+        self.address = address
+        self.rtt = None
+        self.throughput = None
+        self.failures = 0 # in a row
+        self.total_failures = 0
+        self.last_seen = None
+        self.last_failure = None
+
+    def healthy(self, now=None):
+        if self.failures < PEER_MAX_FAILURES:
+            return True
+
+        # a loaded state may have failures without the time of the last one
+        return (now or time.time()) - (self.last_failure or 0) > PEER_RETRY_INTERVAL
+
+    # the seconds a request for PEER_SCORE_BLOCKS blocks is expected to take,
+    # and then some for every recent failure. lower is better. a term that
+    # hasn't been measured yet is filled in with its default, so every peer's
+    # score estimates the same thing.
+    def score(self):
+        rtt = self.rtt if self.rtt is not None else PEER_DEFAULT_RTT
+        throughput = self.throughput or PEER_DEFAULT_THROUGHPUT
+
+        return (rtt + PEER_SCORE_BLOCKS / throughput) * (1 + self.failures)
+
+    def measured(self):
+        return self.rtt is not None or self.throughput is not None
+
+    def getstate(self):
+        return {
+            'address': list(self.address),
+            'rtt': self.rtt,
+            'throughput': self.throughput,
+            'failures': self.failures,
+            'total_failures': self.total_failures,
+            'last_seen': self.last_seen,
+            'last_failure': self.last_failure
+        }
+
+    def setstate(self, state):
+        self.rtt = state.get('rtt')
+        self.throughput = state.get('throughput')
+        self.failures = state.get('failures', 0)
+        self.total_failures = state.get('total_failures', 0)
+        self.last_seen = state.get('last_seen')
+        self.last_failure = state.get('last_failure')
+
+def _average(old, new):
+    return new if old is None else (1 - PEER_ALPHA) * old + PEER_ALPHA * new
+
+# the peers a node knows about, with their scores. the client picks the peer
+# to connect to and the peers to sync from by score, passing over peers that
+# keep failing until they've had PEER_RETRY_INTERVAL seconds to recover.
+#
+# the table is kept in a json file at `path`, so a restarted node remembers
+# which peers served it well.
+class PeerTable:
+    def __init__(self, path=None):
+        self.path = path
+        self.peers = {} # (host, port) -> Peer
+        self.lock = thread.allocate_lock()
+
+        self.metrics = Metrics()
+        self.metrics.gauge('known', lambda: len(self.peers))
+        self.metrics.gauge('healthy', lambda: len(self.best()))
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __contains__(self, address):
+        return address in self.peers
+
+    def get(self, address):
+        return self.peers.get(address)
+
+    def add(self, address):
+        with self.lock:
+            self._peer(address)
+
+    def recordrtt(self, address, rtt):
+        with self.lock:
+            peer = self._peer(address)
+            peer.rtt = _average(peer.rtt, rtt)
+            self._succeeded(peer)
+
+    # `blocks` blocks were synced from the peer in `seconds`
+    def recordsync(self, address, blocks, seconds):
+        with self.lock:
+            peer = self._peer(address)
+
+            if blocks != 0 and seconds > 0:
+                peer.throughput = _average(peer.throughput, blocks / seconds)
+
+            self._succeeded(peer)
+
+    def recordfailure(self, address):
+        with self.lock:
+            peer = self._peer(address)
+            peer.failures += 1
+            peer.total_failures += 1
+            peer.last_failure = time.time()
+
+        self.metrics.counter('failures').inc()
+
+    def healthy(self, address):
+        peer = self.peers.get(address)
+        return peer is None or peer.healthy()
+
+    # addresses of the `n` (or all) healthy peers with the best scores, best first
+    def best(self, n=None, exclude=()):
+        now = time.time()
+
+        with self.lock:
+            peers = [peer for peer in self.peers.itervalues() if peer.address not in exclude and peer.healthy(now)]
+
+        peers.sort(key=lambda peer: peer.score())
+
+        return [peer.address for peer in peers[:n]]
+
+    # a healthy peer scoring so much better than the one at `address` that
+    # it's worth switching to, if there is one
+    def better(self, address):
+        current = self.peers.get(address)
+        candidates = self.best(1, exclude=(address,))
+
+        if current is None or len(candidates) == 0:
+            return None
+
+        other = self.peers[candidates[0]]
+
+        if not current.healthy() or (other.measured() and other.score() * PEER_SWITCH_FACTOR < current.score()):
+            return other.address
+
+        return None
+
+    # write the table out every `interval` seconds
+    def start(self, handlers, interval=PEERS_SAVE_INTERVAL):
+        thread.start_new_thread(self._saveloop, (handlers, interval))
+
+    def _saveloop(self, handlers, interval):
+        while 1:
+            time.sleep(interval)
+
+            try:
+                self.save()
+            except (IOError, OSError) as e:
+                handlers['onerror']('Failed to write the peer table to \'{}\'. The error was: {}'.format(self.path, e))
+
+    def load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+
+        with open(self.path) as f:
+            states = json.load(f)
+
+        with self.lock:
+            for state in states:
+                try:
+                    self._peer(parseaddress(state['address'])).setstate(state)
+                except (KeyError, TypeError, ValueError):
+                    continue
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self.lock:
+            states = [peer.getstate() for peer in self.peers.itervalues()]
+
+        tmpname = self.path + '.tmp'
+
+        with open(tmpname, 'w') as f:
+            json.dump(states, f, indent=1)
+
+        os.rename(tmpname, self.path)
+
+    # the caller holds the lock
+    def _peer(self, address):
+        peer = self.peers.get(address)
+
+        if peer is None:
+            peer = self.peers[address] = Peer(address)
+
+            if len(self.peers) > MAX_PEERS:
+                oldest = min((p for p in self.peers.itervalues() if p is not peer), key=lambda p: p.last_seen or 0)
+                del self.peers[oldest.address]
+
+        return peer
+
+    def _succeeded(self, peer):
+        peer.failures = 0
+        peer.last_seen = time.time()
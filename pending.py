@@ -0,0 +1,117 @@
+import thread
+import threading
+import time
+from collections import OrderedDict
+
+from protocol import *
+
+REQUEST_TIMEOUT = 30 # seconds to wait for a reply before failing a request
+
+# a request sent to the node. it's completed by its reply, or failed when it
+# times out or the connection is lost. the callbacks run on the thread that
+# completes the request (the socket reader for replies), so they shouldn't
+# block on other requests. other threads can block on wait() instead.
+class Request:
+    def __init__(self, reqid, msg, reply_type, onreply, onfailure, timeout):
+        self.id = reqid
+        self.type = msg['type']
+        self.key = msg.get('bc') # chain the request is about, if any
+        self.reply_type = reply_type
+        self.onreply = onreply
+        self.onfailure = onfailure
+        self.sent = time.time()
+        self.deadline = self.sent + timeout
+
+        self.reply = None
+        self.error = None
+        self.finished = threading.Event()
+
+    def succeed(self, reply):
+        self.reply = reply
+        self.finished.set()
+
+        if self.onreply is not None:
+            self.onreply(reply)
+
+    def fail(self, error):
+        self.error = error
+        self.finished.set()
+
+        if self.onfailure is not None:
+            self.onfailure(error)
+
+    # the reply, once there is one. raises RequestFailed if the request failed
+    # or no reply came within `timeout` seconds.
+    def wait(self, timeout=None):
+        if not self.finished.wait(timeout):
+            raise RequestFailed('no reply to \'{}\' yet'.format(self.type))
+
+        if self.error is not None:
+            raise RequestFailed(self.error)
+
+        return self.reply
+
+# the requests sent on a connection that are still waiting for a reply.
+#
+# every request gets an id that the node echoes in its reply, so replies can
+# complete their requests in any order, and several requests (e.g. one per
+# chain) can be in flight on one connection. nodes that don't echo ids answer
+# a connection's requests in order, so an untagged reply completes the oldest
+# request waiting for a reply of its type.
+class PendingRequests:
+    def __init__(self, timeout=REQUEST_TIMEOUT):
+        self.timeout = timeout
+        self.requests = OrderedDict() # id -> Request, oldest first
+        self.nextid = 1
+        self.lock = thread.allocate_lock()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, msg, reply_type, onreply=None, onfailure=None, timeout=None):
+        with self.lock:
+            request = Request(self.nextid, msg, reply_type, onreply, onfailure, timeout or self.timeout)
+            self.requests[request.id] = request
+            self.nextid += 1
+
+        return request
+
+    # take the request `reply` answers off the table. returns None for replies
+    # nobody is waiting for: unsolicited messages, and late replies to requests
+    # that already failed.
+    def match(self, reply):
+        with self.lock:
+            reqid = reply.get('id')
+
+            if reqid is None:
+                reqid = next((r.id for r in self.requests.itervalues() if r.reply_type == reply.get('type')), None)
+
+            return self.requests.pop(reqid, None)
+
+    # number of requests in flight, optionally only those of a type or about a chain
+    def outstanding(self, msg_type=None, key=None):
+        with self.lock:
+            return sum(1 for r in self.requests.itervalues() if (msg_type is None or r.type == msg_type) and (key is None or r.key == key))
+
+    # fail the requests whose deadline has passed, and return them
+    def expire(self):
+        now = time.time()
+
+        with self.lock:
+            expired = [r for r in self.requests.itervalues() if r.deadline < now]
+
+            for request in expired:
+                del self.requests[request.id]
+
+        for request in expired:
+            request.fail('no reply to \'{}\' within {}s'.format(request.type, int(request.deadline - request.sent)))
+
+        return expired
+
+    def failall(self, error):
+        with self.lock:
+            failed = self.requests.values()
+            self.requests.clear()
+
+        for request in failed:
+            request.fail(error)
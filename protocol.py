@@ -0,0 +1,154 @@
+import struct
+import json
+
+from codec import *
+from compression import *
+
+# note: these can't live in exceptions.py, which python 2 shadows with the
+# builtin `exceptions` module.
+class InvalidMessage(Exception):
+    def __init__(self, msg):
+        self.msg = "Invalid message: {}".format(msg)
+
+    def __str__(self):
+        return self.msg
+
+class FrameError(Exception):
+    def __init__(self, msg):
+        self.msg = "Invalid frame: {}".format(msg)
+
+    def __str__(self):
+        return self.msg
+
+class RequestFailed(Exception):
+    def __init__(self, msg):
+        self.msg = "Request failed: {}".format(msg)
+
+    def __str__(self):
+        return self.msg
+
+FRAME_HEADER = struct.Struct('>I') # payload length
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# frames normally hold a json message. a frame starting with BINARY_MARKER
+# holds a length-prefixed json header followed by binary encoded blocks, which
+# are decoded into the header's 'blocks'. either may be compressed (see
+# compression.py), in which case the frame starts with a compression marker.
+BINARY_MARKER = '\x00'
+
+def encodeframe(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def sendmessage(sock, obj):
+    sock.sendall(encodeframe(json.dumps(obj)))
+
+# send an already encoded message
+def sendframe(sock, payload):
+    sock.sendall(encodeframe(payload))
+
+def encodebinarymessage(header, encodedblocks):
+    header = json.dumps(header)
+    return BINARY_MARKER + DATA_LEN.pack(len(header)) + header + encodeblocks(encodedblocks)
+
+# add the request id `reqid` to an already encoded reply, so the client can
+# tell which request it answers. replies to untagged requests are left as is.
+def tagmessage(payload, reqid):
+    if reqid is None:
+        return payload
+
+    if payload[:1] != BINARY_MARKER:
+        return '{"id": ' + json.dumps(reqid) + ', ' + payload[1:]
+
+    n = DATA_LEN.unpack_from(payload, 1)[0]
+    header = json.loads(payload[1 + DATA_LEN.size:1 + DATA_LEN.size + n])
+    header['id'] = reqid
+    header = json.dumps(header)
+
+    return BINARY_MARKER + DATA_LEN.pack(len(header)) + header + payload[1 + DATA_LEN.size + n:]
+
+def decodemessage(frame, max_size=MAX_FRAME_SIZE):
+    data = frame.tobytes()
+
+    try:
+        if iscompressed(data):
+            data = decompress(data, max_size)
+
+        if data[:1] != BINARY_MARKER:
+            return json.loads(data)
+
+        n = DATA_LEN.unpack_from(data, 1)[0]
+        obj = json.loads(data[1 + DATA_LEN.size:1 + DATA_LEN.size + n])
+        obj['blocks'] = decodeblocks(data, 1 + DATA_LEN.size + n)
+
+        return obj
+    except (ValueError, struct.error):
+        raise InvalidMessage(data[:1024])
+
+# splits a socket's byte stream into length-prefixed frames. data is received
+# straight into a reusable buffer, and frames are handed out as memoryview
+# slices of it, so they are only valid until the next call to recv().
+class FrameReader:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, bufsize=64 * 1024):
+        self.max_frame_size = max_frame_size
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = 0 # start of unconsumed data
+        self.end = 0 # end of received data
+        self.needed = 0 # bytes needed to complete the frame at self.start
+
+    # returns the list of frames completed by this read, or None once the
+    # peer has closed the connection.
+    def recv(self, sock):
+        self._reserve(max(self.needed, FRAME_HEADER.size))
+
+        n = sock.recv_into(self.view[self.end:])
+
+        if n == 0:
+            return None
+
+        self.end += n
+
+        return self._frames()
+
+    def _frames(self):
+        frames = []
+
+        while self.end - self.start >= FRAME_HEADER.size:
+            length = FRAME_HEADER.unpack_from(self.buf, self.start)[0]
+
+            if length > self.max_frame_size:
+                raise FrameError('frame of {} bytes exceeds the maximum of {} bytes'.format(length, self.max_frame_size))
+
+            framestart = self.start + FRAME_HEADER.size
+
+            if self.end - framestart < length:
+                self.needed = FRAME_HEADER.size + length
+                return frames
+
+            frames.append(self.view[framestart:framestart + length])
+            self.start = framestart + length
+
+        self.needed = 0
+
+        return frames
+
+    # make sure a frame of `size` bytes starting at self.start fits in the
+    # buffer, with room left to receive into.
+    def _reserve(self, size):
+        pending = self.end - self.start
+
+        if self.start + size <= len(self.buf) and self.end < len(self.buf):
+            return
+
+        if size < len(self.buf):
+            # move the partial frame to the front of the buffer
+            self.buf[:pending] = self.buf[self.start:self.end]
+        else:
+            buf = bytearray(max(size + 1, len(self.buf) * 2))
+            buf[:pending] = self.buf[self.start:self.end]
+
+            self.buf = buf
+            self.view = memoryview(buf)
+
+        self.start = 0
+        self.end = pending
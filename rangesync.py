@@ -0,0 +1,210 @@
+import socket
+import thread
+import threading
+import time
+
+from protocol import *
+
+SYNC_CHUNK_SIZE = 500 # blocks per range handed to a peer
+SYNC_MAX_PEERS = 4
+SYNC_TIMEOUT = 10 # seconds a peer gets to answer a single request
+SYNC_SLOW_AFTER = 15 # seconds after which an idle peer also takes over a range
+
+# pages hold json objects or, with the binary codec, decoded blocks
+def _blockid(block):
+    return block['blockid'] if isinstance(block, dict) else block.blockid
+
+# downloads the blocks after `after` up to and including `tip` for one chain,
+# by splitting the range into chunks and fetching them concurrently from
+# several peers. chunks are handed back to the client in order as they become
+# contiguous, so blocks still go through the usual parent linkage checks.
+# chunks from failed peers go back in the queue, and ranges that are taking
+# too long are fetched again by whichever peer becomes idle first.
+#
+# each peer's throughput and failures go into `peertable` (see peers.py), if given.
+class RangeSync:
+    def __init__(self, bc, peers, after, tip, onchunk, ondone, chunk_size=SYNC_CHUNK_SIZE, max_frame_size=MAX_FRAME_SIZE, peertable=None):
+        self.bc = bc
+        self.peers = peers[:SYNC_MAX_PEERS]
+        self.peertable = peertable
+        self.onchunk = onchunk # called with each run of serialized blocks, in order; returns False to stop
+        self.ondone = ondone # called with the blockid synced up to, and whether the whole range was synced
+        self.max_frame_size = max_frame_size
+
+        self.chunks = [(lo, min(chunk_size, tip - lo)) for lo in xrange(after, tip, chunk_size)]
+        self.queue = list(self.chunks) # chunks nobody is working on
+        self.inflight = {} # chunk -> time it was handed out
+        self.results = {} # chunk lo -> blocks, for fetched chunks not yet applied
+        self.remaining = set(lo for lo, count in self.chunks) # chunks not yet fetched
+        self.next = 0 # index in self.chunks of the next chunk to apply
+        self.workers = 0
+        self.failed = False
+        self.cond = threading.Condition()
+
+    def start(self):
+        with self.cond:
+            self.workers = len(self.peers)
+
+        for peer in self.peers:
+            thread.start_new_thread(self._worker, (peer,))
+
+        thread.start_new_thread(self._assemble, ())
+
+    def _assemble(self):
+        synced = self.chunks[0][0] if len(self.chunks) != 0 else None
+
+        while self.next < len(self.chunks):
+            with self.cond:
+                lo = self.chunks[self.next][0]
+
+                while lo not in self.results and self.workers != 0:
+                    self.cond.wait(1)
+
+                if lo not in self.results:
+                    break
+
+                blocks = self.results.pop(lo)
+
+            # a chain that can't take the blocks (e.g. its log failed) ends the
+            # sync like a bad block does, so ondone still gets to reset it
+            try:
+                if not self.onchunk(blocks):
+                    break
+            except Exception:
+                break
+
+            synced = _blockid(blocks[-1])
+            self.next += 1
+
+        with self.cond:
+            self.failed = self.next < len(self.chunks)
+            self.cond.notify_all()
+
+        self.ondone(synced, not self.failed)
+
+    def _take(self):
+        with self.cond:
+            if len(self.queue) != 0:
+                chunk = self.queue.pop(0)
+            else:
+                # nothing left to hand out, so help with the oldest slow range
+                now = time.time()
+                slow = [(started, chunk) for chunk, started in self.inflight.iteritems() if now - started > SYNC_SLOW_AFTER]
+
+                if len(slow) == 0:
+                    return None
+
+                chunk = min(slow)[1]
+
+            self.inflight[chunk] = time.time()
+            return chunk
+
+    def _done(self):
+        with self.cond:
+            return self.failed or self.next == len(self.chunks)
+
+    def _worker(self, peer):
+        sock = None
+
+        try:
+            sock = socket.create_connection(peer, SYNC_TIMEOUT)
+            reader = FrameReader(self.max_frame_size)
+
+            # the server handles messages in order, so there's no need to wait
+            # for its answer before fetching
+            sendmessage(sock, {
+                'type': 'hello',
+                'codecs': list(CODECS),
+                'compressions': list(COMPRESSIONS)
+            })
+
+            while not self._done():
+                chunk = self._take()
+
+                if chunk is None:
+                    with self.cond:
+                        if len(self.inflight) == 0 and len(self.queue) == 0:
+                            break
+                        self.cond.wait(1)
+
+                    # the server drops clients that go quiet (see
+                    # CLIENT_TIMEOUT), so keep the connection up for taking
+                    # over a slow range. the pongs are skipped by _awaitpage.
+                    sendmessage(sock, {'type': 'ping'})
+                    continue
+
+                started = time.time()
+
+                try:
+                    blocks = self._fetch(sock, reader, chunk)
+                except Exception:
+                    # give the range back to the other peers, and stop using this one
+                    with self.cond:
+                        self.inflight.pop(chunk, None)
+
+                        if chunk[0] in self.remaining and chunk not in self.queue and chunk not in self.inflight:
+                            self.queue.append(chunk)
+
+                        self.cond.notify_all()
+                    raise
+
+                if self.peertable is not None:
+                    self.peertable.recordsync(peer, len(blocks), time.time() - started)
+
+                with self.cond:
+                    self.inflight.pop(chunk, None)
+
+                    # a slow range may have been fetched twice; keep the first
+                    if chunk[0] in self.remaining:
+                        self.remaining.discard(chunk[0])
+                        self.results[chunk[0]] = blocks
+
+                    self.cond.notify_all()
+
+        except Exception:
+            if self.peertable is not None:
+                self.peertable.recordfailure(peer)
+
+        finally:
+            if sock is not None:
+                sock.close()
+
+            with self.cond:
+                self.workers -= 1
+                self.cond.notify_all()
+
+    # fetch the `count` blocks after `lo`, following the server's pages.
+    def _fetch(self, sock, reader, chunk):
+        lo, count = chunk
+        blocks = []
+
+        while len(blocks) < count:
+            sendmessage(sock, {
+                'type': 'fetchblocks',
+                'blockidgt': _blockid(blocks[-1]) if len(blocks) != 0 else lo,
+                'limit': count - len(blocks),
+                'bc': self.bc.key
+            })
+
+            page = self._awaitpage(sock, reader)
+
+            if len(page['blocks']) == 0:
+                raise InvalidMessage('peer does not have blocks after {}'.format(lo))
+
+            blocks.extend(page['blocks'])
+
+        return blocks[:count]
+
+    def _awaitpage(self, sock, reader):
+        while 1:
+            frames = reader.recv(sock)
+
+            if frames is None:
+                raise socket.error('connection closed')
+
+            for frame in frames:
+                obj = decodemessage(frame, self.max_frame_size)
+
+                if obj.get('type') == 'retrieveblocks' and obj.get('bc') == self.bc.key:
+                    # one request is outstanding at a time, so this is the only frame
+                    return obj
@@ -0,0 +1,125 @@
+import re
+import sys
+import thread
+import time
+import datetime
+from collections import deque
+
+DEFAULT_CAPACITY = 1000 # lines kept in memory
+DEFAULT_RATE = 5.0 # lines per second per category, on average
+DEFAULT_BURST = 20 # lines a category may log at once before being limited
+COALESCE_WINDOW = 5 # seconds similar messages are folded into one line
+
+# messages that only differ in numbers are considered similar
+def _template(message):
+    return re.sub(r'\d+', '#', message)
+
+# a bounded in-memory log for status messages coming in from many threads.
+#
+# - only the last `capacity` lines are kept
+# - messages similar to one logged in the last COALESCE_WINDOW seconds (in
+#   the same category) are counted instead of logged, and summed up in one
+#   line once the window has passed
+# - every category is rate limited with a token bucket, and the number of
+#   dropped lines is logged once the category is allowed to log again
+#
+# lines are also written to `out` as they are logged, if given.
+class RingLog:
+    def __init__(self, capacity=DEFAULT_CAPACITY, rate=DEFAULT_RATE, burst=DEFAULT_BURST, out=sys.stdout):
+        self.lines = deque(maxlen=capacity)
+        self.rate = rate
+        self.burst = burst
+        self.out = out
+
+        self.buckets = {} # category -> [tokens, time of last refill]
+        self.dropped = {} # category -> lines dropped by the rate limit
+        self.recent = {} # (category, template) -> [latest message, times seen since, window start]
+        self.lock = thread.allocate_lock()
+
+        thread.start_new_thread(self._flushloop, ())
+
+    # a handler for `category`, for the handlers dicts of Client, Server and Chain
+    def handler(self, category, level='info'):
+        return lambda message, timeout=None: self.log(category, message, level)
+
+    def log(self, category, message, level='info'):
+        # lines are kept as utf-8, as decoded tx and account strings are unicode
+        message = message.encode('utf-8') if isinstance(message, unicode) else str(message)
+        key = (category, _template(message))
+        now = time.time()
+
+        with self.lock:
+            recent = self.recent.get(key)
+
+            if recent is not None and now - recent[2] < COALESCE_WINDOW:
+                recent[0] = message
+                recent[1] += 1
+                return
+
+            if recent is not None:
+                self._summarize(key, recent, now)
+
+            self.recent[key] = [message, 0, now]
+
+            if self._allow(category, now):
+                self._write(now, category, level, message)
+
+    # the last `n` lines (all of them if None), oldest first
+    def tail(self, n=None):
+        with self.lock:
+            lines = list(self.lines)
+
+        return lines if n is None else lines[-n:]
+
+    def _allow(self, category, now):
+        bucket = self.buckets.get(category)
+
+        if bucket is None:
+            bucket = self.buckets[category] = [self.burst, now]
+
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+        if bucket[0] < 1:
+            self.dropped[category] = self.dropped.get(category, 0) + 1
+            return False
+
+        bucket[0] -= 1
+
+        dropped = self.dropped.pop(category, 0)
+
+        if dropped != 0:
+            self._write(now, category, 'warning', '{} messages were dropped by the rate limit'.format(dropped))
+
+        return True
+
+    def _summarize(self, key, recent, now):
+        message, count, started = recent
+
+        if count != 0:
+            self._write(now, key[0], 'info', '{} (and {} similar messages in {:.0f}s)'.format(message, count, now - started))
+
+    def _write(self, now, category, level, message):
+        line = '{} [{}] {}{}'.format(datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S'), category, '' if level == 'info' else level.upper() + ': ', message)
+
+        self.lines.append(line)
+
+        if self.out is not None:
+            try:
+                self.out.write(line + '\n')
+                self.out.flush()
+            except (IOError, ValueError):
+                pass
+
+    # sum up coalesced messages whose window has passed, even if no similar
+    # message comes along to trigger it, and forget about them
+    def _flushloop(self):
+        while 1:
+            time.sleep(COALESCE_WINDOW)
+            now = time.time()
+
+            with self.lock:
+                for key, recent in self.recent.items():
+                    if now - recent[2] >= COALESCE_WINDOW:
+                        self._summarize(key, recent, now)
+                        del self.recent[key]
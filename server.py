@@ -1,25 +1,142 @@
 import socket
+import select
+import errno
 import thread
+import Queue
+import os
 import json
 import time
 import datetime
 
 from client import InvalidMessage
 from chain import *
+from index import *
+from protocol import *
+from cache import *
+from metrics import *
+from forks import MAX_HEADER_PROBES
+from mempool import TransactionRejected
+from gossip import *
+
+FETCH_PAGE_SIZE = 500 # blocks per page, unless the client asks for fewer
+FETCH_PAGE_BYTES = 1024 * 1024
+HISTORY_PAGE_SIZE = 100 # txs per page of an account's history, unless the client asks for fewer
+
+SERVER_MODES = ('threaded', 'evented')
+DEFAULT_BACKLOG = 128
+DEFAULT_MAX_CONNECTIONS = 1024
+CLIENT_TIMEOUT = 2 # clients ping every second, so this many idle seconds means they're gone
+
+SUBSCRIBE_MODES = ('tip', 'blocks')
+ANNOUNCE_MAX_BLOCKS = 100 # bigger bursts are announced as just the tip, for the client to fetch
+ANNOUNCE_BATCH_WAIT = 0.02 # seconds to let a burst of blocks gather into one announcement
+
+# messages pushed to a client (announcements, broadcasts) are dropped rather
+# than wait for a client that has this much queued up already. replies wait.
+SEND_QUEUE_SIZE = 256 # frames, in threaded mode
+SEND_BUFFER_BYTES = 4 * 1024 * 1024 # bytes, in evented mode
+
+# message types the server answers; metrics for anything else are kept under 'unknown'
+MESSAGE_TYPES = ('hello', 'ping', 'listclients', 'subscribe', 'latestblock', 'headers', 'fetchblocks', 'balance', 'accounthistory', 'submittx', 'broadcast', 'stats')
+
+# a client connection served by the event loop. replies are queued by
+# sendall() and written out by the loop as the socket becomes writable, so
+# respond_to_command can treat it just like a blocking socket.
+class Connection:
+    def __init__(self, sock, address, max_frame_size):
+        self.socket = sock
+        self.fd = sock.fileno() # kept, since a closed socket no longer has one
+        self.address = address
+        self.reader = FrameReader(max_frame_size)
+        self.outbuf = bytearray()
+        self.lastseen = time.time()
+
+    def fileno(self):
+        return self.fd
+
+    def sendall(self, data):
+        if len(self.outbuf) == 0:
+            # try to send right away, and only queue what doesn't fit
+            try:
+                data = data[self.socket.send(data):]
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+        self.outbuf += data
+
+    def flush(self):
+        try:
+            n = self.socket.send(self.outbuf)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            return
+
+        del self.outbuf[:n]
 
 class Server:
-    def __init__(self, tx_chain, tx_cnf_chain, blk_chain, blk_cnf_chain, onstatus):
+    def __init__(self, tx_chain, tx_cnf_chain, blk_chain, blk_cnf_chain, onstatus, max_frame_size=MAX_FRAME_SIZE, mode='threaded', backlog=DEFAULT_BACKLOG, max_connections=DEFAULT_MAX_CONNECTIONS, cache_bytes=DEFAULT_CACHE_BYTES, balances=None, accounts=None, compressions=COMPRESSIONS, mempool=None):
+        assert mode in SERVER_MODES, "mode should be one of {}".format(', '.join(SERVER_MODES))
+
         self.onstatus = onstatus
+        self.max_frame_size = max_frame_size
+        self.mode = mode
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.offered_compressions = compressions # in order of preference
 
         self.tx_chain = tx_chain
         self.tx_cnf_chain = tx_cnf_chain
         self.blk_chain = blk_chain
         self.blk_cnf_chain = blk_cnf_chain
 
+        self.cache = EncodedBlockCache([tx_chain, tx_cnf_chain, blk_chain, blk_cnf_chain], cache_bytes)
+
+        # indexes for account queries, normally shared with the node's client.
+        # a server of its own doesn't mine, so its confirmations aren't queued
+        self.balances = balances or BalanceIndex(tx_chain, ConfirmationIndex(tx_chain, tx_cnf_chain, mining=False))
+        self.accounts = accounts or AccountIndex(tx_chain)
+
+        # txs submitted by clients go here, if the node assembles blocks
+        self.mempool = mempool
+
         self.socket = None
         self.clients = {}
+        self.codecs = {} # client socket -> codec negotiated in its 'hello'
+        self.compressions = {} # client socket -> compression negotiated in its 'hello', if any
+        self.subscriptions = {} # client socket -> (set of chain keys, mode)
+        self.outboxes = {} # client socket -> Queue of frames for its writer (threaded mode)
+        self.announcements = Queue.Queue() # (chain, block) appended since the last announcement
+        self.pushes = [] # (connection, frame, droppable) sent from other threads, for the event loop to write
+        self.seen = SeenMessages() # ids of broadcast messages already relayed
+        self.broadcastlisteners = []
+        self.pushlock = thread.allocate_lock()
+        self.wakeup = None # pipe for waking up the event loop
+        self.loop_thread = None
         self.is_running = False
 
+        self.metrics = Metrics()
+        self.metrics.gauge('clients', lambda: len(self.clients))
+        self.metrics.gauge('subscribers', lambda: len(self.subscriptions))
+        self.metrics.gauge('queued_frames', lambda: sum(outbox.qsize() for outbox in self.outboxes.values()))
+        self.metrics.gauge('cache', lambda: {
+            'hits': self.cache.hits,
+            'misses': self.cache.misses,
+            'bytes': self.cache.size
+        })
+
+        # metrics included in the reply to 'stats'
+        self.stats_sources = {
+            'server': self.metrics
+        }
+
+        for bc in [tx_chain, tx_cnf_chain, blk_chain, blk_cnf_chain]:
+            self.stats_sources['chain.{}'.format(bc.key)] = bc.metrics
+
+        for bc in [tx_chain, tx_cnf_chain, blk_chain, blk_cnf_chain]:
+            bc.addlistener(self._onappend, bulk=lambda blocks: None)
+
     def start(self, address, port):
         assert not self.is_running
 
@@ -27,13 +144,20 @@ class Server:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.socket.bind((address, port))
-            self.socket.listen(5)
-
-            thread.start_new_thread(self.listen_for_connections, ())
+            self.socket.listen(self.backlog)
 
             self.is_running = True
 
-            self.onstatus("Server is running")
+            if self.mode == 'evented':
+                self.socket.setblocking(0)
+                self.wakeup = os.pipe()
+                thread.start_new_thread(self.run_event_loop, ())
+            else:
+                thread.start_new_thread(self.listen_for_connections, ())
+
+            thread.start_new_thread(self.announce_new_blocks, ())
+
+            self.onstatus("Server is running ({} mode)".format(self.mode))
         except Exception as e:
             self.onstatus("Failed to start server; Consider restarting the application. The error message was: {}".format(e))
 
@@ -51,19 +175,39 @@ class Server:
     def add_client(self, client_socket, client_address):
         assert self.is_running
 
+        outbox = Queue.Queue(SEND_QUEUE_SIZE)
+
         self.clients["%s:%s" % client_address] = client_socket
+        self.outboxes[client_socket] = outbox
         thread.start_new_thread(self.handle_client_messages, (client_socket, client_address))
+        thread.start_new_thread(self._writeloop, (client_socket, outbox))
         # self.onstatus("Server is running ({} active connections)".format(len(self.clients)))
 
     def remove_client(self, client_socket, client_address):
-        del self.clients["%s:%s" % client_address]
+        self.clients.pop("%s:%s" % client_address, None)
+        self.codecs.pop(client_socket, None)
+        self.compressions.pop(client_socket, None)
+        self.subscriptions.pop(client_socket, None)
+        outbox = self.outboxes.pop(client_socket, None)
+
+        if outbox is not None:
+            try:
+                outbox.put_nowait(None)
+            except Queue.Full:
+                # the writer notices it's been removed once it's done with the queue
+                pass
         # self.onstatus("Server is running ({} active connections)".format(len(self.clients)))
 
     def listen_for_connections(self):
         while self.is_running:
             try:
                 client_socket, client_address = self.socket.accept()
-                client_socket.settimeout(2)
+
+                if len(self.clients) >= self.max_connections:
+                    client_socket.close()
+                    continue
+
+                client_socket.settimeout(CLIENT_TIMEOUT)
                 self.add_client(client_socket, client_address)
             except:
                 break
@@ -71,6 +215,127 @@ class Server:
         if self.is_running:
             self.stop()
 
+    # serve every client from this one thread, polling the listening socket
+    # and all client sockets, instead of a thread per client.
+    def run_event_loop(self):
+        listen_socket = self.socket
+        wakeup_fd = self.wakeup[0]
+        poller = select.poll()
+        poller.register(listen_socket, select.POLLIN)
+        poller.register(wakeup_fd, select.POLLIN)
+        conns = {}
+
+        self.loop_thread = thread.get_ident()
+
+        while self.is_running:
+            try:
+                events = poller.poll(500)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                break
+
+            for fd, ev in events:
+                if fd == listen_socket.fileno():
+                    self._acceptall(listen_socket, poller, conns)
+                    continue
+
+                if fd == wakeup_fd:
+                    os.read(wakeup_fd, 4096)
+                    self._writepushes(poller, conns)
+                    continue
+
+                conn = conns.get(fd)
+
+                if conn is None:
+                    continue
+
+                try:
+                    if ev & (select.POLLERR | select.POLLNVAL):
+                        raise socket.error('connection error')
+
+                    if ev & (select.POLLIN | select.POLLHUP):
+                        frames = conn.reader.recv(conn.socket)
+
+                        if frames is None:
+                            raise socket.error('connection closed')
+
+                        conn.lastseen = time.time()
+
+                        for frame in frames:
+                            self._handlemessage(conn, frame)
+
+                    if len(conn.outbuf) != 0:
+                        conn.flush()
+
+                    poller.modify(fd, select.POLLIN | (select.POLLOUT if len(conn.outbuf) != 0 else 0))
+
+                except Exception, e:
+                    self._closeconnection(conn, poller, conns)
+
+            now = time.time()
+
+            for conn in conns.values():
+                if now - conn.lastseen > CLIENT_TIMEOUT:
+                    self._closeconnection(conn, poller, conns)
+
+        for conn in conns.values():
+            self._closeconnection(conn, poller, conns)
+
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+
+        if self.is_running:
+            self.stop()
+
+    # queue frames sent from other threads on their connections
+    def _writepushes(self, poller, conns):
+        with self.pushlock:
+            pushes = self.pushes
+            self.pushes = []
+
+        for conn, frame, droppable in pushes:
+            if conns.get(conn.fileno()) is not conn:
+                continue
+
+            if droppable and len(conn.outbuf) > SEND_BUFFER_BYTES:
+                self.metrics.counter('dropped_frames').inc()
+                continue
+
+            try:
+                conn.sendall(frame)
+                poller.modify(conn.fileno(), select.POLLIN | (select.POLLOUT if len(conn.outbuf) != 0 else 0))
+            except Exception:
+                self._closeconnection(conn, poller, conns)
+
+    def _acceptall(self, listen_socket, poller, conns):
+        while 1:
+            try:
+                client_socket, client_address = listen_socket.accept()
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.onstatus("Failed to accept connection: {}".format(e))
+                return
+
+            if len(conns) >= self.max_connections:
+                client_socket.close()
+                continue
+
+            client_socket.setblocking(0)
+
+            conn = Connection(client_socket, client_address, self.max_frame_size)
+            conns[conn.fileno()] = conn
+            self.clients["%s:%s" % client_address] = conn
+            poller.register(conn.fileno(), select.POLLIN)
+
+    def _closeconnection(self, conn, poller, conns):
+        fd = conn.fileno()
+
+        poller.unregister(fd)
+        del conns[fd]
+        conn.socket.close()
+        self.remove_client(conn, conn.address)
+
     def _getblockchain(self, msg):
         assert type(msg) == dict
 
@@ -79,7 +344,7 @@ class Server:
 
         if msg['bc'] == 'tx':
             return self.tx_chain
-        elif msg['bc'] == 'tx_cnf_chain':
+        elif msg['bc'] == 'tx_cnf':
             return self.tx_cnf_chain
         elif msg['bc'] == 'blk':
             return self.blk_chain
@@ -88,18 +353,93 @@ class Server:
         else:
             raise InvalidMessage('not a valid blockchain type')
 
+    # register fn(msgid, msg) to be called for every new message broadcast by
+    # a client, after it's been relayed to the other clients
+    def addbroadcastlistener(self, fn):
+        self.broadcastlisteners.append(fn)
+
+    # include another set of metrics (e.g. the node's client) in 'stats' replies
+    def addstats(self, name, metrics):
+        self.stats_sources[name] = metrics
+
+    def _handlemessage(self, client_socket, frame):
+        started = time.time()
+        msg_type = None
+        obj = None
+
+        self.metrics.counter('bytes_in').inc(FRAME_HEADER.size + len(frame))
+
+        try:
+            obj = decodemessage(frame, self.max_frame_size)
+            msg_type = obj.get('type') if isinstance(obj, dict) else None
+
+            self.respond_to_command(client_socket, obj)
+        except InvalidMessage, e:
+            self.metrics.counter('invalid_messages').inc()
+            self.onstatus(str(e))
+
+            # fail the client's request right away, rather than let it time out
+            if isinstance(obj, dict) and obj.get('id') is not None:
+                self._reply(client_socket, obj, {
+                    'type': 'error',
+                    'error': str(e)
+                })
+
+        self.metrics.histogram('handle.{}'.format(msg_type if msg_type in MESSAGE_TYPES else 'unknown')).observe(time.time() - started)
+
     def respond_to_command(self, client_socket, obj):
         msg_type = obj["type"]
 
         if msg_type is None:
             raise InvalidMessage(obj)
 
-        if msg_type == 'ping':
-            client_socket.send(json.dumps({
+        if msg_type == 'hello':
+            # pick the first of our codecs the client also speaks
+            codec = next((c for c in CODECS if c in (obj.get('codecs') or [])), 'json')
+            self.codecs[client_socket] = codec
+
+            # and likewise for compressing large messages, if it offers any
+            compression = next((c for c in self.offered_compressions if c in (obj.get('compressions') or [])), None)
+
+            self._reply(client_socket, obj, {
+                'type': 'hello',
+                'codec': codec,
+                'compression': compression
+            })
+
+            # only compress what's sent after the client got our answer
+            self.compressions[client_socket] = compression
+        elif msg_type == 'ping':
+            self._reply(client_socket, obj, {
                 'type': 'pong'
-            }))
+            })
         elif msg_type == "listclients":
-            client_socket.send(json.dumps(self.clients))
+            self._reply(client_socket, obj, {
+                'type': 'listclients',
+                'clients': self.clients.keys()
+            })
+        elif msg_type == 'subscribe':
+            # push new blocks of these chains to the client as they're appended,
+            # either as just the new tip ('tip') or the blocks themselves ('blocks')
+            if not isinstance(obj.get('bcs'), list) or obj.get('mode', 'tip') not in SUBSCRIBE_MODES:
+                raise InvalidMessage(obj)
+
+            keys = set(self._getblockchain({'bc': k}).key for k in obj['bcs'])
+
+            if len(keys) != 0:
+                self.subscriptions[client_socket] = (keys, obj.get('mode', 'tip'))
+            else:
+                self.subscriptions.pop(client_socket, None)
+
+            self._reply(client_socket, obj, {
+                'type': 'subscribed',
+                'bcs': sorted(keys)
+            })
+        elif msg_type == 'stats':
+            self._reply(client_socket, obj, {
+                'type': 'stats',
+                'stats': collect(self.stats_sources)
+            })
         elif msg_type == 'latestblock':
             # latest block was requested from a child node,
             # so we make sure we are in sync first, and if we are, send it along.
@@ -107,49 +447,358 @@ class Server:
             #self._checksync()
             bc = self._getblockchain(obj)
 
-            client_socket.send(json.dumps({
-                'type': 'retrievelatestblock',
-                'block': bc.latestblock().serialize_obj() if len(bc.blocks) != 0 else None,
-                'bc': bc.key
-            }))
+            self._reply(client_socket, obj, self.cache.tip(bc))
+        elif msg_type == 'headers':
+            # hashes of the requested blocks, for finding where chains fork
+            blockids = obj.get('blockids')
+
+            if not isinstance(blockids, list) or len(blockids) > MAX_HEADER_PROBES or not all(isinstance(blockid, (int, long)) for blockid in blockids):
+                raise InvalidMessage(obj)
+
+            bc = self._getblockchain(obj)
+            headers = []
+
+            for blockid in blockids:
+                blkhash = bc.hashof(blockid)
+                headers.append([blockid, blkhash.encode('hex')] if blkhash is not None else None)
+
+            self._reply(client_socket, obj, {
+                'type': 'headers',
+                'bc': bc.key,
+                'blockids': blockids,
+                'headers': headers
+            })
         elif msg_type == 'fetchblocks':
             if obj['blockidgt'] is None:
                 raise InvalidMessage(obj)
 
             bc = self._getblockchain(obj)
 
-            client_socket.send(json.dumps({
-                'type': 'retrieveblocks',
-                'blocks': [block.serialize_obj() for block in bc.blocks if block.blockid > obj['blockidgt']],
-                'bc': bc.key
-            }))
+            self._reply(client_socket, obj, self._fetchpage(bc, obj['blockidgt'], obj.get('limit'), obj.get('maxbytes'), self.codecs.get(client_socket, 'json')))
+        elif msg_type == 'balance':
+            if not isinstance(obj.get('acct'), basestring):
+                raise InvalidMessage(obj)
+
+            confirmed, unconfirmed = self.balances.lookup(obj['acct'])
+
+            self._reply(client_socket, obj, {
+                'type': 'balance',
+                'acct': obj['acct'],
+                'confirmed': confirmed,
+                'unconfirmed': unconfirmed
+            })
+        elif msg_type == 'accounthistory':
+            if not isinstance(obj.get('acct'), basestring) or not isinstance(obj.get('before'), (int, long, type(None))):
+                raise InvalidMessage(obj)
+
+            self._reply(client_socket, obj, self._historypage(obj['acct'], obj.get('before'), obj.get('limit'), self.codecs.get(client_socket, 'json')))
+        elif msg_type == 'submittx':
+            if self.mempool is None:
+                raise InvalidMessage('this node does not take transactions')
+
+            # the tx can still be turned away after it's accepted, when this
+            # node forwards it to another one (see node.py)
+            def onrejected(tid, reason):
+                self._push(client_socket, json.dumps({
+                    'type': 'submittedtx',
+                    'accepted': False,
+                    'txid': tid,
+                    'reason': reason
+                }))
+
+            try:
+                reply = {
+                    'type': 'submittedtx',
+                    'accepted': True,
+                    'txid': self.mempool.add(obj.get('sender'), obj.get('receiver'), obj.get('amt'), obj.get('nonce'), onrejected)
+                }
+            except TransactionRejected as e:
+                reply = {
+                    'type': 'submittedtx',
+                    'accepted': False,
+                    'reason': str(e)
+                }
+
+            self._reply(client_socket, obj, reply)
         elif msg_type == "broadcast":
-            if obj["msg"] is None:
+            # relay a message to every other client (see gossip.py)
+            msg = obj.get('msg')
+            msgid = obj.get('msgid')
+
+            if not isinstance(msg, dict) or not isinstance(msg.get('type'), basestring):
                 raise InvalidMessage(obj)
 
-            self.socket.sendall(obj["msg"])
+            if msgid is not None and (not isinstance(msgid, basestring) or len(msgid) > MAX_MSGID_LENGTH):
+                raise InvalidMessage(obj)
+
+            msgid = msgid or messageid(msg)
+
+            if self.broadcast(msg, msgid, exclude=client_socket):
+                for fn in self.broadcastlisteners:
+                    fn(msgid, msg)
+
+    # relay a message to every client but `exclude`, unless a message with the
+    # same id was relayed before. returns whether the message was new.
+    def broadcast(self, msg, msgid=None, exclude=None):
+        msgid = msgid or messageid(msg)
+
+        if not self.seen.add(msgid):
+            self.metrics.counter('duplicate_broadcasts').inc()
+            return False
+
+        payload = json.dumps({
+            'type': 'broadcast',
+            'msgid': msgid,
+            'msg': msg
+        })
+
+        for client_socket in self.clients.values():
+            if client_socket is not exclude:
+                self._push(client_socket, payload)
+
+        self.metrics.counter('broadcasts').inc()
+        return True
+
+    # send an encoded message to a client. replies and pushed messages are
+    # sent from different threads, so in threaded mode every client has its
+    # frames queued for a writer thread of its own, and in evented mode other
+    # threads hand their frames to the event loop. either way, a client that
+    # doesn't keep up only holds up itself.
+    #
+    # `droppable` messages are dropped if the client is too far behind, while
+    # anything else waits for room in its queue, up to CLIENT_TIMEOUT.
+    #
+    # `size` is the payload's uncompressed size, for payloads compressed ahead
+    # (see _announce), so bytes_saved counts them too.
+    def _send(self, client_socket, payload, droppable=False, size=None):
+        if size is None:
+            size = len(payload)
+
+        payload = compress(payload, self.compressions.get(client_socket))
+
+        if isinstance(client_socket, Connection):
+            if thread.get_ident() != self.loop_thread:
+                with self.pushlock:
+                    self.pushes.append((client_socket, encodeframe(payload), droppable))
+
+                os.write(self.wakeup[1], '\x00')
+            elif droppable and len(client_socket.outbuf) > SEND_BUFFER_BYTES:
+                self.metrics.counter('dropped_frames').inc()
+                return
+            else:
+                client_socket.sendall(encodeframe(payload))
+        else:
+            outbox = self.outboxes.get(client_socket)
+
+            if outbox is None:
+                # already disconnected
+                return
 
-    def handle_client_messages(self, client_socket, client_address):
-        while self.is_running:
             try:
-                data = client_socket.recv(1024)
+                if droppable:
+                    outbox.put_nowait(payload)
+                else:
+                    outbox.put(payload, timeout=CLIENT_TIMEOUT)
+            except Queue.Full:
+                if not droppable:
+                    raise socket.error('client is not reading')
+
+                self.metrics.counter('dropped_frames').inc()
+                return
+
+        self.metrics.counter('bytes_out').inc(FRAME_HEADER.size + len(payload))
+        self.metrics.counter('bytes_saved').inc(size - len(payload))
+
+    # push a message the client didn't ask for
+    def _push(self, client_socket, payload, size=None):
+        try:
+            self._send(client_socket, payload, droppable=True, size=size)
+        except Exception:
+            # the client's own handler notices the broken connection
+            pass
 
-                if (not data) or len(data) == 0:
+    # writes the frames queued for a client in threaded mode, until the
+    # client is removed
+    def _writeloop(self, client_socket, outbox):
+        while 1:
+            try:
+                payload = outbox.get(timeout=1)
+            except Queue.Empty:
+                if self.outboxes.get(client_socket) is not outbox:
                     break
+                continue
 
-                obj = None
+            if payload is None:
+                break
 
-                try:
-                    obj = json.loads(data)
-                except:
-                    raise InvalidMessage(data)
+            try:
+                sendframe(client_socket, payload)
+            except Exception:
+                break
+
+        # wakes up the client's reader, if it's still waiting
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+
+        client_socket.close()
 
-                self.respond_to_command(client_socket, obj)
+    # send the reply to `request` (a message object, or already encoded),
+    # tagged with the request's id so the client can match it up even when
+    # its requests are answered out of order
+    def _reply(self, client_socket, request, reply):
+        reqid = request.get('id') if isinstance(request, dict) else None
 
-            except InvalidMessage, e:
-                self.onstatus(str(e))
+        if isinstance(reply, dict):
+            if reqid is not None:
+                reply['id'] = reqid
+
+            reply = json.dumps(reply)
+        else:
+            reply = tagmessage(reply, reqid)
+
+        self._send(client_socket, reply)
+
+    def _onappend(self, bc, blk):
+        # called with the chain locked, so just hand the block to the announcer
+        if self.is_running and len(self.subscriptions) != 0:
+            self.announcements.put((bc, blk))
+
+    # tell subscribed clients about new blocks as soon as they're appended.
+    # blocks appended in a burst are announced together, one message per chain.
+    def announce_new_blocks(self):
+        while self.is_running:
+            try:
+                appended = [self.announcements.get(timeout=1)]
+            except Queue.Empty:
                 continue
 
+            time.sleep(ANNOUNCE_BATCH_WAIT)
+
+            while 1:
+                try:
+                    appended.append(self.announcements.get_nowait())
+                except Queue.Empty:
+                    break
+
+            runs = {} # chain key -> (chain, blocks in order)
+
+            for bc, blk in appended:
+                runs.setdefault(bc.key, (bc, []))[1].append(blk)
+
+            for key, (bc, blocks) in runs.iteritems():
+                messages = {} # (mode, codec, compression) -> (encoded announcement, uncompressed size)
+
+                for client_socket, (keys, mode) in self.subscriptions.items():
+                    if key not in keys:
+                        continue
+
+                    codec = self.codecs.get(client_socket, 'json')
+                    compression = self.compressions.get(client_socket)
+
+                    if (mode, codec, compression) not in messages:
+                        encoded = self._encodeannouncement(bc, blocks, mode, codec)
+                        messages[mode, codec, compression] = (compress(encoded, compression), len(encoded))
+
+                    payload, size = messages[mode, codec, compression]
+                    self._push(client_socket, payload, size)
+
+    def _encodeannouncement(self, bc, blocks, mode, codec):
+        header = {
+            'type': 'announce',
+            'bc': bc.key,
+            'blockid': blocks[-1].blockid
+        }
+
+        if mode == 'tip' or len(blocks) > ANNOUNCE_MAX_BLOCKS:
+            return json.dumps(header)
+
+        encoded = [self.cache.get(bc, blk, codec) for blk in blocks]
+
+        if codec == 'binary':
+            return encodebinarymessage(header, encoded)
+
+        return '{{"type": "announce", "bc": {}, "blockid": {}, "blocks": [{}]}}'.format(
+            json.dumps(bc.key), json.dumps(header['blockid']), ','.join(encoded))
+
+    # encode a page of an account's txs before blockid `before`, newest first.
+    # the reply carries the blockid of the oldest tx in the page as a cursor
+    # for fetching the next one.
+    def _historypage(self, acct, before, limit, codec):
+        limit = min(limit or HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE)
+
+        # one extra to tell whether there's more
+        blockids = self.accounts.lookup(acct, before, limit + 1)
+        more = len(blockids) > limit
+        blocks = [blk for blk in (self.tx_chain.find(blockid) for blockid in blockids[:limit]) if blk is not None]
+        encoded = [self.cache.get(self.tx_chain, blk, codec) for blk in blocks]
+
+        header = {
+            'type': 'accounthistory',
+            'acct': acct,
+            'cursor': blocks[-1].blockid if len(blocks) != 0 else before,
+            'more': more
+        }
+
+        if codec == 'binary':
+            return encodebinarymessage(header, encoded)
+
+        return '{{"type": "accounthistory", "acct": {}, "cursor": {}, "more": {}, "blocks": [{}]}}'.format(
+            json.dumps(acct), json.dumps(header['cursor']), json.dumps(more), ','.join(encoded))
+
+    # encode one page of the blocks after `blockidgt`, bounded by both a block
+    # count and a byte budget. the reply carries the blockid of the last block
+    # in the page as a cursor for fetching the next one.
+    def _fetchpage(self, bc, blockidgt, limit, maxbytes, codec):
+        limit = min(limit or FETCH_PAGE_SIZE, FETCH_PAGE_SIZE)
+        maxbytes = min(maxbytes or FETCH_PAGE_BYTES, FETCH_PAGE_BYTES, self.max_frame_size / 2)
+
+        blocks = bc.blocks
+        start = bc.positionafter(blockidgt)
+        end = len(blocks)
+
+        encoded = []
+        size = 0
+        cursor = blockidgt
+
+        for i in xrange(start, min(start + limit, end)):
+            data = self.cache.get(bc, blocks[i], codec)
+
+            # always send at least one block so the client makes progress
+            if len(encoded) != 0 and size + len(data) > maxbytes:
+                break
+
+            encoded.append(data)
+            size += len(data) + 1
+            cursor = blocks[i].blockid
+
+        more = start + len(encoded) < end
+
+        if codec == 'binary':
+            return encodebinarymessage({
+                'type': 'retrieveblocks',
+                'bc': bc.key,
+                'cursor': cursor,
+                'more': more
+            }, encoded)
+
+        return '{{"type": "retrieveblocks", "bc": {}, "cursor": {}, "more": {}, "blocks": [{}]}}'.format(
+            json.dumps(bc.key), json.dumps(cursor), json.dumps(more), ','.join(encoded))
+
+    def handle_client_messages(self, client_socket, client_address):
+        reader = FrameReader(self.max_frame_size)
+
+        while self.is_running:
+            try:
+                frames = reader.recv(client_socket)
+
+                if frames is None:
+                    break
+
+                for frame in frames:
+                    self._handlemessage(client_socket, frame)
+
             except Exception, e:
                 break
 
@@ -0,0 +1,186 @@
+import os
+import re
+import time
+import thread
+import datetime
+import hashlib
+import marshal
+
+from block import *
+
+SNAPSHOT_MAGIC = 'P2PSNAP1'
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# periodically writes the blocks of every chain, plus the state of the indexes
+# derived from them, into a single checksummed snapshot file. on startup the
+# latest valid snapshot is restored, and each chain only has to replay the
+# blocks in its log that came after the snapshot's tip. lazy chains only
+# have their blockids saved, as their blocks are read from the logs anyway.
+class Snapshotter:
+    def __init__(self, chains, indexes, path='./data', keep=2):
+        self.chains = chains # key -> Chain
+        self.indexes = indexes # name -> index with getstate()/setstate()
+        self.path = path
+        self.keep = keep
+        self.lastsize = None
+
+    def start(self, handlers, interval=300):
+        thread.start_new_thread(self._snapshotloop, (handlers, interval))
+
+    def _snapshotloop(self, handlers, interval):
+        while 1:
+            time.sleep(interval)
+
+            if not all(bc.local_blocks_loaded for bc in self.chains.values()):
+                continue
+
+            size = sum(len(bc.blocks) for bc in self.chains.values())
+
+            if size == self.lastsize:
+                continue
+
+            try:
+                fname = self.save()
+                self.lastsize = size
+                handlers['onstatus']('Wrote snapshot \'{}\'.'.format(fname))
+            except (IOError, OSError) as e:
+                handlers['onerror']('Failed to write snapshot. The error was: {}'.format(e))
+
+    def save(self):
+        keys = sorted(self.chains.keys())
+
+        # appends hold the chain's lock while updating the indexes, so holding
+        # every chain lock gives a consistent view of blocks and indexes.
+        for k in keys:
+            self.chains[k].lock.acquire()
+
+        try:
+            state = {
+                'chains': dict((k, [self._packblock(blk) for blk in self.chains[k].blocks]) for k in keys if not self.chains[k].lazy),
+                'blockids': dict((k, list(self.chains[k].blockids)) for k in keys if self.chains[k].lazy),
+                'hashes': dict((k, str(self.chains[k].hashes)) for k in keys),
+                'indexes': dict((name, index.getstate()) for name, index in self.indexes.iteritems())
+            }
+        finally:
+            for k in reversed(keys):
+                self.chains[k].lock.release()
+
+        # every block in the snapshot must be in the logs before the snapshot
+        # can stand in for them.
+        for k in keys:
+            self.chains[k].log.flush()
+
+        body = marshal.dumps(state)
+        fname = os.path.join(self.path, 'snapshot-{:d}.snap'.format(int(time.time() * 1000)))
+        tmpname = fname + '.tmp'
+
+        with open(tmpname, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(hashlib.sha1(body).digest())
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmpname, fname)
+
+        for old in self._snapshotfiles()[:-self.keep]:
+            os.remove(os.path.join(self.path, old))
+
+        return fname
+
+    # load the newest valid snapshot into the chains and indexes. must be called
+    # before the chains are loaded from their logs.
+    def restore(self, handlers):
+        # the indexes are still empty, so this is what they're reset to if a
+        # snapshot turns out to be bad halfway through restoring it
+        empty = dict((name, index.getstate()) for name, index in self.indexes.iteritems())
+
+        for fname in reversed(self._snapshotfiles()):
+            try:
+                state = self._read(os.path.join(self.path, fname))
+            except (IOError, ValueError, EOFError, TypeError) as e:
+                handlers['onerror']('Skipping snapshot \'{}\'. The error was: {}'.format(fname, e))
+                continue
+
+            missing = [name for name in self.indexes if name not in state.get('indexes', {})]
+
+            if len(missing) != 0:
+                # taken before these indexes existed; replay the logs instead
+                handlers['onstatus']('Skipping snapshot \'{}\', which has no state for {}.'.format(fname, ', '.join(sorted(missing))))
+                continue
+
+            keys = sorted(self.chains.keys())
+
+            for k in keys:
+                self.chains[k].lock.acquire()
+
+            try:
+                for k in keys:
+                    if k in state.get('blockids', {}):
+                        self.chains[k].setblockids(state['blockids'][k], state['hashes'].get(k))
+                    else:
+                        self.chains[k].setblocks([self._unpackblock(b) for b in state['chains'].get(k, [])], state.get('hashes', {}).get(k))
+
+                for name, index in self.indexes.iteritems():
+                    index.setstate(state['indexes'][name])
+            except (IOError, ValueError, TypeError, KeyError, AttributeError, AssertionError) as e:
+                # a well-formed file with a bad state; start over from empty
+                # chains and indexes, so nothing half restored is left behind
+                for k in keys:
+                    self.chains[k].setblocks([])
+
+                for name, index in self.indexes.iteritems():
+                    index.setstate(empty[name])
+
+                handlers['onerror']('Skipping snapshot \'{}\'. The error was: {!r}'.format(fname, e))
+                continue
+            finally:
+                for k in reversed(keys):
+                    self.chains[k].lock.release()
+
+            self.lastsize = sum(len(bc.blocks) for bc in self.chains.values())
+            handlers['onstatus']('Restored snapshot \'{}\'.'.format(fname))
+
+            return True
+
+        return False
+
+    def _read(self, fname):
+        with open(fname, 'rb') as f:
+            data = f.read()
+
+        if not data.startswith(SNAPSHOT_MAGIC):
+            raise ValueError('not a snapshot file')
+
+        checksum = data[len(SNAPSHOT_MAGIC):len(SNAPSHOT_MAGIC) + 20]
+        body = data[len(SNAPSHOT_MAGIC) + 20:]
+
+        if hashlib.sha1(body).digest() != checksum:
+            raise ValueError('checksum mismatch')
+
+        state = marshal.loads(body)
+
+        if not isinstance(state, dict):
+            raise ValueError('not a snapshot state')
+
+        return state
+
+    def _snapshotfiles(self):
+        pattern = re.compile('^snapshot-(\d+)\.snap$')
+        found = []
+
+        for fname in os.listdir(self.path):
+            m = pattern.match(fname)
+
+            if m is not None:
+                found.append((int(m.group(1)), fname))
+
+        return [fname for _, fname in sorted(found)]
+
+    def _packblock(self, blk):
+        return (blk.blockid, int((blk.timestamp - EPOCH).total_seconds()), blk.data, blk.parent)
+
+    def _unpackblock(self, packed):
+        blockid, ts, data, parent = packed
+
+        return Block(blockid=blockid, timestamp=EPOCH + datetime.timedelta(seconds=ts), data=data, parent=parent)
@@ -0,0 +1,418 @@
+import mmap
+import os
+import re
+import struct
+import thread
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from codec import *
+from metrics import *
+
+RECORD_HEADER = struct.Struct('>qI') # blockid, payload length
+INDEX_ENTRY = struct.Struct('>qqI') # blockid, record offset, payload length
+
+# append-only block storage for a single chain. blocks are written as
+# length-prefixed records into rolling segment files, with a compact offset
+# index alongside each segment. appends are collected by a writer thread and
+# committed in groups, so a burst of blocks costs one write (and one fsync).
+#
+# blocks are stored with the log's codec. records of either codec can be read
+# back, so a log may mix json blocks (e.g. migrated ones) with binary ones.
+#
+# sync policy:
+#   'always' - append() blocks until its group has been fsynced
+#   'batch'  - append() returns immediately, each group is fsynced
+#   'never'  - groups are written but fsync is left to the OS
+class BlockLog:
+    def __init__(self, key, path=None, segment_size=64 * 1024 * 1024, sync='batch', commit_interval=0.05, codec='binary', metrics=None):
+        assert sync in ('always', 'batch', 'never'), "sync should be one of 'always', 'batch', 'never'"
+        assert codec in CODECS, "codec should be one of {}".format(', '.join(CODECS))
+
+        self.key = key
+        self.codec = codec
+        self.path = path or './data/{}'.format(key)
+        self.segment_size = segment_size
+        self.sync = sync
+        self.commit_interval = commit_interval
+        self.metrics = metrics or Metrics()
+
+        # offset index, one entry per committed block in append order
+        self.blockids = array('l')
+        self.segments = array('i')
+        self.offsets = array('l')
+        self.lengths = array('I')
+
+        self.pending = [] # (blockid, payload) not yet picked up by the writer
+        self.inflight = [] # (blockid, payload) currently being written
+        self.appended = 0
+        self.committed = 0
+        self.error = None
+
+        self.segno = None
+        self.segsize = 0
+        self.segfile = None
+        self.idxfile = None
+        self.maps = {} # segno -> read-only mmap of the segment, see readmapped()
+
+        self.cond = threading.Condition()
+        self.is_open = False
+
+    def open(self):
+        with self.cond:
+            if self.is_open:
+                return
+
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+
+            segnos = self._segmentnumbers()
+
+            for arr in (self.blockids, self.segments, self.offsets, self.lengths):
+                del arr[:]
+
+            for segno in segnos:
+                self._loadsegment(segno)
+
+            self._opensegment(segnos[-1] if len(segnos) != 0 else 0)
+            self.is_open = True
+
+        thread.start_new_thread(self._commitloop, ())
+
+    def close(self):
+        self.flush()
+
+        with self.cond:
+            self.is_open = False
+            self._closemaps()
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.blockids) + len(self.inflight) + len(self.pending)
+
+    def append(self, blk):
+        self.appendraw(blk.blockid, encodestored(blk, self.codec))
+
+    def appendraw(self, blockid, payload):
+        self.open()
+
+        with self.cond:
+            if self.error is not None:
+                raise self.error
+
+            self.pending.append((blockid, payload))
+            self.appended += 1
+            ticket = self.appended
+            self.cond.notify_all()
+
+            if self.sync == 'always':
+                self._waitfor(ticket)
+
+    # wait until everything appended so far has been committed.
+    def flush(self):
+        if not self.is_open:
+            return
+
+        with self.cond:
+            self._waitfor(self.appended)
+
+    def __contains__(self, blockid):
+        with self.cond:
+            i = bisect_left(self.blockids, blockid)
+
+            if i != len(self.blockids) and self.blockids[i] == blockid:
+                return True
+
+            return any(pblockid == blockid for pblockid, payload in self.inflight + self.pending)
+
+    def read(self, blockid):
+        with self.cond:
+            i = bisect_left(self.blockids, blockid)
+
+            if i == len(self.blockids) or self.blockids[i] != blockid:
+                for pblockid, payload in self.inflight + self.pending:
+                    if pblockid == blockid:
+                        return payload
+
+                raise KeyError(blockid)
+
+            segno, offset, length = self.segments[i], self.offsets[i], self.lengths[i]
+
+        with open(self._segpath(segno), 'rb') as f:
+            f.seek(offset + RECORD_HEADER.size)
+            return f.read(length)
+
+    # like read(), but reads the block out of a memory map of its segment
+    # instead of opening the file, so reading blocks in random order is about
+    # as cheap as slicing a str. a segment is remapped when it has grown past
+    # its map.
+    def readmapped(self, blockid):
+        with self.cond:
+            i = bisect_left(self.blockids, blockid)
+
+            if i == len(self.blockids) or self.blockids[i] != blockid:
+                for pblockid, payload in self.inflight + self.pending:
+                    if pblockid == blockid:
+                        return payload
+
+                raise KeyError(blockid)
+
+            segno = self.segments[i]
+            start = self.offsets[i] + RECORD_HEADER.size
+            end = start + self.lengths[i]
+            m = self.maps.get(segno)
+
+            if m is None or len(m) < end:
+                if m is not None:
+                    m.close()
+
+                with open(self._segpath(segno), 'rb') as f:
+                    m = self.maps[segno] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            return m[start:end]
+
+    # yields (blockid, payload) for every committed block in append order,
+    # optionally only those after blockid `after`.
+    def iterrecords(self, after=None):
+        self.open()
+        self.flush()
+
+        f = None
+        fsegno = None
+        start = bisect_right(self.blockids, after) if after is not None else 0
+
+        try:
+            for i in xrange(start, len(self.blockids)):
+                if self.segments[i] != fsegno:
+                    if f is not None:
+                        f.close()
+
+                    fsegno = self.segments[i]
+                    f = open(self._segpath(fsegno), 'rb')
+
+                f.seek(self.offsets[i] + RECORD_HEADER.size)
+                yield self.blockids[i], f.read(self.lengths[i])
+        finally:
+            if f is not None:
+                f.close()
+
+    # one-time import of the old one-file-per-block layout ('<key>-<id>.dat').
+    # returns the number of blocks moved into the log.
+    def migrate(self):
+        self.open()
+
+        pattern = re.compile('^{}-(\d+)\.dat$'.format(re.escape(self.key)))
+        found = []
+
+        for fname in os.listdir(self.path):
+            m = pattern.match(fname)
+
+            if m is not None:
+                found.append((int(m.group(1)), fname))
+
+        if len(found) == 0:
+            return 0
+
+        found.sort()
+
+        lastblockid = self.blockids[-1] if len(self.blockids) != 0 else -1
+        num_migrated = 0
+
+        for blockid, fname in found:
+            # blocks at or below the tip were migrated before an interrupted cleanup
+            if blockid > lastblockid:
+                with open(os.path.join(self.path, fname)) as f:
+                    self.appendraw(blockid, f.read())
+
+                num_migrated += 1
+
+        self.flush()
+
+        if self.error is not None:
+            raise self.error
+
+        for blockid, fname in found:
+            os.remove(os.path.join(self.path, fname))
+
+        return num_migrated
+
+    def _waitfor(self, ticket):
+        while self.committed < ticket and self.error is None:
+            self.cond.wait(1)
+
+        if self.error is not None:
+            raise self.error
+
+    def _commitloop(self):
+        while 1:
+            with self.cond:
+                while len(self.pending) == 0 and self.is_open:
+                    self.cond.wait(1)
+
+                if len(self.pending) == 0:
+                    break
+
+            # give concurrent appends a moment to join this group
+            time.sleep(self.commit_interval)
+
+            with self.cond:
+                self.inflight, self.pending = self.pending, []
+
+            started = time.time()
+
+            # whatever stops the writer fails the appends waiting on it,
+            # instead of leaving them to wait forever
+            try:
+                entries = self._commit(self.inflight)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                break
+
+            with self.cond:
+                for blockid, segno, offset, length in entries:
+                    self.blockids.append(blockid)
+                    self.segments.append(segno)
+                    self.offsets.append(offset)
+                    self.lengths.append(length)
+
+                self.committed += len(self.inflight)
+                self.inflight = []
+                self.cond.notify_all()
+
+            # a group's write and fsync
+            self.metrics.histogram('disk_write_seconds').observe(time.time() - started)
+            self.metrics.counter('disk_bytes_written').inc(sum(RECORD_HEADER.size + length for blockid, segno, offset, length in entries))
+
+        self.segfile.close()
+        self.idxfile.close()
+
+    def _commit(self, batch):
+        entries = []
+        data = []
+        idxdata = []
+
+        for blockid, payload in batch:
+            if self.segsize >= self.segment_size:
+                self._write(data, idxdata)
+                data, idxdata = [], []
+
+                self.segfile.close()
+                self.idxfile.close()
+                self._opensegment(self.segno + 1)
+
+            entries.append((blockid, self.segno, self.segsize, len(payload)))
+            data.append(RECORD_HEADER.pack(blockid, len(payload)))
+            data.append(payload)
+            idxdata.append(INDEX_ENTRY.pack(blockid, self.segsize, len(payload)))
+
+            self.segsize += RECORD_HEADER.size + len(payload)
+
+        self._write(data, idxdata)
+
+        return entries
+
+    def _write(self, data, idxdata):
+        if len(data) == 0:
+            return
+
+        self.segfile.write(''.join(data))
+        self.segfile.flush()
+
+        # the index can always be rebuilt from the segment, so only the
+        # segment itself needs to be synced.
+        if self.sync != 'never':
+            os.fsync(self.segfile.fileno())
+
+        self.idxfile.write(''.join(idxdata))
+        self.idxfile.flush()
+
+    def _closemaps(self):
+        for m in self.maps.itervalues():
+            m.close()
+
+        self.maps.clear()
+
+    def _segpath(self, segno):
+        return os.path.join(self.path, '{}-{:06d}.seg'.format(self.key, segno))
+
+    def _idxpath(self, segno):
+        return os.path.join(self.path, '{}-{:06d}.idx'.format(self.key, segno))
+
+    def _segmentnumbers(self):
+        pattern = re.compile('^{}-(\d+)\.seg$'.format(re.escape(self.key)))
+        segnos = []
+
+        for fname in os.listdir(self.path):
+            m = pattern.match(fname)
+
+            if m is not None:
+                segnos.append(int(m.group(1)))
+
+        return sorted(segnos)
+
+    def _opensegment(self, segno):
+        self.segno = segno
+        self.segfile = open(self._segpath(segno), 'ab')
+        self.idxfile = open(self._idxpath(segno), 'ab')
+        self.segsize = self.segfile.tell()
+
+    # read a segment's offset index, recovering any records that made it into
+    # the segment but not the index, and cutting off a torn record at the end.
+    def _loadsegment(self, segno):
+        segpath = self._segpath(segno)
+        idxpath = self._idxpath(segno)
+        segsize = os.path.getsize(segpath)
+
+        entries = []
+        end = 0
+
+        if os.path.isfile(idxpath):
+            with open(idxpath, 'rb') as f:
+                idxdata = f.read()
+
+            for pos in xrange(0, len(idxdata) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+                blockid, offset, length = INDEX_ENTRY.unpack_from(idxdata, pos)
+
+                if offset != end or offset + RECORD_HEADER.size + length > segsize:
+                    break
+
+                entries.append((blockid, offset, length))
+                end = offset + RECORD_HEADER.size + length
+
+        num_indexed = len(entries)
+
+        with open(segpath, 'rb') as f:
+            f.seek(end)
+
+            while 1:
+                header = f.read(RECORD_HEADER.size)
+
+                if len(header) < RECORD_HEADER.size:
+                    break
+
+                blockid, length = RECORD_HEADER.unpack(header)
+
+                if end + RECORD_HEADER.size + length > segsize:
+                    break
+
+                f.seek(length, os.SEEK_CUR)
+                entries.append((blockid, end, length))
+                end += RECORD_HEADER.size + length
+
+        if end != segsize:
+            with open(segpath, 'r+b') as f:
+                f.truncate(end)
+
+        if not os.path.isfile(idxpath) or num_indexed != len(entries) or os.path.getsize(idxpath) != len(entries) * INDEX_ENTRY.size:
+            with open(idxpath, 'wb') as f:
+                f.write(''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+
+        for blockid, offset, length in entries:
+            self.blockids.append(blockid)
+            self.segments.append(segno)
+            self.offsets.append(offset)
+            self.lengths.append(length)
@@ -0,0 +1,61 @@
+import shutil
+import tempfile
+import unittest
+
+from client import *
+from test_codec import TIMESTAMP, _binary
+
+class ApplyBlocksTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.chains = [Chain(key, path=os.path.join(self.path, key)) for key in ('tx', 'tx_cnf', 'blk', 'blk_cnf')]
+        self.chains[0].append(GENESISTX)
+
+        handlers = { 'onerror': lambda msg: None, 'onstatus': lambda msg: None }
+        self.client = Client(*self.chains, handlers=handlers)
+
+    def tearDown(self):
+        for bc in self.chains:
+            bc.log.close()
+
+        shutil.rmtree(self.path)
+
+    def test_applies_good_binary_blocks(self):
+        blk = _binary(TransactionBatch(blockid=1, timestamp=TIMESTAMP, txs=[('0x0', 'b', 3)], parent=0))
+        errors = self.client._applyblocks(self.chains[0], [blk])
+
+        self.assertEqual(len(errors), 0)
+        self.assertEqual(self.chains[0].latestblock().blockid, 1)
+
+    def test_rejects_bad_binary_blocks(self):
+        blk = _binary(TransactionBatch(blockid=1, timestamp=TIMESTAMP, txs=[('0x0', 'b', 3), ('0x0', 'c', -7)], parent=0))
+        errors = self.client._applyblocks(self.chains[0], [blk])
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.chains[0].latestblock().blockid, 0)
+
+    def test_fails_batch_with_negative_amt(self):
+        blk = TransactionBatch(blockid=1, timestamp=TIMESTAMP, txs=[('0x0', 'b', 3), ('0x0', 'c', -7)], parent=0)
+        self.chains[0].append(blk)
+        self.client._confirmblock(self.chains[0], blk)
+
+        self.assertEqual(self.chains[1].latestblock().data['result'], 'FAILURE')
+
+    def test_confirms_covered_batch(self):
+        blk = TransactionBatch(blockid=1, timestamp=TIMESTAMP, txs=[('0x0', 'b', 3), ('0x0', 'c', 7)], parent=0)
+        self.chains[0].append(blk)
+        self.client._confirmblock(self.chains[0], blk)
+
+        self.assertEqual(self.chains[1].latestblock().data['result'], 'SUCCESS')
+
+    def test_rejects_broadcast_without_type(self):
+        relayed = []
+        self.client.addbroadcastlistener(lambda msgid, msg: relayed.append(msg))
+
+        with self.assertRaises(InvalidMessage):
+            self.client.respond_to_message({ 'type': 'broadcast', 'msgid': 'm', 'msg': { 'sender': '0x0' } })
+
+        self.assertEqual(relayed, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import datetime
+import unittest
+
+from codec import *
+
+TIMESTAMP = datetime.datetime(2018, 1, 2)
+
+# a block as it arrives in a binary message: encoded by the sender, decoded here
+def _binary(blk):
+    decoded, offset = decodeblock(encodeblock(blk))
+    return decoded
+
+class DecodeBatchTest(unittest.TestCase):
+    def test_binary_tx(self):
+        blk = _binary(Transaction(blockid=1, timestamp=TIMESTAMP, senderid='a', receiverid='b', amt=3, parent=0))
+        blocks, errors = decodebatch('tx', [blk], 0)
+
+        self.assertEqual(len(errors), 0)
+        self.assertEqual([b.blockid for b in blocks], [1])
+
+    def test_binary_batch_with_negative_amt(self):
+        blk = _binary(TransactionBatch(blockid=1, timestamp=TIMESTAMP, txs=[('a', 'b', 3), ('a', 'c', -7)], parent=0))
+        blocks, errors = decodebatch('tx', [blk], 0)
+
+        self.assertEqual(len(blocks), 0)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('amt', errors[0].reason)
+
+    def test_binary_batch_on_cnf_chain(self):
+        blk = _binary(TransactionBatch(blockid=1, timestamp=TIMESTAMP, txs=[('a', 'b', 3)], parent=0))
+        blocks, errors = decodebatch('tx_cnf', [blk], 0)
+
+        self.assertEqual(len(blocks), 0)
+        self.assertEqual(len(errors), 1)
+
+    def test_binary_cnf_on_tx_chain(self):
+        blk = _binary(Confirmation(blockid=1, timestamp=TIMESTAMP, linkedblockid=0, validatorid='v', result='SUCCESS', parent=0))
+        blocks, errors = decodebatch('tx', [blk], 0)
+
+        self.assertEqual(len(blocks), 0)
+        self.assertEqual(len(errors), 1)
+
+    def test_blocks_after_bad_block_are_dropped(self):
+        good = _binary(Transaction(blockid=1, timestamp=TIMESTAMP, senderid='a', receiverid='b', amt=3, parent=0))
+        bad = _binary(Transaction(blockid=2, timestamp=TIMESTAMP, senderid='a', receiverid='b', amt=-7, parent=1))
+        after = _binary(Transaction(blockid=3, timestamp=TIMESTAMP, senderid='a', receiverid='b', amt=3, parent=2))
+        blocks, errors = decodebatch('tx', [good, bad, after], 0)
+
+        self.assertEqual([b.blockid for b in blocks], [1])
+        self.assertEqual(errors[0].blockid, 2)
+
+if __name__ == '__main__':
+    unittest.main()